@@ -0,0 +1,84 @@
+from optparse import OptionParser
+
+from twitblob.api import DEFAULT_TOKEN_LIFETIME
+from twitblob.easy import make_storage
+from twitblob import transfer
+
+CONFIG_FILE = "config.json"
+
+USAGE = """%prog export|import <directory> [options]
+
+Exports every blob in the database configured by config.json to
+gzipped, newline-delimited JSON files in the given directory, or
+imports them from it. Run the same command again to resume one that
+was interrupted."""
+
+def make_parser():
+    parser = OptionParser(usage=USAGE)
+    parser.add_option('--workers', type='int',
+                      default=transfer.DEFAULT_WORKERS,
+                      help='number of user id ranges to export, or files '
+                           'to import, at once')
+    parser.add_option('--batch-size', type='int',
+                      default=transfer.DEFAULT_BATCH_SIZE,
+                      help='number of blobs read or written at a time')
+    parser.add_option('--tokens', action='store_true', default=False,
+                      help='also export auth tokens that haven\'t expired')
+    parser.add_option('--checkpoint', default=None,
+                      help='file to keep the progress of an import in, '
+                           'if the directory is read-only')
+    return parser
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    from twitblob import codec as json
+
+    parser = make_parser()
+    options, args = parser.parse_args()
+    if len(args) != 2 or args[0] not in ['export', 'import']:
+        parser.print_help()
+        sys.exit(1)
+    command, directory = args
+
+    if not os.path.exists(CONFIG_FILE):
+        print "%s not found. Please run server.py for details." % CONFIG_FILE
+        sys.exit(1)
+
+    config = json.loads(open(CONFIG_FILE).read())
+    storage = config.get('storage', 'mongo')
+
+    conn = None
+    connect = None
+    if storage == 'mongo':
+        import pymongo
+
+        try:
+            conn = pymongo.Connection()
+        except Exception, e:
+            print('Backing up MongoDB storage requires a MongoDB server '
+                  'to be active on localhost at the default port.')
+            sys.exit(1)
+        connect = pymongo.Connection
+
+    storage = make_storage(storage, conn, config['db_name'],
+                           config.get('shards'),
+                           config.get('retired_shards', ()),
+                           connect)
+
+    if command == 'export':
+        token_lifetime = None
+        if options.tokens:
+            token_lifetime = DEFAULT_TOKEN_LIFETIME
+        blobs, tokens = transfer.export(storage, directory, options.workers,
+                                        options.batch_size, token_lifetime)
+        print "exported %d blob(s) and %d token(s)." % (blobs, tokens)
+    else:
+        if not os.path.isdir(directory):
+            print "%s is not a directory." % directory
+            sys.exit(1)
+        blobs, tokens = transfer.import_(storage, directory, options.workers,
+                                         options.batch_size,
+                                         options.checkpoint)
+        print "imported %d blob(s) and %d token(s)." % (blobs, tokens)
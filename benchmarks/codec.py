@@ -0,0 +1,133 @@
+'''
+Measures how quickly each installed JSON implementation encodes and
+decodes the kinds of payloads Twitblob handles, and reports the
+results, along with which implementations twitblob.codec chose, as
+JSON.
+
+Run it from the root of the checkout, e.g.:
+
+    python -m benchmarks.codec --blob-size 2000 --batch 50 --users 1000
+'''
+
+import time
+import random
+import datetime
+from optparse import OptionParser
+
+import simplejson as json
+
+from twitblob import codec
+
+def make_blob(size, rand):
+    '''
+    Returns a blob of roughly the given encoded size, made of the
+    strings, numbers, lists and nested objects that web apps tend to
+    store.
+    '''
+
+    blob = {}
+    i = 0
+    while len(codec.dumps(blob)) < size:
+        kind = i % 4
+        if kind == 0:
+            value = u'note %d: caf\xe9 \u2603 <b>%s</b>' % (i, 'x' * 20)
+        elif kind == 1:
+            value = [rand.randint(0, 10 ** 9) for j in range(5)]
+        elif kind == 2:
+            value = {'updated': time.time(), 'score': rand.random(),
+                     'done': bool(i % 3), 'tags': ['a', 'b', None]}
+        else:
+            value = rand.random() * 1000
+        blob['key%d' % i] = value
+        i += 1
+    return blob
+
+def make_payloads(blob_size, batch, users, seed=0):
+    rand = random.Random(seed)
+    blob = make_blob(blob_size, rand)
+    return {
+        'blob': blob,
+        'ids': dict(('user%d' % i, blob) for i in range(batch)),
+        'who': [{'screen_name': 'user%d' % i, 'user_id': i}
+                for i in range(1, users + 1)]
+        }
+
+def best_time(func, arg, iterations, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        for j in xrange(iterations):
+            func(arg)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / iterations
+
+def measure(func, arg, size, min_time, repeats):
+    # Calibrate the number of iterations so that each repeat takes
+    # about min_time seconds.
+    iterations = 1
+    while best_time(func, arg, iterations, 1) * iterations < min_time:
+        iterations *= 2
+    seconds = best_time(func, arg, iterations, repeats)
+    return {
+        'ops_per_sec': 1 / seconds,
+        'mb_per_sec': size / seconds / 1e6
+        }
+
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option('--blob-size', type='int', default=2000,
+                      help='approximate size of each encoded blob')
+    parser.add_option('--batch', type='int', default=50,
+                      help='number of blobs in an ?ids= response')
+    parser.add_option('--users', type='int', default=1000,
+                      help='number of users in a /who/ response')
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='minimum seconds spent on each measurement')
+    parser.add_option('--repeats', type='int', default=3,
+                      help='number of measurements to take the best of')
+    parser.add_option('--output', default=None,
+                      help='file to write JSON results to')
+    options, args = parser.parse_args(argv)
+
+    payloads = make_payloads(options.blob_size, options.batch,
+                             options.users)
+    results = {}
+    for name, dumps, loads in codec.candidates():
+        result = {
+            'encodes_faithfully': codec.encodes_faithfully(dumps),
+            'decodes_faithfully': codec.decodes_faithfully(loads)
+            }
+        for payload_name, payload in payloads.items():
+            encoded = json.dumps(payload)
+            result[payload_name] = {
+                'dumps': measure(dumps, payload, len(encoded),
+                                 options.min_time, options.repeats),
+                'loads': measure(loads, encoded, len(encoded),
+                                 options.min_time, options.repeats)
+                }
+        results[name] = result
+
+    results = {
+        'implementations': results,
+        'chosen': {'dumps': codec.ENCODER, 'loads': codec.DECODER},
+        'config': {
+            'blob_size': options.blob_size,
+            'batch': options.batch,
+            'users': options.users,
+            'sizes': dict((name, len(json.dumps(payload)))
+                          for name, payload in payloads.items()),
+            'date': datetime.datetime.utcnow().isoformat()
+            }
+        }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    print output
+
+if __name__ == '__main__':
+    main()
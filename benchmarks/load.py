@@ -0,0 +1,338 @@
+'''
+Drives a TwitBlobApi with a realistic mix of requests and reports
+throughput, latency percentiles and storage calls per request as
+JSON, so that results can be diffed between releases.
+
+Run it from the root of the checkout, e.g.:
+
+    python -m benchmarks.load --users 1000 --blob-size 2000 \\
+        --mix get=80,post=10,put=4,ids=5,who=1 --requests 20000 \\
+        --driver http --threads 4 --output results.json
+
+By default the app is driven directly through its WSGI interface,
+with no sockets involved, and stores its data in memory.
+'''
+
+import time
+import random
+import datetime
+import threading
+import httplib
+from StringIO import StringIO
+from optparse import OptionParser
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from wsgiref.util import setup_testing_defaults
+
+import simplejson as json
+
+from twitblob.api import TwitBlobApi
+from twitblob.storage import Backend
+from twitblob.easy import make_storage, STORAGE_BACKENDS
+
+DEFAULT_MIX = 'get=80,post=10,put=4,ids=5,who=1'
+
+DBNAME = 'twitblob_benchmark_database'
+
+class CountingStorage(Backend):
+    '''
+    Wraps a storage backend, counting the calls made to it.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.request_tokens = backend.request_tokens
+        self.calls = 0
+        self.lock = threading.Lock()
+        for name in dir(Backend):
+            if not name.startswith('_'):
+                setattr(self, name, self.counted(getattr(backend, name)))
+
+    def counted(self, method):
+        def wrapper(*args, **kwargs):
+            self.lock.acquire()
+            try:
+                self.calls += 1
+            finally:
+                self.lock.release()
+            return method(*args, **kwargs)
+        return wrapper
+
+class NoTwitter(object):
+    def __call__(self, environ, start_response):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['logins are not benchmarked']
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation: %s' % name)
+        weights.append((name, int(weight)))
+    return weights
+
+def make_blob(size):
+    blob = {}
+    i = 0
+    while len(json.dumps(blob)) < size:
+        blob['key%d' % i] = 'x' * 40
+        i += 1
+    return blob
+
+class Workload(object):
+    def __init__(self, api, users, blob_size, ids_per_batch=50,
+                 who_limit=None, seed=0):
+        self.api = api
+        self.users = users
+        self.blob = make_blob(blob_size)
+        self.ids_per_batch = ids_per_batch
+        self.who_limit = who_limit
+        self.random = random.Random(seed)
+        self.tokens = []
+        for user_id in range(1, users + 1):
+            token = api.db.make_token('user%d' % user_id, user_id)
+            api.db.replace_user(token, self.blob)
+            self.tokens.append(token['id'])
+
+    def request(self, op):
+        '''
+        Returns a (method, path, body) tuple for the given operation.
+        '''
+
+        user_id = self.random.randint(1, self.users)
+        path = '/blobs/user%d' % user_id
+        token = self.tokens[user_id - 1]
+        if op == 'get':
+            return ('GET', path, None)
+        if op == 'post':
+            key = 'key%d' % self.random.randint(0, len(self.blob) - 1)
+            return ('POST', path, json.dumps({'token': token,
+                                              'data': {key: 'y' * 40}}))
+        if op == 'put':
+            return ('PUT', path, json.dumps({'token': token,
+                                             'data': self.blob}))
+        if op == 'ids':
+            ids = [self.random.randint(1, self.users)
+                   for i in range(self.ids_per_batch)]
+            return ('GET', '/blobs/?ids=%s' % ','.join(map(str, ids)), None)
+        if op == 'who':
+            if self.who_limit:
+                return ('GET', '/who/?limit=%d&after=%d' % (
+                    self.who_limit, self.random.randint(0, self.users)
+                    ), None)
+            return ('GET', '/who/', None)
+        raise ValueError(op)
+
+OPERATIONS = ['get', 'post', 'put', 'ids', 'who']
+
+class WsgiDriver(object):
+    '''
+    Sends requests straight to a WSGI application.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, method, path, body):
+        environ = {'REQUEST_METHOD': method}
+        if '?' in path:
+            path, environ['QUERY_STRING'] = path.split('?', 1)
+        environ['PATH_INFO'] = path
+        if body is not None:
+            environ['CONTENT_LENGTH'] = str(len(body))
+            environ['CONTENT_TYPE'] = 'application/json'
+            environ['wsgi.input'] = StringIO(body)
+        setup_testing_defaults(environ)
+        status = []
+        def start_response(s, headers, exc_info=None):
+            status.append(s)
+        result = self.app(environ, start_response)
+        size = sum(len(chunk) for chunk in result)
+        if hasattr(result, 'close'):
+            result.close()
+        return int(status[0].split()[0]), size
+
+    def close(self):
+        pass
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class HttpDriver(object):
+    '''
+    Serves a WSGI application over HTTP on a local port from a
+    background thread, and sends requests to it.
+    '''
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app,
+                                  handler_class=QuietHandler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __call__(self, method, path, body):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port)
+        headers = {}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        size = len(response.read())
+        conn.close()
+        return response.status, size
+
+    def close(self):
+        self.server.shutdown()
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p95_ms': 1000 * percentile(latencies, 0.95),
+        'p99_ms': 1000 * percentile(latencies, 0.99)
+        }
+
+def run(driver, workload, mix, requests, threads=1, counter=None):
+    ops = []
+    for name, weight in mix:
+        ops.extend([name] * weight)
+    plan = []
+    for i in range(requests):
+        op = workload.random.choice(ops)
+        plan.append((op, workload.request(op)))
+    latencies = {}
+    errors = []
+    lock = threading.Lock()
+    position = [0]
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                i = position[0]
+                position[0] += 1
+            finally:
+                lock.release()
+            if i >= len(plan):
+                return
+            op, request = plan[i]
+            start = time.time()
+            status, size = driver(*request)
+            latency = time.time() - start
+            lock.acquire()
+            try:
+                latencies.setdefault(op, []).append(latency)
+                if status >= 400:
+                    errors.append((op, status))
+            finally:
+                lock.release()
+
+    calls_before = counter and counter.calls
+    start = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+
+    results = {'total': summarize(sum(latencies.values(), []), elapsed),
+               'operations': {},
+               'errors': len(errors)}
+    for op, op_latencies in latencies.items():
+        results['operations'][op] = summarize(op_latencies, elapsed)
+    if counter is not None:
+        results['total']['storage_calls_per_request'] = (
+            float(counter.calls - calls_before) / requests
+            )
+    return results
+
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option('--users', type='int', default=1000,
+                      help='number of users with blobs')
+    parser.add_option('--blob-size', type='int', default=1000,
+                      help='approximate size of each blob, in bytes')
+    parser.add_option('--mix', default=DEFAULT_MIX,
+                      help='relative weights of each operation '
+                           '(default: %s)' % DEFAULT_MIX)
+    parser.add_option('--requests', type='int', default=10000,
+                      help='number of requests to send')
+    parser.add_option('--threads', type='int', default=1,
+                      help='number of concurrent clients')
+    parser.add_option('--ids-per-batch', type='int', default=50,
+                      help='number of ids in each ?ids= request')
+    parser.add_option('--who-limit', type='int', default=None,
+                      help='page size of /who/ requests (default: all)')
+    parser.add_option('--driver', type='choice', choices=['wsgi', 'http'], default='wsgi',
+                      help='call the WSGI app directly, or over HTTP')
+    parser.add_option('--storage', type='choice', choices=STORAGE_BACKENDS,
+                      default='memory', help='storage backend to use')
+    parser.add_option('--db-name', default=DBNAME,
+                      help='MongoDB database or SQLite file to use')
+    parser.add_option('--app-options', default='{}',
+                      help='JSON object of extra TwitBlobApi options')
+    parser.add_option('--output', default=None,
+                      help='file to write JSON results to')
+    options, args = parser.parse_args(argv)
+
+    conn = None
+    db_name = options.db_name
+    if options.storage == 'mongo':
+        import pymongo
+        conn = pymongo.Connection()
+        conn.drop_database(db_name)
+    elif options.storage == 'sqlite' and db_name == DBNAME:
+        db_name = ':memory:'
+
+    counter = CountingStorage(make_storage(options.storage, conn, db_name))
+    app_options = json.loads(options.app_options)
+    api = TwitBlobApi(twitter=NoTwitter(), db=counter,
+                      **dict((str(k), v) for k, v in app_options.items()))
+    mix = parse_mix(options.mix)
+    workload = Workload(api, options.users, options.blob_size,
+                        ids_per_batch=options.ids_per_batch,
+                        who_limit=options.who_limit)
+
+    if options.driver == 'http':
+        driver = HttpDriver(api.wsgi_app)
+    else:
+        driver = WsgiDriver(api.wsgi_app)
+    try:
+        results = run(driver, workload, mix, options.requests,
+                      threads=options.threads, counter=counter)
+    finally:
+        driver.close()
+
+    results['config'] = {
+        'users': options.users,
+        'blob_size': options.blob_size,
+        'mix': dict(mix),
+        'requests': options.requests,
+        'threads': options.threads,
+        'driver': options.driver,
+        'storage': options.storage,
+        'app_options': app_options,
+        'date': datetime.datetime.utcnow().isoformat()
+        }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    print output
+
+if __name__ == '__main__':
+    main()
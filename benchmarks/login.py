@@ -0,0 +1,143 @@
+'''
+Measures how quickly users can log in to a Twitblob app through the
+OAuth flow, against a local fake of Twitter's OAuth API, and reports
+throughput and latency percentiles as JSON.
+
+Run it from the root of the checkout, e.g.:
+
+    python -m benchmarks.login --logins 500 --threads 4 --delay 0.05
+'''
+
+import time
+import datetime
+import threading
+import httplib
+from urlparse import urlparse
+from optparse import OptionParser
+
+import oauth2 as oauth
+import simplejson as json
+
+from twitblob.api import TwitBlobApi
+from twitblob.storage import MemoryBackend
+from tests.fake_oauth import FakeOAuthProvider
+from twitblob.http_client import ConnectionPool, DEFAULT_MAX_IDLE
+from twitblob.twitter_client import TwitterOauthClientApp
+from twitblob.workers import listen, make_server
+from benchmarks.load import summarize
+
+def serve(app, threads):
+    server = make_server(listen('127.0.0.1', 0), app, threads)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def get(url):
+    parts = urlparse(url)
+    conn = httplib.HTTPConnection(parts.hostname, parts.port)
+    conn.request('GET', '%s?%s' % (parts.path, parts.query))
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status, response.getheader('Location')
+
+def login(app_url, screen_name):
+    '''
+    Follows the redirects of a login as a browser would, returning the
+    final status code.
+    '''
+
+    status, location = get(app_url + 'login/')
+    if status != 302:
+        return status
+    status, location = get('%s&screen_name=%s' % (location, screen_name))
+    if status != 302:
+        return status
+    return get(location)[0]
+
+def main(argv=None):
+    parser = OptionParser()
+    parser.add_option('--logins', type='int', default=200,
+                      help='number of logins to perform')
+    parser.add_option('--threads', type='int', default=4,
+                      help='number of concurrent clients')
+    parser.add_option('--delay', type='float', default=0.0,
+                      help='seconds the fake Twitter takes to respond')
+    parser.add_option('--read-timeout', type='float', default=10,
+                      help='seconds to wait for each read from Twitter')
+    parser.add_option('--output', default=None,
+                      help='file to write JSON results to')
+    options, args = parser.parse_args(argv)
+
+    provider = FakeOAuthProvider('key', 'secret', delay=options.delay)
+    # Each connection kept alive by the app's connection pool ties up
+    # one of the fake Twitter's threads, besides those serving the
+    # simulated browsers.
+    provider_server = serve(provider, options.threads * 2 +
+                            DEFAULT_MAX_IDLE)
+    backend = MemoryBackend()
+    twitter = TwitterOauthClientApp(
+        oauth.Consumer('key', 'secret'), oauth, backend.request_tokens,
+        http=ConnectionPool(read_timeout=options.read_timeout),
+        base_url='http://127.0.0.1:%d/oauth/' % provider_server.server_port
+        )
+    api = TwitBlobApi(twitter=twitter, db=backend)
+    app_server = serve(api.wsgi_app, options.threads)
+    app_url = 'http://127.0.0.1:%d/' % app_server.server_port
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [options.logins]
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+                i = remaining[0]
+            finally:
+                lock.release()
+            start = time.time()
+            status = login(app_url, 'user%d' % i)
+            latency = time.time() - start
+            lock.acquire()
+            try:
+                latencies.append(latency)
+                if status != 200:
+                    errors.append(status)
+            finally:
+                lock.release()
+
+    start = time.time()
+    workers = [threading.Thread(target=worker)
+               for i in range(options.threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    app_server.shutdown()
+    provider_server.shutdown()
+
+    results = summarize(latencies, elapsed)
+    results['errors'] = len(errors)
+    results['config'] = {
+        'logins': options.logins,
+        'threads': options.threads,
+        'delay': options.delay,
+        'date': datetime.datetime.utcnow().isoformat()
+        }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output)
+        f.close()
+    print output
+
+if __name__ == '__main__':
+    main()
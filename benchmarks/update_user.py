@@ -0,0 +1,101 @@
+'''
+Compares the latency and the number of document bytes moved between
+the application and MongoDB for a POST merge, using the old
+read-modify-write implementation of TwitBlobDb.update_user and the
+current single field-level update.
+
+Run it from the root of the checkout with a MongoDB server active on
+localhost at the default port:
+
+    python benchmarks/update_user.py --keys 200 --value-size 80
+'''
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import pymongo
+from bson import BSON
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twitblob.api import TwitBlobDb
+
+DBNAME = 'twitblob_benchmark_database'
+
+def bson_size(doc):
+    return len(BSON.encode(doc))
+
+def legacy_update_user(db, token, data):
+    # This is how update_user used to work before it was made atomic.
+    moved = bson_size({'screen_name': token['screen_name']})
+    blob = db.blobs.find_one({'screen_name': token['screen_name']})
+    if blob is not None:
+        moved += bson_size(blob)
+        for name in data:
+            blob['data'][name] = data[name]
+        data = blob['data']
+    doc = {'screen_name': token['screen_name'],
+           'user_id': token['user_id'],
+           'data': data}
+    moved += bson_size(doc)
+    db.blobs.update({'user_id': token['user_id']}, doc, upsert=True)
+    return moved
+
+def atomic_update_user(blobdb, token, data):
+    changes = {'screen_name': token['screen_name'],
+               'user_id': token['user_id']}
+    for name in data:
+        changes['data.%s' % name] = data[name]
+    blobdb.update_user(token, data)
+    return bson_size({'$set': changes})
+
+def run(name, func, existing, iterations):
+    latencies = []
+    moved = 0
+    for i in range(iterations):
+        start = time.time()
+        moved += func({'key%d' % (i % len(existing)): i})
+        latencies.append(time.time() - start)
+    latencies.sort()
+    print "%-8s  mean %7.3f ms  p95 %7.3f ms  %9.1f bytes/op" % (
+        name,
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[int(len(latencies) * 0.95)],
+        float(moved) / iterations
+        )
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--keys', type='int', default=200,
+                      help='number of keys in the stored blob')
+    parser.add_option('--value-size', type='int', default=80,
+                      help='size of each stored value, in bytes')
+    parser.add_option('--iterations', type='int', default=1000,
+                      help='number of merges to time for each path')
+    options, args = parser.parse_args()
+
+    db = pymongo.Connection()[DBNAME]
+    blobdb = TwitBlobDb(db)
+    token = {'screen_name': 'bob', 'user_id': 1}
+    existing = dict(('key%d' % i, 'x' * options.value_size)
+                    for i in range(options.keys))
+
+    print "merging one key into a %d-key blob, %d times per path" % (
+        options.keys, options.iterations)
+
+    db.blobs.remove()
+    blobdb.replace_user(token, dict(existing))
+    run('legacy', lambda data: legacy_update_user(db, token, data),
+        existing, options.iterations)
+
+    db.blobs.remove()
+    blobdb.replace_user(token, dict(existing))
+    run('atomic', lambda data: atomic_update_user(blobdb, token, data),
+        existing, options.iterations)
+
+    db.blobs.remove()
+
+if __name__ == '__main__':
+    main()
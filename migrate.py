@@ -0,0 +1,94 @@
+import datetime
+
+from twitblob.api import backfill_blob_json, DEFAULT_TOKEN_LIFETIME
+from twitblob.tokens import TokenSweeper, DEFAULT_REQUEST_TOKEN_LIFETIME
+from twitblob.easy import make_storage
+from twitblob.sharded_storage import ShardedBackend, rebalance
+
+CONFIG_FILE = "config.json"
+
+MIGRATIONS = {
+    'backfill-json': 'store the encoded JSON of blobs written before '
+                     'store_json was enabled',
+    'sweep-tokens': 'remove expired auth tokens, request tokens and '
+                    'revocations',
+    'rebalance-shards': 'move blobs and auth tokens to the shards they '
+                        'belong on after the shards have changed',
+    'feedback-stats': 'show how much feedback is waiting to be delivered',
+    'requeue-feedback': 'retry delivering feedback that was set aside '
+                        'after failing too many times'
+    }
+
+def backfill_json(storage, config):
+    # Setting up a TwitBlobDb would reset token expiry to the default
+    # lifetimes, rather than those the server is configured with.
+    count = backfill_blob_json(storage)
+    print "stored JSON for %d blob(s)." % count
+
+def sweep_tokens(storage, config):
+    request_token_lifetime = datetime.timedelta(seconds=config.get(
+        'request_token_lifetime',
+        DEFAULT_REQUEST_TOKEN_LIFETIME.seconds
+        ))
+    count = TokenSweeper(storage, DEFAULT_TOKEN_LIFETIME,
+                         request_token_lifetime).sweep()
+    print "removed %d expired token(s) and revocation(s)." % count
+
+def rebalance_shards(storage, config):
+    if not isinstance(storage, ShardedBackend):
+        print "no shards are configured."
+        return
+    count = rebalance(storage)
+    print "moved %d blob(s) and token(s)." % count
+
+def feedback_stats(storage, config):
+    stats = storage.feedback_stats()
+    print "%d message(s) queued, %d dead-lettered." % (stats['queued'],
+                                                        stats['dead'])
+    if stats['oldest'] is not None:
+        print "oldest queued message is from %s." % stats['oldest']
+
+def requeue_feedback(storage, config):
+    count = storage.requeue_dead_feedback(datetime.datetime.utcnow())
+    print "requeued %d message(s)." % count
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    from twitblob import codec as json
+
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        print "usage: %s <migration>\n" % sys.argv[0]
+        for name, text in MIGRATIONS.items():
+            print "  %-15s - %s" % (name, text)
+        print
+        sys.exit(1)
+
+    if not os.path.exists(CONFIG_FILE):
+        print "%s not found. Please run server.py for details." % CONFIG_FILE
+        sys.exit(1)
+
+    config = json.loads(open(CONFIG_FILE).read())
+    storage = config.get('storage', 'mongo')
+
+    conn = None
+    connect = None
+    if storage == 'mongo':
+        import pymongo
+
+        try:
+            conn = pymongo.Connection()
+        except Exception, e:
+            print('Running migrations with MongoDB storage requires a '
+                  'MongoDB server to be active on localhost at the '
+                  'default port.')
+            sys.exit(1)
+        connect = pymongo.Connection
+
+    migration = sys.argv[1].replace('-', '_')
+    storage = make_storage(storage, conn, config['db_name'],
+                           config.get('shards'),
+                           config.get('retired_shards', ()),
+                           connect)
+    globals()[migration](storage, config)
@@ -1,26 +1,64 @@
 from twitblob.easy import make_wsgi_app
+from twitblob import workers
 
 CONFIG_FILE = "config.json"
 
 CONFIG_DOCS = {
-    'db_name': 'name of the MongoDB database to use for storage',
+    'db_name': 'name of the MongoDB database, or path of the SQLite '
+               'file, to use for storage',
     'consumer_key': 'OAuth consumer key for Twitter',
     'consumer_secret': 'OAuth consumer secret for Twitter'
     }
 
+# Keys of config.json that configure the server rather than the app.
+SERVER_OPTIONS = {
+    'server': 'simple',
+    'host': '',
+    'port': 8000,
+    'workers': workers.DEFAULT_WORKERS,
+    'threads': workers.DEFAULT_THREADS,
+    'keepalive_timeout': workers.DEFAULT_KEEPALIVE_TIMEOUT,
+    'queue_size': workers.DEFAULT_QUEUE_SIZE,
+    'graceful_timeout': workers.DEFAULT_GRACEFUL_TIMEOUT,
+    'mongo_pool_size': None
+    }
+
+SERVERS = ['simple', 'threaded', 'prefork']
+
+def split_config(config):
+    app_config = {}
+    server_config = dict(SERVER_OPTIONS)
+    for name, value in config.items():
+        if name in SERVER_OPTIONS:
+            server_config[name] = value
+        else:
+            app_config[str(name)] = value
+    return app_config, server_config
+
+def connect_to_mongo(server_config, host=None, port=None):
+    import pymongo
+
+    # Each process gets its own connection pool, big enough for all
+    # of its request threads, so the total number of connections
+    # grows with the number of workers.
+    pool_size = server_config['mongo_pool_size']
+    if pool_size is None and server_config['server'] != 'simple':
+        pool_size = server_config['threads']
+    return pymongo.Connection(host, port, max_pool_size=pool_size)
+
+def make_app(config):
+    app_config, server_config = split_config(config)
+    conn = None
+    if app_config.get('storage', 'mongo') == 'mongo':
+        conn = connect_to_mongo(server_config)
+    connect = lambda host, port: connect_to_mongo(server_config, host, port)
+    return make_wsgi_app(conn, connect=connect, **app_config)
+
 if __name__ in ['__main__', '__builtin__']:
     import os
     import sys
 
-    import simplejson as json
-    import pymongo
-
-    try:
-        conn = pymongo.Connection()
-    except Exception, e:
-        print('Running this app requires a MongoDB server '
-              'to be active on localhost at the default port.')
-        sys.exit(1)
+    from twitblob import codec as json
 
     if not os.path.exists(CONFIG_FILE):
         print("%s not found. Please create a JSON-formatted file with "
@@ -30,7 +68,10 @@ if __name__ in ['__main__', '__builtin__']:
         print
         sys.exit(1)
 
-    config = json.loads(open(CONFIG_FILE).read())
+    def load_config():
+        return json.loads(open(CONFIG_FILE).read())
+
+    config = load_config()
 
     missing_keys = [name for name in CONFIG_DOCS
                     if name not in config]
@@ -43,12 +84,61 @@ if __name__ in ['__main__', '__builtin__']:
         print
         sys.exit(1)
 
-    app = make_wsgi_app(conn, **config)
+    app_config, server_config = split_config(config)
+
+    if server_config['server'] not in SERVERS:
+        print "'server' must be one of: %s" % ', '.join(SERVERS)
+        sys.exit(1)
+
+    # Each worker process would have its own, separate, memory.
+    if (server_config['server'] == 'prefork' and
+        app_config.get('storage', 'mongo') == 'memory'):
+        print("'memory' storage can't be shared between 'prefork' "
+              "workers; use the 'threaded' server instead.")
+        sys.exit(1)
+
+    # Multi-worker servers make their apps once they've started up.
+    if __name__ == '__builtin__' or server_config['server'] == 'simple':
+        try:
+            app = make_app(config)
+        except Exception, e:
+            if app_config.get('storage', 'mongo') != 'mongo':
+                raise
+            print('Running this app with MongoDB storage requires a MongoDB '
+                  'server to be active on localhost at the default port.')
+            sys.exit(1)
 
     if __name__ == '__main__':
-        from wsgiref.simple_server import make_server
+        import logging
+
+        logging.basicConfig()
+
+        host = server_config['host']
+        port = server_config['port']
+        options = dict(threads=server_config['threads'],
+                       keepalive_timeout=server_config['keepalive_timeout'],
+                       graceful_timeout=server_config['graceful_timeout'],
+                       queue_size=server_config['queue_size'])
+
+        # Apps are made from a fresh read of the config file, so that
+        # changes to it are picked up when the server receives SIGHUP.
+        app_factory = lambda: make_app(load_config())
+
+        if server_config['server'] == 'simple':
+            from wsgiref.simple_server import make_server
 
-        port = 8000
-        httpd = make_server('', port, app)
-        print "serving on port %d" % port
-        httpd.serve_forever()
+            httpd = make_server(host, port, app)
+            print "serving on port %d" % port
+            httpd.serve_forever()
+        elif server_config['server'] == 'threaded':
+            print "serving on port %d with %d threads" % (
+                port, options['threads']
+                )
+            workers.serve_threaded(app_factory, host, port, **options)
+        else:
+            print "serving on port %d with %d workers of %d threads" % (
+                port, server_config['workers'], options['threads']
+                )
+            workers.serve_prefork(app_factory, host, port,
+                                  workers=server_config['workers'],
+                                  **options)
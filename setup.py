@@ -7,7 +7,7 @@ setup(name="twitblob",
       author="Atul Varma",
       author_email="atul@mozilla.com",
       url="http://hg.toolness.com/twitblob",
-      packages = find_packages(),
+      packages = find_packages(exclude=["benchmarks"]),
       install_requires = ['oauth2', 'simplejson'],
       license = "MIT License",
       zip_safe = True,
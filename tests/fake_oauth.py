@@ -0,0 +1,174 @@
+'''
+A stand-in for the parts of Twitter's OAuth API that
+TwitterOauthClientApp uses, so that logins can be tested and
+benchmarked without a network connection.
+'''
+
+import time
+import threading
+import urllib
+from cgi import parse_qsl
+from wsgiref.util import request_uri
+
+import oauth2 as oauth
+
+from twitblob.api import gentoken
+
+class FakeOAuthProvider(object):
+    '''
+    A WSGI application that issues request tokens and access tokens
+    like Twitter does, checking the signature of every request made
+    to it. Its authorize page approves every request immediately,
+    logging in as the user given by its 'screen_name' query argument.
+
+    Like Twitter, it rejects requests that reuse the nonce and
+    timestamp of one it has already seen, even one that failed.
+
+    Setting 'delay' makes every response take that many seconds, and
+    any statuses appended to 'failures' are returned, in order,
+    instead of the next responses.
+    '''
+
+    def __init__(self, consumer_key, consumer_secret, delay=0):
+        self.consumer = oauth.Consumer(consumer_key, consumer_secret)
+        self.server = oauth.Server()
+        self.server.add_signature_method(oauth.SignatureMethod_HMAC_SHA1())
+        self.delay = delay
+        self.failures = []
+        self.lock = threading.Lock()
+        self.request_tokens = {}
+        self.user_ids = {}
+        self.nonces = set()
+
+    def __call__(self, environ, start_response):
+        if self.delay:
+            time.sleep(self.delay)
+        path = environ['PATH_INFO']
+        try:
+            req = None
+            if path in ['/oauth/request_token', '/oauth/access_token']:
+                req = self.parse(environ)
+                self.use_nonce(req)
+
+            self.lock.acquire()
+            try:
+                failure = self.failures and self.failures.pop(0)
+            finally:
+                self.lock.release()
+            if failure:
+                start_response(failure, [('Content-Type', 'text/plain')])
+                return [failure]
+
+            if path == '/oauth/request_token':
+                return self.request_token(req, start_response)
+            if path == '/oauth/authorize':
+                return self.authorize(environ, start_response)
+            if path == '/oauth/access_token':
+                return self.access_token(req, start_response)
+        except oauth.Error, e:
+            start_response('401 Unauthorized',
+                           [('Content-Type', 'text/plain')])
+            return [str(e)]
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['unknown path: %s' % path]
+
+    def parse(self, environ):
+        # OAuth parameters may be in the Authorization header, the
+        # query string or a form-encoded body.
+        if environ['REQUEST_METHOD'] == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            query_string = environ['wsgi.input'].read(length)
+        else:
+            query_string = environ.get('QUERY_STRING', '')
+        headers = {}
+        if 'HTTP_AUTHORIZATION' in environ:
+            headers['Authorization'] = environ['HTTP_AUTHORIZATION']
+        req = oauth.Request.from_request(
+            environ['REQUEST_METHOD'],
+            request_uri(environ, include_query=False),
+            headers=headers,
+            query_string=query_string
+            )
+        if req is None:
+            raise oauth.Error('missing OAuth parameters')
+        return req
+
+    def use_nonce(self, req):
+        nonce = (req.get('oauth_timestamp'), req.get('oauth_nonce'))
+        self.lock.acquire()
+        try:
+            if nonce in self.nonces:
+                raise oauth.Error('nonce already used')
+            self.nonces.add(nonce)
+        finally:
+            self.lock.release()
+
+    def respond(self, start_response, params):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [urllib.urlencode(params)]
+
+    def request_token(self, req, start_response):
+        self.server.verify_request(req, self.consumer, None)
+        token = oauth.Token(gentoken(), gentoken())
+        self.lock.acquire()
+        try:
+            self.request_tokens[token.key] = {
+                'token': token,
+                'callback': str(req['oauth_callback']),
+                'verifier': None,
+                'screen_name': None
+                }
+        finally:
+            self.lock.release()
+        return self.respond(start_response, [
+            ('oauth_token', token.key),
+            ('oauth_token_secret', token.secret),
+            ('oauth_callback_confirmed', 'true')
+            ])
+
+    def authorize(self, environ, start_response):
+        qargs = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+        self.lock.acquire()
+        try:
+            info = self.request_tokens.get(qargs.get('oauth_token'))
+            if info is not None:
+                info['verifier'] = gentoken()
+                info['screen_name'] = qargs.get('screen_name', 'user')
+        finally:
+            self.lock.release()
+        if info is None:
+            raise oauth.Error('invalid request token')
+        location = '%s?%s' % (info['callback'], urllib.urlencode([
+            ('oauth_token', info['token'].key),
+            ('oauth_verifier', info['verifier'])
+            ]))
+        start_response('302 Found', [('Location', location)])
+        return []
+
+    def access_token(self, req, start_response):
+        self.lock.acquire()
+        try:
+            info = self.request_tokens.pop(req.get('oauth_token'), None)
+        finally:
+            self.lock.release()
+        if info is None or info['verifier'] is None:
+            raise oauth.Error('invalid request token')
+        info['token'].set_verifier(info['verifier'])
+        self.server.verify_request(req, self.consumer, info['token'])
+        if req.get('oauth_verifier') != info['verifier']:
+            raise oauth.Error('invalid verifier')
+
+        screen_name = info['screen_name']
+        self.lock.acquire()
+        try:
+            if screen_name not in self.user_ids:
+                self.user_ids[screen_name] = len(self.user_ids) + 1
+            user_id = self.user_ids[screen_name]
+        finally:
+            self.lock.release()
+        return self.respond(start_response, [
+            ('oauth_token', gentoken()),
+            ('oauth_token_secret', gentoken()),
+            ('user_id', str(user_id)),
+            ('screen_name', screen_name)
+            ])
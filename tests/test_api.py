@@ -1,48 +1,91 @@
 import simplejson as json
 import datetime
+import zlib
+import os
 
-import pymongo
+from webob import Request
 from webtest import TestApp
 from twitblob.api import TwitBlobApi, gentoken
+from twitblob.easy import make_storage, STORAGE_BACKENDS
+from twitblob.storage import MemoryBackend
+from twitblob.purge import RecordingPurger, BackgroundPurger
+from twitblob.metrics import route_name
+from twitblob.admission import route_class
 
 DBNAME = 'twitblob_test_database'
 
+# The storage backend to run the test suite against.
+BACKEND = os.environ.get('TWITBLOB_TEST_BACKEND', 'mongo')
+
+# The number of shards to spread the test database across, if any.
+SHARDS = int(os.environ.get('TWITBLOB_TEST_SHARDS', '0'))
+
 api = None
 app = None
 twitter = None
-db = None
+storage = None
 
 USER_IDS = {
     'bob': '1',
     'jane': '2'
     }
 
-try:
-    conn = pymongo.Connection()
-except Exception, e:
-    raise Exception('Running this test suite requires a MongoDB server '
-                    'to be active on localhost at the default port.')
+if BACKEND not in STORAGE_BACKENDS:
+    raise Exception('TWITBLOB_TEST_BACKEND must be one of: %s' %
+                    ', '.join(STORAGE_BACKENDS))
+
+conn = None
+if BACKEND == 'mongo':
+    import pymongo
+
+    try:
+        conn = pymongo.Connection()
+    except Exception, e:
+        raise Exception('Running this test suite against MongoDB requires '
+                        'a MongoDB server to be active on localhost at the '
+                        'default port. Set TWITBLOB_TEST_BACKEND to '
+                        '"memory" or "sqlite" to use another backend.')
 
-def apptest(func):
-    def wrapper():
-        g = globals()
+def make_test_storage():
+    if BACKEND == 'mongo':
+        db_names = [DBNAME]
+        if SHARDS:
+            db_names = ['%s_%d' % (DBNAME, i) for i in range(SHARDS)]
+        for db_name in db_names:
+            db = conn[db_name]
 
-        g['db'] = conn[DBNAME]
+            for coll in [name for name in db.collection_names()
+                         if not name.startswith('system.')]:
+                db[coll].remove()
 
-        for coll in [name for name in db.collection_names()
-                     if not name.startswith('system.')]:
-            db[coll].remove()
+        if SHARDS:
+            return make_storage(BACKEND, conn, DBNAME, shards=db_names)
+        return make_storage(BACKEND, conn, DBNAME)
+    if SHARDS:
+        return make_storage(BACKEND, None, None,
+                            shards=[':memory:'] * SHARDS)
+    return make_storage(BACKEND, None, ':memory:')
 
-        g['twitter'] = FakeTwitter()
-        g['api'] = TwitBlobApi(twitter=twitter, db=db,
-                               utcnow=TimeMachine.utcnow,
-                               gentoken=EntropyMachine.gentoken)
-        g['app'] = TestApp(api.wsgi_app)
+def apptest_with(**api_kwargs):
+    def decorator(func):
+        def wrapper():
+            g = globals()
 
-        func()
+            g['storage'] = make_test_storage()
+            g['twitter'] = FakeTwitter()
+            g['api'] = TwitBlobApi(twitter=twitter, db=storage,
+                                   utcnow=TimeMachine.utcnow,
+                                   gentoken=EntropyMachine.gentoken,
+                                   **api_kwargs)
+            g['app'] = TestApp(api.wsgi_app)
 
-    wrapper.__name__ = func.__name__
-    return wrapper
+            func()
+
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+apptest = apptest_with()
 
 class EntropyMachine(object):
     next = []
@@ -91,6 +134,15 @@ def put_json(url, obj, **kwargs):
                    {'Content-Type': 'application/json'},
                    **kwargs)
 
+def raw_get(url, **headers):
+    # WebTest transparently decodes compressed responses, so
+    # compression has to be tested without it.
+    return Request.blank(url, headers=headers).get_response(api.wsgi_app)
+
+def get_metrics(**kwargs):
+    return app.get('/metrics/', headers={'Authorization': 'Bearer secret'},
+                   **kwargs)
+
 def do_login(screen_name):
     assert screen_name in USER_IDS
 
@@ -106,6 +158,85 @@ def test_login_contains_quota_info():
     resp = app.get('/login/fake-callback')
     assert '"quota": 20000' in resp
 
+    # The quota clients are told about is the one writes are held to.
+    token = do_login('bob')
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+    assert resp.json == {'success': True, 'usage': 8, 'quota': 20000,
+                         'remaining': 19992}
+
+@apptest_with(blob_quota=0)
+def test_login_leaves_out_quota_when_it_is_off():
+    twitter.fake_screen_name = 'bob'
+    twitter.fake_user_id = USER_IDS['bob']
+    resp = app.get('/login/fake-callback')
+    assert '"quota"' not in resp
+
+    token = do_login('bob')
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+    assert resp.json == {'success': True}
+
+@apptest_with(blob_quota=30)
+def test_blob_quota():
+    twitter.fake_screen_name = 'bob'
+    twitter.fake_user_id = USER_IDS['bob']
+    assert '"quota": 30' in app.get('/login/fake-callback')
+
+    token = do_login('bob')
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'a': 'x' * 10}})
+    assert resp.json == {'success': True, 'usage': 19, 'quota': 30,
+                         'remaining': 11}
+
+    # Merges count the keys already stored, and replacing a key
+    # frees up the space it took.
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'b': 'x' * 10}},
+                     status=413)
+    assert resp.json == {'error': 'blob would exceed quota', 'size': 38,
+                         'quota': 30}
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'a': 'x'}})
+    assert resp.json['usage'] == 10
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'b': 'x' * 10}})
+    assert resp.json['usage'] == 29
+    assert app.get('/blobs/bob').json == {'a': 'x', 'b': 'x' * 10}
+
+    put_json('/blobs/bob', {'token': token, 'data': {'c': 'x' * 30}},
+             status=413)
+    resp = put_json('/blobs/bob', {'token': token, 'data': {}})
+    assert resp.json['remaining'] == 28
+
+@apptest_with(blob_quota=30)
+def test_blob_quota_merges_retry_on_conflict():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+
+    # Another write gets in between the read and the write of a merge.
+    replace_blob = storage.replace_blob
+    def racing_replace_blob(*args, **kwargs):
+        storage.replace_blob = replace_blob
+        replace_blob(1, 'bob', {'a': 1, 'c': 3})
+        return replace_blob(*args, **kwargs)
+    storage.replace_blob = racing_replace_blob
+
+    post_json('/blobs/bob', {'token': token, 'data': {'b': 2}})
+    assert app.get('/blobs/bob').json == {'a': 1, 'b': 2, 'c': 3}
+
+@apptest_with(blob_quota=30)
+def test_blob_quota_merges_give_up_after_repeated_conflicts():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+
+    replace_blob = storage.replace_blob
+    def racing_replace_blob(*args, **kwargs):
+        replace_blob(1, 'bob', {'a': 1})
+        return replace_blob(*args, **kwargs)
+    storage.replace_blob = racing_replace_blob
+
+    resp = post_json('/blobs/bob', {'token': token, 'data': {'b': 2}},
+                     status=409)
+    assert resp.json == {'error': 'blob is being changed by another '
+                                  'request, try again'}
+    storage.replace_blob = replace_blob
+    assert app.get('/blobs/bob').json == {'a': 1}
+
 @apptest
 def test_tokens_are_unique():
     EntropyMachine.next[:] = ['b', 'a', 'a', 'a', 'a']
@@ -155,6 +286,206 @@ def test_get_user_list():
     assert resp.json == [{'screen_name': 'bob',
                           'user_id': 1}]
 
+def post_users(*names):
+    for name in names:
+        post_json('/blobs/%s' % name,
+                  {'token': do_login(name),
+                   'data': {'hai': 1}})
+
+@apptest_with(user_directory=True)
+def test_user_directory():
+    post_users('jane')
+    storage.replace_blob(3, 'mallory', {})
+    resp = app.get('/who/')
+    assert resp.json == [{'screen_name': 'jane', 'user_id': 2}]
+    etag = resp.headers['ETag']
+    app.get('/who/', headers={'If-None-Match': etag}, status=304)
+
+    post_users('bob')
+    resp = app.get('/who/', headers={'If-None-Match': etag})
+    assert resp.json == [{'screen_name': 'bob', 'user_id': 1},
+                         {'screen_name': 'jane', 'user_id': 2}]
+    resp = app.get('/who/?after=1&limit=1')
+    assert resp.json == [{'screen_name': 'jane', 'user_id': 2}]
+
+    # Users added elsewhere show up once the directory is refreshed.
+    TimeMachine.travel(api.db.directory.refresh_interval)
+    resp = app.get('/who/?after=2')
+    assert resp.json == [{'screen_name': 'mallory', 'user_id': 3}]
+
+@apptest_with(user_directory=True)
+def test_user_directory_keeps_users_seen_while_refreshing():
+    post_users('jane')
+    TimeMachine.travel(api.db.directory.refresh_interval)
+
+    # Bob's blob is written after the refresh has read the users.
+    iter_users = storage.iter_users
+    def racing_iter_users(*args, **kwargs):
+        users = list(iter_users(*args, **kwargs))
+        storage.iter_users = iter_users
+        post_users('bob')
+        return users
+    storage.iter_users = racing_iter_users
+
+    resp = app.get('/who/')
+    assert resp.json == [{'screen_name': 'bob', 'user_id': 1},
+                         {'screen_name': 'jane', 'user_id': 2}]
+
+class LaggingReplica(MemoryBackend):
+    lag = datetime.timedelta(0)
+
+    def replication_lag(self):
+        return self.lag
+
+@apptest_with(read_replica=LaggingReplica(), max_staleness=10,
+              pin_window=5)
+def test_read_replica():
+    replica = api.db.router.replica
+    replica.replace_blob(2, 'jane', {'from': 'replica'})
+    storage.replace_blob(2, 'jane', {'from': 'primary'})
+    assert app.get('/blobs/jane').json == {'from': 'replica'}
+    assert app.get('/who/').json == [{'screen_name': 'jane', 'user_id': 2}]
+
+    # Writers see their own writes, and new users see themselves
+    # listed, for a while afterwards.
+    post_users('bob')
+    assert app.get('/blobs/bob').json == {'hai': 1}
+    resp = app.get('/blobs/?ids=1,2')
+    assert resp.json == {'bob': {'hai': 1}, 'jane': {'from': 'replica'}}
+    assert len(app.get('/who/').json) == 2
+    TimeMachine.travel(seconds=5)
+    app.get('/blobs/bob', status=404)
+    assert len(app.get('/who/').json) == 1
+
+    # A replica that's too far behind isn't used until it catches up.
+    replica.lag = datetime.timedelta(seconds=11)
+    TimeMachine.travel(seconds=1)
+    assert app.get('/blobs/jane').json == {'from': 'primary'}
+    replica.lag = datetime.timedelta(0)
+    assert app.get('/blobs/jane').json == {'from': 'primary'}
+    TimeMachine.travel(seconds=1)
+    assert app.get('/blobs/jane').json == {'from': 'replica'}
+
+@apptest_with(cache_control='public, max-age=10',
+              surrogate_control='max-age=3600', surrogate_keys=True)
+def test_cache_headers():
+    post_users('bob')
+    resp = app.get('/blobs/bob')
+    assert resp.headers['Cache-Control'] == 'public, max-age=10'
+    assert resp.headers['Surrogate-Control'] == 'max-age=3600'
+    assert resp.headers['Surrogate-Key'] == 'user-1 name-bob'
+    etag = resp.headers['ETag']
+    resp = app.get('/blobs/bob', headers={'If-None-Match': etag}, status=304)
+    assert resp.headers['Cache-Control'] == 'public, max-age=10'
+    resp = app.get('/blobs/?ids=1,2,1')
+    assert resp.headers['Surrogate-Key'] == 'user-1 user-2'
+    resp = app.get('/blobs/?names=bob,jane')
+    assert resp.headers['Surrogate-Key'] == 'name-bob name-jane user-1'
+    resp = app.get('/who/')
+    assert resp.headers['Surrogate-Key'] == 'users'
+
+    # Errors aren't cached.
+    resp = app.get('/blobs/jane', status=404)
+    assert 'Cache-Control' not in resp.headers
+
+@apptest
+def test_no_cache_headers_by_default():
+    post_users('bob')
+    resp = app.get('/blobs/bob')
+    assert 'Cache-Control' not in resp.headers
+    assert 'Surrogate-Key' not in resp.headers
+
+@apptest_with(purger=RecordingPurger())
+def test_writes_purge_cached_responses():
+    purged = api.db.purger.purged
+    del purged[:]
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+    assert purged == [['user-1', 'name-bob', 'users']]
+    put_json('/blobs/bob', {'token': token, 'data': {'b': 2}})
+    assert purged[1:] == [['user-1', 'name-bob']]
+
+    # Failed writes purge nothing.
+    post_json('/blobs/bob', {'token': 'bad', 'data': {}}, status=403)
+    assert len(purged) == 2
+
+@apptest_with(purger=RecordingPurger(), user_directory=True)
+def test_renames_purge_user_list():
+    purged = api.db.purger.purged
+    del purged[:]
+    post_users('bob')
+    twitter.fake_screen_name = 'robert'
+    twitter.fake_user_id = USER_IDS['bob']
+    token = app.get('/login/fake-callback').headers['X-access-token']
+    post_json('/blobs/robert', {'token': token, 'data': {}})
+    assert purged == [['user-1', 'name-bob', 'users'],
+                      ['user-1', 'name-robert', 'users']]
+
+@apptest_with(purger=BackgroundPurger(RecordingPurger(), threads=0))
+def test_background_purger_purges_after_the_write():
+    purged = api.db.purger.purger.purged
+    del purged[:]
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+    put_json('/blobs/bob', {'token': token, 'data': {'b': 2}})
+    assert purged == []
+    assert api.db.purger.flush() == 3
+    assert purged == [['user-1', 'name-bob', 'users']]
+
+def test_background_purger_threads_stop_once_it_is_thrown_away():
+    import gc
+    import time
+    import threading
+
+    purger = BackgroundPurger(RecordingPurger(), poll_interval=0.01)
+    purger.purge(['user-1'])
+    deadline = time.time() + 5
+    while not purger.purger.purged and time.time() < deadline:
+        time.sleep(0.01)
+    assert purger.purger.purged == [['user-1']]
+    threads = threading.activeCount()
+    del purger
+    gc.collect()
+    while threading.activeCount() >= threads and time.time() < deadline:
+        time.sleep(0.01)
+    assert threading.activeCount() < threads
+
+def test_routes_are_classified_consistently():
+    # Paths the API doesn't serve are neither limited nor counted as
+    # one of its routes.
+    for path in ['/who/bob', '/feedback/x', '/logout/x', '/metrics/x',
+                 '/nothing/']:
+        assert route_name(path, {}) == 'other'
+        assert route_class(path, 'GET') is None
+    assert route_name('/logout/', {}) == 'logout'
+    assert route_class('/logout/', 'POST') == 'login'
+    assert route_name('/who/', {}) == 'who'
+    assert route_class('/who/', 'GET') == 'read'
+
+@apptest
+def test_get_user_list_pages():
+    post_users('jane', 'bob')
+    resp = app.get('/who/?limit=1')
+    assert resp.json == [{'screen_name': 'bob', 'user_id': 1}]
+    resp = app.get('/who/?limit=1&after=1')
+    assert resp.json == [{'screen_name': 'jane', 'user_id': 2}]
+    resp = app.get('/who/?limit=1&after=2')
+    assert resp.json == []
+
+@apptest
+def test_get_user_list_with_invalid_args():
+    app.get('/who/?limit=0', status=400)
+    app.get('/who/?after=bob', status=400)
+
+@apptest_with(stream_user_list=True)
+def test_get_streamed_user_list():
+    post_users('jane', 'bob')
+    resp = app.get('/who/')
+    assert resp.json == [{'screen_name': 'bob', 'user_id': 1},
+                         {'screen_name': 'jane', 'user_id': 2}]
+    resp = app.get('/who/?after=1')
+    assert resp.json == [{'screen_name': 'jane', 'user_id': 2}]
+
 @apptest
 def test_blobs_query_with_nonexistent_ids():
     resp = app.get('/blobs/?ids=935234', status=200)
@@ -173,6 +504,101 @@ def test_blobs_query_with_good_ids():
     assert resp.json == {'bob': {'hai': 1},
                          'jane': {'there': 2}}
 
+@apptest
+def test_blobs_query_with_ids_in_small_chunks():
+    api.db.lookup_chunk_size = 1
+    post_json('/blobs/bob',
+              {'token': do_login('bob'),
+               'data': {'hai': 1}})
+    post_json('/blobs/jane',
+              {'token': do_login('jane'),
+               'data': {'there': 2}})
+    resp = app.get('/blobs/?ids=1,2,2,439', status=200)
+    assert resp.json == {'bob': {'hai': 1},
+                         'jane': {'there': 2}}
+
+@apptest
+def test_blobs_query_with_no_names():
+    resp = app.get('/blobs/?names=,', status=400)
+
+@apptest
+def test_blobs_query_with_good_names():
+    post_json('/blobs/bob',
+              {'token': do_login('bob'),
+               'data': {'hai': 1}})
+    post_json('/blobs/jane',
+              {'token': do_login('jane'),
+               'data': {'there': 2}})
+    resp = app.get('/blobs/?names=bob,jane,nonexistent', status=200)
+    assert resp.json == {'bob': {'hai': 1},
+                         'jane': {'there': 2}}
+
+@apptest_with(cache_size=10)
+def test_cached_blob_reads():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'foo': 'bar'}})
+    assert app.get('/blobs/bob').json == {'foo': 'bar'}
+    assert app.get('/blobs/?ids=1').json == {'bob': {'foo': 'bar'}}
+    assert app.get('/blobs/?names=bob').json == {'bob': {'foo': 'bar'}}
+    assert api.db.cache.hits == 2
+
+    post_json('/blobs/bob', {'token': token, 'data': {'baz': 'um'}})
+    assert app.get('/blobs/bob').json == {'foo': 'bar', 'baz': 'um'}
+    put_json('/blobs/bob', {'token': token, 'data': {'meh': 1}})
+    assert app.get('/blobs/?ids=1').json == {'bob': {'meh': 1}}
+
+@apptest_with(cache_size=10)
+def test_reads_racing_writes_dont_leave_stale_cache_entries():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+    db = api.db
+
+    # The read happens after the cache is invalidated for the write,
+    # but before the write itself.
+    merge_blob = db.storage.merge_blob
+    def racing_merge_blob(*args, **kwargs):
+        assert db.get_blob('bob') == {'a': 1}
+        return merge_blob(*args, **kwargs)
+    db.storage.merge_blob = racing_merge_blob
+    try:
+        post_json('/blobs/bob', {'token': token, 'data': {'b': 2}})
+    finally:
+        del db.storage.merge_blob
+    assert app.get('/blobs/bob').json == {'a': 1, 'b': 2}
+    assert app.get('/blobs/?ids=1').json == {'bob': {'a': 1, 'b': 2}}
+
+@apptest_with(cache_size=10)
+def test_reads_missing_the_cache_during_writes_dont_cache_old_blobs():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'a': 1}})
+    db = api.db
+
+    # The read misses the cache and reads the blob before the write,
+    # but only caches it afterwards.
+    find_blob = db.storage.find_blob
+    def racing_find_blob(*args, **kwargs):
+        blob = find_blob(*args, **kwargs)
+        del db.storage.find_blob
+        post_json('/blobs/bob', {'token': token, 'data': {'b': 2}})
+        return blob
+    db.storage.find_blob = racing_find_blob
+    assert app.get('/blobs/bob').json == {'a': 1}
+    assert app.get('/blobs/bob').json == {'a': 1, 'b': 2}
+    etag = app.get('/blobs/bob').headers['ETag']
+    assert etag == '"2"'
+    app.get('/blobs/bob', headers={'If-None-Match': '"1"'}, status=200)
+
+@apptest_with(cache_size=1)
+def test_cache_evictions():
+    post_json('/blobs/bob', {'token': do_login('bob'), 'data': {'a': 1}})
+    post_json('/blobs/jane', {'token': do_login('jane'), 'data': {'b': 2}})
+    assert app.get('/blobs/bob').json == {'a': 1}
+    assert app.get('/blobs/jane').json == {'b': 2}
+    assert api.db.cache.evictions == 1
+    assert app.get('/blobs/bob').json == {'a': 1}
+    assert app.get('/blobs/?ids=1,2').json == {'bob': {'a': 1},
+                                               'jane': {'b': 2}}
+
 @apptest
 def test_cross_origin_support():
     resp = app.get('/blobs/', status=400)
@@ -181,6 +607,156 @@ def test_cross_origin_support():
                                                             'PUT,POST')
     assert resp.headers['Access-Control-Allow-Headers'] == 'Content-Type'
 
+@apptest_with(compress_min_size=100, compressed_cache_size=10)
+def test_compressed_blob():
+    blob = {'foo': 'bar' * 100}
+    post_json('/blobs/bob', {'token': do_login('bob'), 'data': blob})
+    for i in range(2):
+        resp = raw_get('/blobs/bob', Accept_Encoding='gzip')
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert resp.headers['Access-Control-Allow-Origin'] == '*'
+        assert resp.headers['Content-Length'] == str(len(resp.body))
+        body = zlib.decompress(resp.body, 16 + zlib.MAX_WBITS)
+        assert json.loads(body) == blob
+    assert api.compressed_cache.hits == 1
+
+    resp = raw_get('/blobs/bob', Accept_Encoding='deflate')
+    assert resp.headers['Content-Encoding'] == 'deflate'
+    assert json.loads(zlib.decompress(resp.body)) == blob
+
+    resp = raw_get('/blobs/bob')
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(resp.body) == blob
+
+@apptest_with(compress_min_size=100)
+def test_compressed_blob_etags():
+    post_json('/blobs/bob', {'token': do_login('bob'),
+                             'data': {'foo': 'bar' * 100}})
+    resp = raw_get('/blobs/bob')
+    assert resp.headers['ETag'] == '"1"'
+    resp = raw_get('/blobs/bob', **{'Accept-Encoding': 'gzip'})
+    assert resp.headers['ETag'] == '"1-gzip"'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+
+    resp = raw_get('/blobs/bob', **{'Accept-Encoding': 'gzip',
+                                    'If-None-Match': '"1-gzip"'})
+    assert resp.status_int == 304
+    assert resp.headers['ETag'] == '"1-gzip"'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    resp = raw_get('/blobs/bob', **{'If-None-Match': '"1"'})
+    assert resp.status_int == 304
+    assert resp.headers['ETag'] == '"1"'
+
+@apptest_with(compress_min_size=100)
+def test_small_responses_are_not_compressed():
+    post_json('/blobs/bob', {'token': do_login('bob'), 'data': {'a': 1}})
+    resp = raw_get('/blobs/bob', Accept_Encoding='gzip')
+    assert 'Content-Encoding' not in resp.headers
+    assert json.loads(resp.body) == {'a': 1}
+
+@apptest_with(compress_min_size=100, stream_user_list=True)
+def test_compressed_streamed_user_list():
+    post_users('bob', 'jane')
+    resp = raw_get('/who/', Accept_Encoding='gzip')
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    body = zlib.decompress(resp.body, 16 + zlib.MAX_WBITS)
+    assert json.loads(body) == [{'screen_name': 'bob', 'user_id': 1},
+                                {'screen_name': 'jane', 'user_id': 2}]
+
+@apptest
+def test_metrics_not_served_by_default():
+    app.get('/metrics/', status=404)
+
+@apptest_with(metrics=True, metrics_token='secret')
+def test_metrics():
+    post_users('bob')
+    app.get('/blobs/bob')
+    app.get('/blobs/nobody', status=404)
+    resp = get_metrics()
+    assert resp.headers['Content-Type'].startswith('text/plain')
+    lines = resp.body.splitlines()
+    assert ('twitblob_requests_total{route="blob",method="GET",'
+            'status="200"} 1') in lines
+    assert ('twitblob_requests_total{route="blob",method="GET",'
+            'status="404"} 1') in lines
+    assert ('twitblob_request_duration_seconds_count{route="blob"} 3'
+            in lines)
+    assert 'twitblob_storage_operations_total{operation="find_blob"} 2' \
+           in lines
+    # With shards, looking up a blob that doesn't exist asks all of
+    # them, and each counts toward the request.
+    assert ('twitblob_request_storage_operations_bucket{route="blob",'
+            'le="1"} %d' % (SHARDS and 1 or 2)) in lines
+
+@apptest_with(metrics=True, metrics_token='secret')
+def test_metrics_need_token():
+    app.get('/metrics/', status=403)
+    resp = app.get('/metrics/', headers={'Authorization': 'Bearer wrong'},
+                   status=403)
+    assert 'Access-Control-Allow-Origin' not in resp.headers
+    assert 'Access-Control-Allow-Origin' not in get_metrics().headers
+
+@apptest_with(metrics=True)
+def test_metrics_not_served_without_token():
+    app.get('/metrics/', status=403)
+
+@apptest_with(metrics=True, metrics_token='secret')
+def test_metrics_count_errors_and_consumed_generators():
+    def broken(environ, start_response):
+        raise ValueError('broken')
+    twitter = api.twitter
+    api.twitter = broken
+    try:
+        app.get('/login/')
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+    api.twitter = twitter
+    post_users('bob')
+    app.get('/who/')
+    lines = get_metrics().body.splitlines()
+    assert ('twitblob_requests_total{route="login",method="GET",'
+            'status="500"} 1') in lines
+    assert 'twitblob_storage_operations_total{operation="iter_users"} 1' \
+           in lines
+    if SHARDS:
+        assert ('twitblob_storage_operations_total'
+                '{operation="shard.iter_users"} %d' % SHARDS) in lines
+
+@apptest_with(metrics=True, metrics_token='secret', stream_user_list=True)
+def test_metrics_count_streamed_responses_closed_unread():
+    post_users('bob')
+    status, headers, app_iter = Request.blank('/who/').call_application(
+        api.wsgi_app
+        )
+    assert status == '200 OK'
+    app_iter.close()
+    assert ('twitblob_requests_total{route="who",method="GET",'
+            'status="200"} 1') in get_metrics().body.splitlines()
+
+@apptest_with(metrics=True, metrics_token='secret',
+              slow_request_threshold=0)
+def test_slow_requests_are_logged():
+    import logging
+
+    records = []
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+    handler = Handler()
+    logger = logging.getLogger('twitblob.metrics')
+    logger.addHandler(handler)
+    try:
+        app.get('/blobs/bob', status=404)
+    finally:
+        logger.removeHandler(handler)
+    assert len(records) == 1
+    assert records[0].startswith('slow request: GET /blobs/bob -> 404 in ')
+    assert api.metrics.slow_requests == 1
+
 @apptest
 def test_post_json_blob_with_invalid_token():
     post_json('/blobs/bob',
@@ -228,6 +804,12 @@ def test_post_json_blob_with_invalid_data():
                'data': 'i am not an object'},
               status=400)
 
+@apptest
+def test_post_json_blob_with_empty_key():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'': 1}}, status=400)
+    put_json('/blobs/bob', {'token': token, 'data': {'': 1}}, status=400)
+
 @apptest
 def test_post_json_blob():
     blob = {'talks': {'0': 0, '1': 5}}
@@ -252,6 +834,85 @@ def test_post_json_blob_twice_updates():
     resp = app.get('/blobs/bob')
     assert resp.json == {'foo': 'bar', 'baz': 'um'}
 
+@apptest
+def test_post_empty_json_blob_creates_blob():
+    post_json('/blobs/bob',
+              {'token': do_login('bob'),
+               'data': {}})
+    resp = app.get('/blobs/bob')
+    assert resp.json == {}
+
+@apptest
+def test_post_json_blob_with_invalid_keys():
+    token = do_login('bob')
+    for name in ['foo.bar', '$set']:
+        post_json('/blobs/bob',
+                  {'token': token,
+                   'data': {name: 1}},
+                  status=400)
+
+@apptest
+def test_conditional_get():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'foo': 'bar'}})
+    resp = app.get('/blobs/bob')
+    etag = resp.headers['ETag']
+    resp = app.get('/blobs/bob', headers={'If-None-Match': etag},
+                   status=304)
+    assert resp.body == ''
+    assert resp.headers['ETag'] == etag
+
+    post_json('/blobs/bob', {'token': token, 'data': {'baz': 'um'}})
+    resp = app.get('/blobs/bob', headers={'If-None-Match': etag})
+    assert resp.json == {'foo': 'bar', 'baz': 'um'}
+    assert resp.headers['ETag'] != etag
+
+    put_json('/blobs/bob', {'token': token, 'data': {}})
+    resp = app.get('/blobs/bob', headers={'If-None-Match': etag})
+    assert resp.headers['ETag'] != etag
+
+@apptest_with(cache_size=10)
+def test_cached_conditional_get():
+    put_json('/blobs/bob', {'token': do_login('bob'), 'data': {'a': 1}})
+    etag = app.get('/blobs/bob').headers['ETag']
+    app.get('/blobs/bob', headers={'If-None-Match': etag}, status=304)
+    assert api.db.cache.misses == 0
+
+@apptest
+def test_conditional_get_of_nonexistent_blob():
+    app.get('/blobs/bob', headers={'If-None-Match': '*'}, status=404)
+
+@apptest_with(store_json=True)
+def test_stored_json():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {'foo': 'bar'}})
+    post_json('/blobs/bob', {'token': token, 'data': {'baz': 'um'}})
+    assert json.loads(storage.find_blob('bob')['json']) == {'foo': 'bar',
+                                                            'baz': 'um'}
+    resp = app.get('/blobs/bob')
+    assert resp.json == {'foo': 'bar', 'baz': 'um'}
+    assert resp.headers['Content-Length'] == str(len(resp.body))
+
+    put_json('/blobs/bob', {'token': token, 'data': {'meh': 1}})
+    assert app.get('/blobs/bob').json == {'meh': 1}
+    assert app.get('/blobs/?ids=1').json == {'bob': {'meh': 1}}
+
+@apptest_with(store_json=True, cache_size=10)
+def test_cached_stored_json():
+    post_json('/blobs/bob', {'token': do_login('bob'), 'data': {'a': 1}})
+    assert app.get('/blobs/bob').json == {'a': 1}
+    assert app.get('/blobs/?names=bob').json == {'bob': {'a': 1}}
+
+@apptest_with(store_json=True)
+def test_backfill_json():
+    api.db.store_json = False
+    post_json('/blobs/bob', {'token': do_login('bob'), 'data': {'a': 1}})
+    api.db.store_json = True
+    assert app.get('/blobs/bob').json == {'a': 1}
+    assert api.db.backfill_json() == 1
+    assert api.db.backfill_json() == 0
+    assert json.loads(storage.find_blob('bob')['json']) == {'a': 1}
+
 @apptest
 def test_post_json_blob_then_put():
     token = do_login('bob')
@@ -276,6 +937,14 @@ def test_expired_token():
                'data': {}},
               status=403)
 
+@apptest
+def test_expired_tokens_are_swept():
+    token = do_login('bob')
+    TimeMachine.travel(api.db.token_lifetime + datetime.timedelta(hours=1))
+    do_login('jane')
+    if api.db.sweeper is not None:
+        assert storage.find_token(token) is None
+
 @apptest
 def test_forged_token():
     post_json('/blobs/bob',
@@ -283,6 +952,85 @@ def test_forged_token():
                'data': {}},
               status=403)
 
+@apptest
+def test_logout():
+    token = do_login('bob')
+    post_json('/logout/', {'token': token})
+    post_json('/blobs/bob',
+              {'token': token,
+               'data': {}},
+              status=403)
+
+@apptest
+def test_logout_with_invalid_token():
+    post_json('/logout/', {'token': 'bad token'}, status=403)
+
+@apptest_with(token_secret='sekrit')
+def test_signed_token():
+    token = do_login('bob')
+    assert storage.find_token(token) is None
+    post_json('/blobs/bob',
+              {'token': token,
+               'data': {'foo': 'bar'}})
+    assert app.get('/blobs/bob').json == {'foo': 'bar'}
+    post_json('/blobs/jane',
+              {'token': token,
+               'data': {}},
+              status=403)
+
+@apptest_with(token_secret='sekrit')
+def test_expired_signed_token():
+    token = do_login('bob')
+    TimeMachine.travel(api.db.token_lifetime)
+    post_json('/blobs/bob',
+              {'token': token,
+               'data': {}},
+              status=403)
+
+@apptest_with(token_secret='sekrit')
+def test_forged_signed_token():
+    token = do_login('bob')
+    payload, signature = token.split('.')
+    post_json('/blobs/bob',
+              {'token': payload + '.' + signature[::-1],
+               'data': {}},
+              status=403)
+
+@apptest_with(token_secret='sekrit')
+def test_logout_signed_token_without_revocation():
+    post_json('/logout/', {'token': do_login('bob')}, status=501)
+
+@apptest_with(token_secret='sekrit', token_revocation=True)
+def test_logout_signed_token():
+    token = do_login('bob')
+    other_token = do_login('bob')
+    post_json('/logout/', {'token': token})
+    post_json('/blobs/bob',
+              {'token': token,
+               'data': {}},
+              status=403)
+    post_json('/blobs/bob',
+              {'token': other_token,
+               'data': {}})
+    assert len(list(storage.find_revocations(TimeMachine.now))) == 1
+
+@apptest_with(token_secret='sekrit', token_revocation=True)
+def test_logout_while_revocations_are_refreshed():
+    token = do_login('bob')
+    post_json('/blobs/bob', {'token': token, 'data': {}})
+    TimeMachine.travel(api.db.revoked.refresh_interval)
+
+    # The token is revoked after the refresh has read the revocations.
+    find_revocations = storage.find_revocations
+    def racing_find_revocations(now):
+        revocations = list(find_revocations(now))
+        storage.find_revocations = find_revocations
+        post_json('/logout/', {'token': token})
+        return revocations
+    storage.find_revocations = racing_find_revocations
+
+    post_json('/blobs/bob', {'token': token, 'data': {}}, status=403)
+
 @apptest
 def test_options():
     result = {'done': False}
@@ -304,6 +1052,34 @@ def test_options():
 
     assert result['done']
 
+@apptest_with(stream_user_list=True,
+              concurrency_limits={'read': {'limit': 1},
+                                  'write': {'limit': 1}})
+def test_concurrency_limits():
+    token = do_login('bob')
+    put_json('/blobs/bob', {'token': token, 'data': {}})
+
+    # Streamed responses hold on to their slot until they're closed.
+    status, headers, app_iter = Request.blank('/who/').call_application(
+        api.wsgi_app
+        )
+    assert status == '200 OK'
+    resp = app.get('/blobs/bob', status=503)
+    assert resp.headers['Retry-After'] == '1'
+    assert resp.json == {'error': 'too busy, try again later'}
+    put_json('/blobs/bob', {'token': token, 'data': {}})
+    app_iter.close()
+
+    app.get('/blobs/bob')
+    assert api.admission.limiters['read'].rejected == 1
+
+@apptest_with(metrics=True, metrics_token='secret',
+              concurrency_limits={'login': {'limit': 2}})
+def test_admission_metrics():
+    body = get_metrics().body
+    assert 'twitblob_admission_active{class="login"} 0\n' in body
+    assert 'twitblob_admission_rejected_total{class="login"} 0\n' in body
+
 @apptest
 def test_feedback_with_no_impl():
     post_json('/feedback/',
@@ -311,18 +1087,72 @@ def test_feedback_with_no_impl():
                'message': 'o hai'},
               status=501)
 
-@apptest
+@apptest_with(feedback_workers=0)
 def test_feedback_with_impl():
+    sent = []
     def fake_send_feedback(sender, message):
-        return {'sender': sender, 'message': message}
+        sent.append({'sender': sender, 'message': message})
 
     api.send_feedback = fake_send_feedback
 
     resp = post_json('/feedback/',
                      {'token': do_login('bob'),
-                      'message': 'o hai'})
+                      'message': 'o hai'},
+                     status=202)
+
+    assert resp.json['queued']
+    assert sent == []
+    assert api.feedback.drain() == 1
+    assert sent == [{'sender': 'bob',
+                     'message': 'o hai'}]
+    assert api.feedback.drain() == 0
+
+@apptest_with(feedback_workers=0, feedback_max_attempts=2,
+              feedback_retry_delay=10)
+def test_failed_feedback_is_retried_then_dead_lettered():
+    def fake_send_feedback(sender, message):
+        raise IOError('mail server is down')
+
+    api.send_feedback = fake_send_feedback
+    post_json('/feedback/', {'token': do_login('bob'), 'message': 'o hai'},
+              status=202)
+
+    assert api.feedback.drain() == 1
+    assert api.feedback.drain() == 0
+    TimeMachine.travel(seconds=10)
+    assert api.feedback.drain() == 1
+    TimeMachine.travel(seconds=20)
+    assert api.feedback.drain() == 0
+
+    stats = api.feedback.stats()
+    assert (stats['queued'], stats['dead']) == (0, 1)
+    assert (stats['retried'], stats['dead_lettered']) == (1, 1)
+
+@apptest_with(feedback_workers=1)
+def test_feedback_is_delivered_in_the_background():
+    import threading
+
+    sent = threading.Event()
+    api.send_feedback = lambda sender, message: sent.set()
+    post_json('/feedback/', {'token': do_login('bob'), 'message': 'o hai'},
+              status=202)
+    sent.wait(5)
+    assert sent.isSet()
 
-    assert resp.json == {'sender': 'bob',
-                         'message': 'o hai'}
+@apptest_with(metrics=True, metrics_token='secret', feedback_workers=0)
+def test_feedback_metrics():
+    api.send_feedback = lambda sender, message: None
+    post_json('/feedback/', {'token': do_login('bob'), 'message': 'o hai'},
+              status=202)
+    TimeMachine.travel(seconds=3)
+    assert 'twitblob_feedback_queued 1\n' in get_metrics().body
+    assert ('twitblob_feedback_oldest_age_seconds 3.0\n' in
+            get_metrics().body)
+    api.feedback.drain()
+    body = get_metrics().body
+    assert 'twitblob_feedback_queued 0\n' in body
+    assert ('twitblob_feedback_deliveries_total{outcome="delivered"} 1\n'
+            in body)
+    assert 'twitblob_feedback_latency_seconds_sum 3.0\n' in body
 
 # TODO: Need tests for edge cases for feedback.
@@ -0,0 +1,293 @@
+import datetime
+import os
+
+from twitblob.easy import make_storage
+from twitblob.storage import DuplicateToken, MemoryBackend
+from twitblob.sharded_storage import ShardedBackend, rebalance
+
+DBNAME = 'twitblob_test_database'
+
+def backends():
+    yield make_storage('memory', None, None)
+    yield make_storage('sqlite', None, ':memory:')
+    yield make_storage('memory', None, None, shards=['a', 'b', 'c'])
+    yield make_storage('sqlite', None, None, shards=[':memory:'] * 3)
+    if os.environ.get('TWITBLOB_TEST_BACKEND', 'mongo') == 'mongo':
+        import pymongo
+
+        conn = pymongo.Connection()
+        db = conn[DBNAME]
+        for coll in [name for name in db.collection_names()
+                     if not name.startswith('system.')]:
+            db[coll].remove()
+        yield make_storage('mongo', conn, DBNAME)
+
+def storagetest(func):
+    def wrapper():
+        for backend in backends():
+            yield func, backend
+
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+@storagetest
+def test_nonexistent_blob(b):
+    assert b.find_blob('bob') is None
+    assert b.find_blob_version('bob') is None
+    assert list(b.find_blobs('user_id', [1])) == []
+
+@storagetest
+def test_merge_and_replace_blob(b):
+    assert b.merge_blob(1, 'bob', {'a': 1}) == {'version': 1}
+    assert b.merge_blob(1, 'bob', {'b': 2}, fetch_data=True) == {
+        'version': 2,
+        'data': {'a': 1, 'b': 2}
+        }
+    assert b.replace_blob(1, 'bob', {'c': 3}) == 3
+    assert b.find_blob('bob') == {'screen_name': 'bob', 'user_id': 1,
+                                  'data': {'c': 3}, 'version': 3}
+
+@storagetest
+def test_replace_blob_if_version(b):
+    assert b.replace_blob(1, 'bob', {'a': 1}, if_version=1) is None
+    assert b.replace_blob(1, 'bob', {'a': 1}, if_version=0) == 1
+    assert b.replace_blob(1, 'bob', {'a': 2}, if_version=0) is None
+    assert b.replace_blob(1, 'bob', {'a': 2}, if_version=2) is None
+    assert b.replace_blob(1, 'bob', {'a': 2}, if_version=1) == 2
+    assert b.find_blob('bob')['data'] == {'a': 2}
+
+@storagetest
+def test_renamed_user(b):
+    b.replace_blob(1, 'bob', {})
+    b.replace_blob(1, 'robert', {})
+    assert b.find_blob('bob') is None
+    assert b.find_blob('robert')['user_id'] == 1
+
+@storagetest
+def test_name_taken_by_another_user(b):
+    # Twitter lets a name be taken as soon as it's given up, so another
+    # user can be seen with it before the first is seen renamed.
+    b.replace_blob(1, 'bob', {})
+    b.replace_blob(2, 'bob', {})
+    b.replace_blob(1, 'robert', {})
+    assert b.find_blob('bob')['user_id'] == 2
+    b.replace_blob(3, 'robert', {})
+    b.remove_blob(1)
+    assert b.find_blob('robert')['user_id'] == 3
+
+@storagetest
+def test_stored_json(b):
+    b.replace_blob(1, 'bob', {'a': 1}, json='{"a": 1}')
+    assert b.find_blob('bob', without_data=True) == {
+        'screen_name': 'bob', 'user_id': 1, 'json': '{"a": 1}', 'version': 1
+        }
+    assert list(b.iter_blobs_without_json()) == []
+
+    b.merge_blob(1, 'bob', {'b': 2})
+    assert 'json' not in b.find_blob('bob')
+    assert [blob['version'] for blob in b.iter_blobs_without_json()] == [2]
+
+    b.set_blob_json(1, 1, 'stale')
+    assert 'json' not in b.find_blob('bob')
+    b.set_blob_json(1, 2, '{"a": 1, "b": 2}')
+    assert b.find_blob('bob')['json'] == '{"a": 1, "b": 2}'
+
+@storagetest
+def test_find_blobs(b):
+    b.replace_blob(1, 'bob', {'a': 1})
+    b.replace_blob(2, 'jane', {'b': 2}, json='{"b": 2}')
+    blobs = sorted(b.find_blobs('user_id', [1, 2, 3]),
+                   key=lambda blob: blob['user_id'])
+    assert blobs == [
+        {'screen_name': 'bob', 'user_id': 1, 'data': {'a': 1}, 'version': 1},
+        {'screen_name': 'jane', 'user_id': 2, 'data': {'b': 2}, 'version': 1}
+        ]
+    blobs = list(b.find_blobs('screen_name', ['jane']))
+    assert [blob['user_id'] for blob in blobs] == [2]
+
+@storagetest
+def test_iter_users(b):
+    for user_id in [3, 1, 2]:
+        b.replace_blob(user_id, 'user%d' % user_id, {})
+    assert [user['user_id'] for user in b.iter_users()] == [1, 2, 3]
+    assert list(b.iter_users(after=1, limit=1)) == [
+        {'screen_name': 'user2', 'user_id': 2}
+        ]
+
+@storagetest
+def test_iter_and_restore_blobs(b):
+    for user_id in [3, 1, 2]:
+        b.replace_blob(user_id, 'user%d' % user_id, {'id': user_id})
+    b.set_blob_json(2, 1, '{"id": 2}')
+    blobs = list(b.iter_blobs(after=1, limit=1))
+    assert blobs == [{'screen_name': 'user2', 'user_id': 2,
+                      'data': {'id': 2}, 'json': '{"id": 2}', 'version': 1}]
+    b.remove_blob(2)
+    assert b.find_blob('user2') is None
+    b.restore_blob(dict(blobs[0], version=5))
+    assert b.find_blob('user2')['version'] == 5
+    assert [blob['user_id'] for blob in b.iter_blobs()] == [1, 2, 3]
+    assert [blob['user_id'] for blob in b.iter_blobs(until=2)] == [1, 2]
+    assert b.user_id_range() == (1, 3)
+
+@storagetest
+def test_restore_blobs(b):
+    assert b.user_id_range() is None
+    b.replace_blob(1, 'bob', {'a': 1})
+    b.restore_blobs([{'screen_name': 'bob', 'user_id': 1, 'data': {'b': 2},
+                      'version': 7},
+                     {'screen_name': 'jane', 'user_id': 2, 'data': {},
+                      'json': '{}', 'version': 3}])
+    assert b.find_blob('bob') == {'screen_name': 'bob', 'user_id': 1,
+                                  'data': {'b': 2}, 'version': 7}
+    assert b.find_blob('jane')['json'] == '{}'
+    b.restore_blobs([])
+
+@storagetest
+def test_tokens(b):
+    date = datetime.datetime(2010, 6, 17, 0, 32, 33)
+    b.insert_token({'id': 'a', 'screen_name': 'bob', 'user_id': 1,
+                    'date': date})
+    assert b.find_token('a') == {'id': 'a', 'screen_name': 'bob',
+                                 'user_id': 1, 'date': date}
+    assert [token['id'] for token in b.iter_tokens()] == ['a']
+    b.remove_token('a')
+    assert b.find_token('a') is None
+
+@storagetest
+def test_duplicate_token(b):
+    date = datetime.datetime(2010, 6, 17, 0, 32, 33)
+    token = {'id': 'a', 'screen_name': 'bob', 'user_id': 1, 'date': date}
+    b.insert_token(token)
+    try:
+        b.insert_token(dict(token, screen_name='jane'))
+    except DuplicateToken:
+        pass
+    else:
+        raise AssertionError('DuplicateToken not raised')
+    assert b.find_token('a')['screen_name'] == 'bob'
+
+@storagetest
+def test_remove_expired_tokens(b):
+    date = datetime.datetime(2010, 6, 17, 0, 32, 33)
+    day = datetime.timedelta(days=1)
+    for token_id, token_date in [('old', date - day), ('new', date)]:
+        b.insert_token({'id': token_id, 'screen_name': 'bob', 'user_id': 1,
+                        'date': token_date})
+    b.insert_revocation('old', date - day)
+    b.insert_revocation('new', date + day)
+    b.request_tokens['a'] = {'oauth_token': 'a'}
+    now = datetime.datetime.utcnow()
+    assert b.remove_expired_tokens(date, now - day, date) == 2
+    assert b.find_token('old') is None
+    assert b.find_token('new') is not None
+    assert 'a' in b.request_tokens
+    assert b.remove_expired_tokens(date, now + day, date) == 1
+    assert 'a' not in b.request_tokens
+
+@storagetest
+def test_revocations(b):
+    date = datetime.datetime(2010, 6, 17, 0, 32, 33)
+    b.insert_revocation('a', date)
+    b.insert_revocation('b', date + datetime.timedelta(days=1))
+    assert list(b.find_revocations(date)) == [
+        ('b', date + datetime.timedelta(days=1))
+        ]
+
+@storagetest
+def test_request_tokens(b):
+    assert 'a' not in b.request_tokens
+    b.request_tokens['a'] = {'oauth_token': 'a'}
+    assert 'a' in b.request_tokens
+    assert b.request_tokens['a'] == {'oauth_token': 'a'}
+    del b.request_tokens['a']
+    assert 'a' not in b.request_tokens
+
+@storagetest
+def test_pop_request_token(b):
+    b.request_tokens['a'] = {'oauth_token': 'a'}
+    assert b.request_tokens.pop('a') == {'oauth_token': 'a'}
+    assert 'a' not in b.request_tokens
+    assert b.request_tokens.pop('a', None) is None
+    try:
+        b.request_tokens.pop('a')
+    except KeyError:
+        pass
+    else:
+        raise AssertionError('KeyError not raised')
+
+@storagetest
+def test_feedback_queue(b):
+    now = datetime.datetime(2010, 6, 17)
+    lease = datetime.timedelta(minutes=5)
+    first = b.enqueue_feedback('bob', 'o hai', now)
+    second = b.enqueue_feedback('jane', 'hi', now)
+    assert [(item['sender'], item['message'], item['enqueued'],
+             item['attempts']) for item in b.claim_feedback(now, now + lease,
+                                                            1)] == [
+        ('bob', 'o hai', now, 1)
+        ]
+    assert [item['id'] for item in b.claim_feedback(now, now + lease,
+                                                    10)] == [second]
+    assert b.claim_feedback(now, now + lease, 10) == []
+    assert b.feedback_stats() == {'queued': 2, 'dead': 0, 'oldest': now}
+
+    b.finish_feedback(second)
+    b.retry_feedback(first, now + lease, 'ValueError: oops')
+    assert b.claim_feedback(now, now + lease, 10) == []
+    later = now + lease
+    assert [item['attempts'] for item in b.claim_feedback(later, later + lease,
+                                                          10)] == [2]
+
+    b.dead_letter_feedback(first, 'ValueError: oops')
+    assert b.claim_feedback(later + lease, later + lease, 10) == []
+    assert b.feedback_stats() == {'queued': 0, 'dead': 1, 'oldest': None}
+    assert b.requeue_dead_feedback(later) == 1
+    assert [(item['id'], item['attempts']) for item in b.claim_feedback(
+        later, later + lease, 10
+        )] == [(first, 1)]
+
+def test_sharding_spreads_blobs_and_tokens():
+    shards = [MemoryBackend() for i in range(4)]
+    b = ShardedBackend(shards)
+    date = datetime.datetime(2010, 6, 17, 0, 32, 33)
+    for user_id in range(1, 101):
+        b.replace_blob(user_id, 'user%d' % user_id, {})
+        b.insert_token({'id': 'token%d' % user_id, 'user_id': user_id,
+                        'screen_name': 'user%d' % user_id, 'date': date})
+    for shard in shards:
+        assert 10 < len(shard.blobs) < 40
+        assert 10 < len(shard.auth_tokens) < 40
+        for user_id in shard.blobs:
+            assert b.shard_for(user_id) is shard
+    blobs = b.find_blobs('user_id', range(1, 101))
+    assert sorted(blob['user_id'] for blob in blobs) == range(1, 101)
+    blobs = b.find_blobs('screen_name', ['user5', 'user50', 'nobody'])
+    assert sorted(blob['user_id'] for blob in blobs) == [5, 50]
+
+def test_rebalance():
+    shards = [MemoryBackend() for i in range(4)]
+    b = ShardedBackend(shards)
+    date = datetime.datetime(2010, 6, 17, 0, 32, 33)
+    for user_id in range(1, 101):
+        b.merge_blob(user_id, 'user%d' % user_id, {'a': user_id})
+        b.insert_token({'id': 'token%d' % user_id, 'user_id': user_id,
+                        'screen_name': 'user%d' % user_id, 'date': date})
+
+    # Growing the number of shards only moves data to the new ones.
+    grown = ShardedBackend(shards + [MemoryBackend()])
+    moved = rebalance(grown)
+    assert 0 < moved < 100
+    assert moved == (len(grown.shards[4].blobs) +
+                     len(grown.shards[4].auth_tokens))
+
+    # Retired shards are emptied.
+    shrunk = ShardedBackend(shards[:2], retired=grown.shards[2:])
+    rebalance(shrunk)
+    for shard in grown.shards[2:]:
+        assert not shard.blobs and not shard.auth_tokens
+    for user_id in range(1, 101):
+        blob = shrunk.find_blobs('user_id', [user_id])[0]
+        assert blob['data'] == {'a': user_id}
+        assert shrunk.find_token('token%d' % user_id)['user_id'] == user_id
+    assert rebalance(shrunk) == 0
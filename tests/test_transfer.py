@@ -0,0 +1,117 @@
+import os
+import gzip
+import shutil
+import datetime
+import tempfile
+
+from twitblob.easy import make_storage
+from twitblob.storage import MemoryBackend
+from twitblob import transfer
+
+def make_source(users=20):
+    source = make_storage('sqlite', None, None, shards=[':memory:'] * 2)
+    for user_id in range(1, users + 1):
+        source.replace_blob(user_id, 'user%d' % user_id, {'id': user_id})
+    source.set_blob_json(3, 1, '{"id": 3}')
+    return source
+
+def transfertest(func):
+    def wrapper():
+        directory = tempfile.mkdtemp()
+        try:
+            func(directory)
+        finally:
+            shutil.rmtree(directory)
+
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+@transfertest
+def test_export_and_import(directory):
+    source = make_source()
+    assert transfer.export(source, directory, workers=3,
+                           batch_size=4) == (20, 0)
+    assert len(os.listdir(directory)) == 4
+
+    dest = MemoryBackend()
+    assert transfer.import_(dest, directory, workers=3,
+                            batch_size=4) == (20, 0)
+    assert list(dest.iter_blobs()) == list(source.iter_blobs())
+    assert dest.find_blob('user3', without_data=True)['json'] == '{"id": 3}'
+
+@transfertest
+def test_export_live_tokens(directory):
+    now = datetime.datetime(2010, 6, 17)
+    source = make_source(0)
+    for token_id, age in [('new', 1), ('old', 20)]:
+        source.insert_token({'id': token_id, 'screen_name': 'bob',
+                             'user_id': 1,
+                             'date': now - datetime.timedelta(days=age)})
+    assert transfer.export(source, directory,
+                           token_lifetime=datetime.timedelta(days=14),
+                           utcnow=lambda: now) == (0, 1)
+
+    dest = MemoryBackend()
+    assert transfer.import_(dest, directory) == (0, 1)
+    assert dest.find_token('new')['date'] == now - datetime.timedelta(days=1)
+    assert dest.find_token('old') is None
+
+@transfertest
+def test_interrupted_export_resumes(directory):
+    source = make_source()
+    iter_blobs = source.iter_blobs
+    calls = []
+    def failing_iter_blobs(after=None, limit=None, until=None):
+        calls.append(after)
+        if len(calls) == 3:
+            raise IOError('connection lost')
+        return iter_blobs(after, limit, until)
+    source.iter_blobs = failing_iter_blobs
+    try:
+        transfer.export(source, directory, workers=1, batch_size=4)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('export should have failed')
+
+    # The part of the batch being written when the export failed
+    # would be left over, were the file not cut back.
+    path = os.path.join(directory, transfer.BLOBS_FILE % 0)
+    f = open(path, 'ab')
+    f.write('garbage')
+    f.close()
+
+    assert transfer.export(source, directory, workers=1,
+                           batch_size=4) == (20, 0)
+    lines = gzip.GzipFile(path).read().splitlines()
+    assert len(lines) == 20
+    assert calls[:4] == [None, 4, 8, 8]
+
+@transfertest
+def test_interrupted_import_resumes(directory):
+    source = make_source()
+    transfer.export(source, directory, workers=1, batch_size=4)
+
+    dest = MemoryBackend()
+    restore_blobs = dest.restore_blobs
+    restored = []
+    failing = [True]
+    def failing_restore_blobs(blobs):
+        if failing[0] and len(restored) == 2:
+            raise IOError('connection lost')
+        restored.append([blob['user_id'] for blob in blobs])
+        restore_blobs(blobs)
+    dest.restore_blobs = failing_restore_blobs
+    try:
+        transfer.import_(dest, directory, workers=1, batch_size=4)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('import should have failed')
+
+    del restored[:]
+    failing[0] = False
+    assert transfer.import_(dest, directory, workers=1,
+                            batch_size=4) == (20, 0)
+    assert restored[0] == [9, 10, 11, 12]
+    assert len(list(dest.iter_blobs())) == 20
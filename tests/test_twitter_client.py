@@ -1,91 +1,295 @@
-import minimock
+import time
+import threading
+import urllib
+import httplib
+import SocketServer
+from urlparse import urlparse
+
+import oauth2 as oauth
+from webtest import TestApp
 
 from twitblob.twitter_client import TwitterOauthClientApp
+from tests.fake_oauth import FakeOAuthProvider
+from twitblob.http_client import ConnectionPool, ConnectFailed
+from twitblob.async_http import AsyncHttpClient
+from twitblob.workers import listen, make_server
+
+provider = None
+server = None
+base_url = None
+
+def setup():
+    global provider, server, base_url
+
+    provider = FakeOAuthProvider('key', 'secret')
+    server = make_server(listen('127.0.0.1', 0), provider, threads=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    base_url = 'http://127.0.0.1:%d/oauth/' % server.server_port
+
+def teardown():
+    server.shutdown()
+    server.drain()
+    server.server_close()
 
-class Mock(minimock.Mock):
-    def __repr__(self):
-        return "<Mock %s>" % self.mock_name
+def onsuccess(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    token = environ['oauth.access_token']
+    return ['%s:%s' % (token['screen_name'], token['user_id'])]
 
-def app(request_tokens=None):
+class FakeOAuthModule(object):
+    # The oauth2 module, with requests signed by the given function.
+
+    def __init__(self, sign_request):
+        self.Request = type('Request', (oauth.Request,),
+                            {'sign_request': sign_request})
+
+    def __getattr__(self, name):
+        return getattr(oauth, name)
+
+def client(request_tokens=None, **kwargs):
     if request_tokens is None:
         request_tokens = {}
-    consumer = 'mock consumer'
-    oauth = Mock('oauth')
-    onsuccess = Mock('onsuccess')
-    toc = TwitterOauthClientApp(consumer, oauth,
-                                request_tokens, onsuccess)
-    return (consumer, oauth, onsuccess, toc)
+    del provider.failures[:]
+    provider.delay = 0
+    kwargs.setdefault('sleep', lambda seconds: None)
+    toc = TwitterOauthClientApp(oauth.Consumer('key', 'secret'), oauth,
+                                request_tokens, onsuccess,
+                                base_url=base_url, **kwargs)
+    return toc, TestApp(toc)
+
+def authorize(location, screen_name):
+    # Plays the part of the user's browser at Twitter.
+    parts = urlparse(location)
+    conn = httplib.HTTPConnection(parts.hostname, parts.port)
+    conn.request('GET', '%s?%s&%s' % (parts.path, parts.query,
+                                      urllib.urlencode({
+                                          'screen_name': screen_name
+                                          })))
+    resp = conn.getresponse()
+    assert resp.status == 302
+    callback = urlparse(resp.getheader('Location'))
+    conn.close()
+    assert callback.path == '/callback'
+    return callback.query
 
 def test_404():
-    """
-    >>> _, _, _, toc = app()
-    >>> environ = dict(PATH_INFO='/blah', QUERY_STRING='')
-    >>> toc(environ, Mock('start_response'))
-    Called start_response('404 Not Found', [('Content-Type', 'text/plain')])
-    ['path not found: /blah']
-    """
-
-    pass
-
-def test_request_redirect():
-    """
-    >>> consumer, oauth, _, toc = app()
-    >>> client = Mock('client')
-    >>> client.request.mock_returns = (
-    ...   {'status': '200'},
-    ...   'oauth_token=token&oauth_token_secret=secret&'
-    ...   'oauth_callback_confirmed=true'
-    ... )
-    >>> oauth.Client.mock_returns = client
-    >>> environ = dict(PATH_INFO='/', QUERY_STRING='', SERVER_NAME='foo.com', SERVER_PORT='80')
-    >>> environ['wsgi.url_scheme'] = 'http'
-    >>> toc(environ, Mock('start_response'))
-    Called oauth.Client('mock consumer')
-    Called client.request(
-        'https://api.twitter.com/oauth/request_token?oauth_callback=http%3A%2F%2Ffoo.com%2Fcallback',
-        'GET')
-    Called start_response(
-        '302 Found',
-        [('Location', 'https://api.twitter.com/oauth/authorize?oauth_token=token')])
-    []
-    """
-
-    pass
-
-def test_callback():
-    """
-    >>> storage = {'token': {'oauth_token': 'token', 'oauth_token_secret': 'secret'}}
-    >>> consumer, oauth, onsuccess, toc = app(storage)
-    >>> client = Mock('client')
-    >>> client.request.mock_returns = (
-    ...   {'status': '200'},
-    ...   'oauth_token=token&oauth_token_secret=secret&'
-    ...   'user_id=userid&screen_name=bob'
-    ... )
-    >>> oauth.Client.mock_returns = client
-    >>> token = Mock('token')
-    >>> oauth.Token.mock_returns = token
-    >>> environ = dict(
-    ...   PATH_INFO='/callback',
-    ...   QUERY_STRING='oauth_token=token&oauth_verifier=verifier',
-    ...   SERVER_NAME='foo.com', SERVER_PORT='80'
-    ... )
-    >>> environ['wsgi.url_scheme'] = 'http'
-    >>> onsuccess.mock_returns = ['success']
-    >>> toc(environ, Mock('start_response'))
-    Called oauth.Token('token', 'secret')
-    Called token.set_verifier('verifier')
-    Called oauth.Client('mock consumer', <Mock token>)
-    Called client.request('https://api.twitter.com/oauth/access_token', 'POST')
-    Called onsuccess(
-        {'SERVER_NAME': 'foo.com', 'wsgi.url_scheme': 'http', 'PATH_INFO': '/callback', 'SERVER_PORT': '80', 'oauth.access_token': {'oauth_token_secret': 'secret', 'user_id': 'userid', 'oauth_token': 'token', 'screen_name': 'bob'}, 'QUERY_STRING': 'oauth_token=token&oauth_verifier=verifier'},
-        <Mock start_response>)
-    ['success']
-    """
-
-    pass
-
-if __name__ == '__main__':
-    import doctest
-    doctest.testmod()
-    print "done running tests."
+    toc, app = client()
+    resp = app.get('/blah', status=404)
+    assert resp.body == 'path not found: /blah'
+
+def test_login():
+    request_tokens = {}
+    toc, app = client(request_tokens)
+    resp = app.get('/', status=302)
+    assert resp.headers['Location'].startswith(base_url + 'authorize?')
+    assert len(request_tokens) == 1
+    query = authorize(resp.headers['Location'], 'bob')
+    resp = app.get('/callback?%s' % query)
+    assert resp.body == 'bob:1'
+    assert request_tokens == {}
+
+    # The request token can't be redeemed again.
+    resp = app.get('/callback?%s' % query, status=400)
+    assert resp.body.startswith('invalid token: ')
+
+def test_connections_are_reused():
+    toc, app = client()
+    for i in range(3):
+        app.get('/', status=302)
+    assert len(toc.http.idle.values()[0]) == 1
+
+def test_callback_with_missing_args():
+    toc, app = client()
+    app.get('/callback?oauth_token=foo', status=400)
+
+def test_retries():
+    sleeps = []
+    toc, app = client(sleep=sleeps.append, backoff=1)
+    provider.failures.extend(['503 Service Unavailable'] * 2)
+    app.get('/', status=302)
+    assert sleeps == [1, 2]
+
+def test_reused_nonces_are_rejected():
+    toc, app = client(retries=1)
+    sign = toc.oauth.Request.sign_request
+    def sign_with_same_nonce(req, *args):
+        req['oauth_nonce'] = 'same'
+        req['oauth_timestamp'] = '1'
+        sign(req, *args)
+    toc.oauth = FakeOAuthModule(sign_with_same_nonce)
+    provider.failures.append('503 Service Unavailable')
+    resp = app.get('/', status=502)
+    assert resp.body.endswith('returned status 401')
+
+def test_access_token_is_not_retried_after_errors():
+    toc, app = client()
+    resp = app.get('/', status=302)
+    query = authorize(resp.headers['Location'], 'bob')
+    provider.failures.append('503 Service Unavailable')
+    resp = app.get('/callback?%s' % query, status=502)
+    assert resp.body.endswith('returned status 503')
+
+def test_access_token_is_retried_after_connect_failures():
+    toc, app = client()
+    resp = app.get('/', status=302)
+    query = authorize(resp.headers['Location'], 'bob')
+    def unreachable_once(*args):
+        del toc.http.request
+        raise ConnectFailed(IOError('connection refused'))
+    toc.http.request = unreachable_once
+    resp = app.get('/callback?%s' % query)
+    assert resp.body == 'bob:1'
+
+def test_too_many_failures():
+    toc, app = client(retries=1)
+    provider.failures.extend(['503 Service Unavailable'] * 2)
+    resp = app.get('/', status=502)
+    assert resp.body.endswith('returned status 503')
+
+def test_client_errors_are_not_retried():
+    toc, app = client()
+    provider.failures.append('401 Unauthorized')
+    app.get('/', status=502)
+    assert provider.failures == []
+
+def test_bad_signature():
+    toc, app = client()
+    toc.consumer = oauth.Consumer('key', 'wrong secret')
+    app.get('/', status=502)
+
+def test_timeout():
+    toc, app = client(retries=0, http=ConnectionPool(read_timeout=0.05))
+    provider.delay = 0.5
+    resp = app.get('/', status=504)
+    assert resp.body.endswith('timed out')
+
+def test_unreachable():
+    sock = listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    sock.close()
+    toc, app = client(retries=0)
+    toc.request_token_url = 'http://127.0.0.1:%d/oauth/request_token' % port
+    app.get('/', status=502)
+
+class DroppingHandler(SocketServer.StreamRequestHandler):
+    # Answers the first request on each connection, keeping it alive,
+    # then drops the connection when the next request arrives, as a
+    # server does with one it has let go idle.
+
+    def handle(self):
+        answered = False
+        while True:
+            request_line = self.rfile.readline()
+            if not request_line:
+                return
+            length = 0
+            for line in iter(self.rfile.readline, '\r\n'):
+                name, value = line.split(':', 1)
+                if name.lower() == 'content-length':
+                    length = int(value)
+            self.rfile.read(length)
+            self.server.received.append(request_line.split()[0])
+            if answered:
+                return
+            self.wfile.write('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+                             '\r\nok')
+            answered = True
+
+def test_dropped_connections_only_retry_idempotent_requests():
+    dropping = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+                                               DroppingHandler)
+    dropping.daemon_threads = True
+    dropping.received = []
+    thread = threading.Thread(target=dropping.serve_forever, args=(0.05,))
+    thread.setDaemon(True)
+    thread.start()
+    url = 'http://127.0.0.1:%d/' % dropping.server_address[1]
+    pool = ConnectionPool()
+    try:
+        assert pool.request(url) == (200, 'ok')
+        try:
+            pool.request(url, 'POST', 'x', idempotent=False)
+        except httplib.BadStatusLine:
+            pass
+        else:
+            assert False, 'expected BadStatusLine'
+        assert dropping.received == ['GET', 'POST']
+
+        del dropping.received[:]
+        assert pool.request(url) == (200, 'ok')
+        assert pool.request(url, 'POST', 'x') == (200, 'ok')
+        assert dropping.received == ['GET', 'POST', 'POST']
+    finally:
+        dropping.shutdown()
+        dropping.server_close()
+
+def serve_logins(toc):
+    # Logins can only be deferred by a server that supports it.
+    login_server = make_server(listen('127.0.0.1', 0), toc, threads=1)
+    thread = threading.Thread(target=login_server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return login_server
+
+def fetch(port, path):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    result = (resp.status, resp.getheader('Location'), resp.read())
+    conn.close()
+    return result
+
+def test_nonblocking_logins_share_a_thread():
+    toc, app = client(async_http=AsyncHttpClient())
+    provider.delay = 0.5
+    login_server = serve_logins(toc)
+    port = login_server.server_port
+    try:
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       fetch(port, '/')
+                       )) for i in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # One thread waiting on each in turn would take 1.5 seconds.
+        assert time.time() - start < 1.2
+        assert [status for status, location, body in results] == [302] * 3
+
+        provider.delay = 0
+        query = authorize(results[0][1], 'bob')
+        status, location, body = fetch(port, '/callback?%s' % query)
+        assert (status, body) == (200, 'bob:1')
+        status, location, body = fetch(port, '/callback?%s' % query)
+        assert status == 400
+    finally:
+        login_server.shutdown()
+        login_server.drain()
+        login_server.server_close()
+
+def test_nonblocking_login_failures():
+    toc, app = client(async_http=AsyncHttpClient(read_timeout=0.2),
+                      retries=1, backoff=0)
+    login_server = serve_logins(toc)
+    port = login_server.server_port
+    try:
+        provider.failures.extend(['503 Service Unavailable'] * 2)
+        status, location, body = fetch(port, '/')
+        assert status == 502
+        assert body.endswith('returned status 503')
+
+        provider.failures.append('503 Service Unavailable')
+        assert fetch(port, '/')[0] == 302
+
+        provider.delay = 0.5
+        status, location, body = fetch(port, '/')
+        assert status == 504
+        assert body.endswith('timed out')
+    finally:
+        login_server.shutdown()
+        login_server.drain()
+        login_server.server_close()
@@ -0,0 +1,188 @@
+import os
+import time
+import signal
+import socket
+import httplib
+import threading
+
+from twitblob.workers import listen, make_server, run_server, PreforkMaster
+
+entered = threading.Event()
+release = threading.Event()
+
+def app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    if environ['PATH_INFO'] == '/slow':
+        entered.set()
+        release.wait()
+    if environ['PATH_INFO'] == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return iter(['a', 'b'])
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['%d:%s' % (os.getpid(), body)]
+
+def serve(threads=2, **kwargs):
+    server = make_server(listen('127.0.0.1', 0), app, threads, **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def stop(server):
+    server.shutdown()
+    server.drain()
+    server.server_close()
+
+def test_keepalive():
+    server = serve()
+    try:
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        conn.request('POST', '/', 'hi')
+        resp = conn.getresponse()
+        assert resp.version == 11
+        assert resp.read() == '%d:hi' % os.getpid()
+        sock = conn.sock
+        conn.request('POST', '/', 'there')
+        assert conn.getresponse().read() == '%d:there' % os.getpid()
+        assert conn.sock is sock
+        conn.close()
+    finally:
+        stop(server)
+
+def test_connection_closed_without_content_length():
+    server = serve()
+    try:
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        conn.request('GET', '/stream')
+        resp = conn.getresponse()
+        assert resp.getheader('Connection') == 'close'
+        assert resp.read() == 'ab'
+        conn.close()
+    finally:
+        stop(server)
+
+def test_idle_connections_dont_hold_threads():
+    server = serve(threads=1)
+    try:
+        idle = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        idle.request('POST', '/', 'hi')
+        assert idle.getresponse().read() == '%d:hi' % os.getpid()
+
+        # The only thread is free to serve another connection while
+        # the first is kept alive.
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port,
+                                      timeout=5)
+        conn.request('POST', '/', 'there')
+        assert conn.getresponse().read() == '%d:there' % os.getpid()
+        conn.close()
+
+        idle.request('POST', '/', 'again')
+        assert idle.getresponse().read() == '%d:again' % os.getpid()
+        idle.close()
+    finally:
+        stop(server)
+
+def test_busy_server_turns_connections_away():
+    entered.clear()
+    release.clear()
+    server = serve(threads=1, queue_size=1)
+    try:
+        slow = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        slow.request('GET', '/slow')
+        assert entered.wait(5)
+
+        queued = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        queued.request('POST', '/', 'queued')
+        deadline = time.time() + 5
+        while not server.requests.full() and time.time() < deadline:
+            time.sleep(0.01)
+
+        conn = httplib.HTTPConnection('127.0.0.1', server.server_port)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        assert resp.status == 503
+        assert resp.getheader('Retry-After') == '1'
+        conn.close()
+        assert server.turned_away == 1
+
+        release.set()
+        assert slow.getresponse().status == 200
+        assert queued.getresponse().read() == '%d:queued' % os.getpid()
+        slow.close()
+        queued.close()
+    finally:
+        release.set()
+        stop(server)
+
+def test_drain_stops_threads():
+    server = serve(threads=3)
+    stop(server)
+    assert not [thread for thread in server.threads if thread.isAlive()]
+
+def get(port):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/')
+    body = conn.getresponse().read()
+    conn.close()
+    return int(body.split(':')[0])
+
+def test_failed_reload_keeps_serving():
+    sock = listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    def app_factory():
+        raise ValueError('bad config')
+    server_pid = os.fork()
+    if not server_pid:
+        status = 1
+        try:
+            run_server(make_server(sock, app, 1), app_factory, 5)
+            status = 0
+        finally:
+            os._exit(status)
+    sock.close()
+    try:
+        first = get(port)
+        os.kill(server_pid, signal.SIGHUP)
+        time.sleep(1.5)
+        assert get(port) == first
+    finally:
+        os.kill(server_pid, signal.SIGTERM)
+        pid, status = os.waitpid(server_pid, 0)
+    assert status == 0
+
+def test_prefork():
+    sock = listen('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    master_pid = os.fork()
+    if not master_pid:
+        try:
+            PreforkMaster(sock, lambda: app, workers=2, threads=1,
+                          graceful_timeout=5).run()
+        finally:
+            os._exit(0)
+    sock.close()
+    try:
+        pids = set()
+        for i in range(20):
+            pids.add(get(port))
+        assert master_pid not in pids
+        assert os.getpid() not in pids
+
+        # Workers that die are replaced.
+        seen = set(pids)
+        deadline = time.time() + 10
+        while len(seen) < 4 and time.time() < deadline:
+            pid = get(port)
+            seen.add(pid)
+            os.kill(pid, signal.SIGKILL)
+        assert len(seen) >= 4
+    finally:
+        os.kill(master_pid, signal.SIGTERM)
+        pid, status = os.waitpid(master_pid, 0)
+    assert status == 0
+    try:
+        get(port)
+    except socket.error:
+        pass
+    else:
+        raise AssertionError('server still running')
@@ -0,0 +1,225 @@
+'''
+Admission control: limits on the number of requests of each class
+served at once, so that when storage or Twitter slows down, the
+requests that pile up are turned away quickly with a 503 rather than
+tying up every thread until they all time out together.
+'''
+
+import time
+import threading
+
+from twitblob import codec as json
+from twitblob.metrics import format_labels
+from twitblob.routes import route
+from twitblob.workers import RESUMED_KEY
+
+ROUTE_CLASSES = ['read', 'write', 'login', 'feedback']
+
+# Seconds a request may wait for a slot, if its class has a queue.
+DEFAULT_QUEUE_TIMEOUT = 1.0
+
+# Seconds clients are told to wait before retrying a request that was
+# turned away.
+DEFAULT_RETRY_AFTER = 1
+
+def route_class(path, method):
+    '''
+    Classifies a request by what it costs to serve, returning None for
+    requests that are never limited.
+
+      >>> route_class('/blobs/bob', 'GET')
+      'read'
+      >>> route_class('/blobs/bob', 'POST')
+      'write'
+      >>> route_class('/login/callback', 'GET')
+      'login'
+      >>> route_class('/metrics/', 'GET') is None
+      True
+    '''
+
+    if method == 'OPTIONS':
+        return None
+    resource = route(path)[0]
+    if resource in ('blob', 'blobs', 'who'):
+        if method in ('GET', 'HEAD'):
+            return 'read'
+        return 'write'
+    if resource in ('login', 'logout'):
+        return 'login'
+    if resource == 'feedback':
+        return 'feedback'
+    return None
+
+class Limiter(object):
+    '''
+    Lets at most limit callers in at once, and makes at most
+    queue_size more wait, for up to queue_timeout seconds each, for
+    one of them to leave. Everyone else is turned away at once.
+
+      >>> l = Limiter(1, queue_size=1, queue_timeout=0.01)
+      >>> l.acquire()
+      True
+      >>> l.acquire()
+      False
+      >>> l.release()
+      >>> l.acquire()
+      True
+      >>> l.rejected
+      1
+    '''
+
+    def __init__(self, limit, queue_size=0,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.cond = threading.Condition(threading.Lock())
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def acquire(self):
+        self.cond.acquire()
+        try:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+            deadline = time.time() + self.queue_timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return True
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.active -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+class AdmissionControl(object):
+    '''
+    A Limiter for each route class that has limits, which are given
+    as a dictionary mapping class names to dictionaries with a
+    'limit' and, optionally, a 'queue' size, 'queue_timeout' and
+    'retry_after'.
+
+      >>> a = AdmissionControl({'write': {'limit': 10, 'queue': 20}})
+      >>> a.limiter_for('/blobs/bob', 'PUT').queue_size
+      20
+      >>> a.limiter_for('/blobs/bob', 'GET') is None
+      True
+    '''
+
+    def __init__(self, limits):
+        self.limiters = {}
+        for name, options in limits.items():
+            if name not in ROUTE_CLASSES:
+                raise ValueError('unknown route class: %s' % name)
+            self.limiters[name] = Limiter(
+                options['limit'],
+                queue_size=options.get('queue', 0),
+                queue_timeout=options.get('queue_timeout',
+                                          DEFAULT_QUEUE_TIMEOUT),
+                retry_after=options.get('retry_after', DEFAULT_RETRY_AFTER)
+                )
+
+    def limiter_for(self, path, method):
+        return self.limiters.get(route_class(path, method))
+
+    def render_metrics(self):
+        '''
+        Renders the number of requests of each class being served,
+        waiting and turned away in the Prometheus text exposition
+        format.
+        '''
+
+        lines = []
+        for name, attr, kind in [
+            ('twitblob_admission_active', 'active', 'gauge'),
+            ('twitblob_admission_waiting', 'waiting', 'gauge'),
+            ('twitblob_admission_rejected_total', 'rejected', 'counter')
+            ]:
+            lines.append('# TYPE %s %s' % (name, kind))
+            for route_class in sorted(self.limiters):
+                lines.append('%s%s %d' % (
+                    name, format_labels([('class', route_class)]),
+                    getattr(self.limiters[route_class], attr)
+                    ))
+        return '\n'.join(lines) + '\n'
+
+class ReleasingIterable(object):
+    '''
+    Passes on a streamed response, releasing its limiter once the
+    server closes it.
+    '''
+
+    def __init__(self, result, limiter):
+        self.result = result
+        self.limiter = limiter
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.limiter.release()
+
+def admitted(func):
+    '''
+    Decorates a WSGI method so that requests are admitted by the
+    AdmissionControl in its object's 'admission' attribute, if that
+    isn't None, and turned away with a 503 if their class is at its
+    limit.
+    '''
+
+    def wsgi_wrapper(self, environ, start_response):
+        # A deferred request gives up its slot while it waits, but
+        # isn't turned away once it's resumed, having been let in.
+        if self.admission is None or environ.get(RESUMED_KEY):
+            return func(self, environ, start_response)
+
+        limiter = self.admission.limiter_for(environ['PATH_INFO'],
+                                             environ['REQUEST_METHOD'])
+        if limiter is None:
+            return func(self, environ, start_response)
+        if not limiter.acquire():
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'application/json'),
+                            ('Retry-After', str(limiter.retry_after))])
+            return [json.dumps({'error': 'too busy, try again later'})]
+
+        try:
+            result = func(self, environ, start_response)
+        except:
+            limiter.release()
+            raise
+        if isinstance(result, list):
+            limiter.release()
+            return result
+        return ReleasingIterable(result, limiter)
+
+    wsgi_wrapper.__name__ = func.__name__
+    return wsgi_wrapper
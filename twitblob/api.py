@@ -1,15 +1,47 @@
-import simplejson as json
+from twitblob import codec as json
 import wsgiref.util
 import datetime
 from cgi import parse_qsl
 from base64 import urlsafe_b64encode
 from os import urandom
 
+from twitblob.admission import AdmissionControl, admitted
+from twitblob.cache import LRUCache
+from twitblob.compression import negotiate_encoding, \
+                                 CACHE_KEY as COMPRESSION_CACHE_KEY
+from twitblob.directory import UserDirectory, content_etag, \
+                               DEFAULT_DIRECTORY_REFRESH
+from twitblob.feedback import FeedbackQueue, DEFAULT_FEEDBACK_WORKERS, \
+                              DEFAULT_MAX_ATTEMPTS, DEFAULT_RETRY_DELAY
+from twitblob.metrics import Metrics, InstrumentedStorage, instrumented
+from twitblob.purge import USER_LIST_KEY, user_key, name_key, blob_keys
+from twitblob.replicas import ReadRouter, DEFAULT_PIN_WINDOW
+from twitblob.routes import route
+from twitblob.storage import Backend, DuplicateToken
+from twitblob.mongo_storage import MongoBackend
+from twitblob.tokens import TokenSigner, RevocationList, TokenSweeper, \
+                            to_timestamp, constant_time_compare, \
+                            DEFAULT_REVOCATION_REFRESH, \
+                            DEFAULT_REQUEST_TOKEN_LIFETIME, \
+                            DEFAULT_SWEEP_INTERVAL
+
 DEFAULT_MAX_BODY_SIZE = 20000
 
 # By default, auth tokens last a fortnight.
 DEFAULT_TOKEN_LIFETIME = datetime.timedelta(days=14)
 
+# Maximum number of ids or names sent to the database in a single
+# batched lookup query.
+DEFAULT_LOOKUP_CHUNK_SIZE = 500
+
+# Approximate number of bytes buffered between writes of a streamed
+# JSON response.
+STREAM_CHUNK_SIZE = 8192
+
+# Number of times a merge that has to check a blob's quota is tried
+# before giving up, if other writes to the blob keep getting in first.
+MAX_MERGE_ATTEMPTS = 5
+
 def allow_cross_origin(func):
     aca_headers = [
         ('Access-Control-Allow-Origin', '*'),
@@ -17,6 +49,9 @@ def allow_cross_origin(func):
         ('Access-Control-Allow-Headers', 'Content-Type')
         ]
     def wsgi_wrapper(self, environ, start_response):
+        # Metrics are for monitoring systems, not other sites' pages.
+        if route(environ['PATH_INFO'])[0] == 'metrics':
+            return func(self, environ, start_response)
         def new_start_response(status, headers):
             start_response(status, headers + aca_headers)
         return func(self, environ, new_start_response)
@@ -27,6 +62,122 @@ def gentoken():
     # an annoying '=' in the string.
     return urlsafe_b64encode(urandom(256/8+1))
 
+def blob_data(blob):
+    # Cached blobs may only have their encoded JSON.
+    if 'data' not in blob:
+        return json.loads(blob['json'])
+    return blob['data']
+
+def as_backend(db):
+    # For backwards compatibility, db may also be a pymongo
+    # database rather than a storage backend.
+    if not isinstance(db, Backend):
+        return MongoBackend(db)
+    return db
+
+# The functions below validate requests independently of how they
+# were received; they raise ValueError or return an error message.
+
+def parse_ids(value):
+    '''
+      >>> parse_ids('1,2')
+      [1, 2]
+    '''
+
+    return [int(strid) for strid in value.split(",")]
+
+def parse_names(value):
+    '''
+      >>> parse_names('bob,,jane')
+      ['bob', 'jane']
+    '''
+
+    names = [name for name in value.split(",") if name]
+    if not names:
+        raise ValueError(value)
+    return names
+
+def unique(values):
+    '''
+    Returns the given values without duplicates, in their original
+    order.
+
+      >>> unique([2, 1, 2])
+      [2, 1]
+    '''
+
+    seen = set()
+    result = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            result.append(value)
+    return result
+
+def parse_page(qargs):
+    '''
+    Returns the 'after' and 'limit' arguments of a user list request.
+
+      >>> parse_page({'after': '5', 'limit': '10'})
+      (5, 10)
+      >>> parse_page({})
+      (None, None)
+    '''
+
+    after = qargs.get('after')
+    if after is not None:
+        after = int(after)
+    limit = qargs.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError(limit)
+    return (after, limit)
+
+def blob_body_error(obj):
+    '''
+      >>> blob_body_error({'data': {'a': 1}})
+      >>> blob_body_error({'data': {'$a': 1}})
+      'data keys may not be empty, contain "." or start with "$"'
+      >>> blob_body_error({'data': {'': 1}})
+      'data keys may not be empty, contain "." or start with "$"'
+    '''
+
+    if not (isinstance(obj, dict) and
+            isinstance(obj.get('data'), dict)):
+        return 'body must contain "data" object'
+    for name in obj['data']:
+        if not name or '.' in name or name.startswith('$'):
+            return ('data keys may not be empty, contain "." or start '
+                    'with "$"')
+    return None
+
+def feedback_body_error(obj):
+    if not (isinstance(obj, dict) and
+            isinstance(obj.get('message'), basestring)):
+        return 'body must contain "message" string'
+    return None
+
+class QuotaExceeded(Exception):
+    '''
+    Raised when a write would make the encoded data of a blob bigger
+    than its quota.
+    '''
+
+    def __init__(self, size, quota):
+        Exception.__init__(self, size, quota)
+        self.size = size
+        self.quota = quota
+
+class MergeConflict(Exception):
+    '''
+    Raised when a merge can't be made because other writes to the
+    same blob keep getting in between reading and writing it.
+    '''
+
+def make_etag(version):
+    return '"%d"' % version
+
 class Request(object):
     def __init__(self, environ, start_response):
         self.environ = environ
@@ -40,91 +191,594 @@ class Request(object):
         except ValueError:
             self.length = 0
 
-    def json_response(self, obj, status='200 OK'):
+    def json_response(self, obj, status='200 OK', headers=None):
         self.start_response(status,
-                            [('Content-Type', 'application/json')])
+                            [('Content-Type', 'application/json')] +
+                            (headers or []))
         return [json.dumps(obj)]
 
+    def raw_json_response(self, body, status='200 OK', headers=None):
+        self.start_response(status,
+                            [('Content-Type', 'application/json'),
+                             ('Content-Length', str(len(body)))] +
+                            (headers or []))
+        return [body]
+
+    def not_modified(self, etag, headers=None):
+        self.start_response('304 Not Modified',
+                            [('ETag', etag)] + (headers or []))
+        return []
+
+    def etag_matches(self, etag):
+        '''
+        Returns whether the request's If-None-Match header matches
+        the given entity tag.
+
+          >>> req = Request({'PATH_INFO': '/', 'REQUEST_METHOD': 'GET',
+          ...                'HTTP_IF_NONE_MATCH': 'W/"1", "2"'}, None)
+          >>> req.etag_matches('"2"'), req.etag_matches('"3"')
+          (True, False)
+          >>> req.environ['HTTP_IF_NONE_MATCH'] = '*'
+          >>> req.etag_matches('"3"')
+          True
+        '''
+
+        header = self.environ.get('HTTP_IF_NONE_MATCH')
+        if not header:
+            return False
+        for candidate in header.split(','):
+            candidate = candidate.strip()
+            if candidate.startswith('W/'):
+                candidate = candidate[2:]
+            if candidate in ('*', etag):
+                return True
+        return False
+
     def json_error(self, error, status='400 Bad Request'):
         return self.json_response({'error': error}, status)
 
+    def json_stream(self, items, status='200 OK', headers=None):
+        self.start_response(status,
+                            [('Content-Type', 'application/json')] +
+                            (headers or []))
+        return iter_json_array(items)
+
+def iter_json_array(items, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Encodes an iterable as a JSON array, a chunk at a time.
+
+      >>> list(iter_json_array(iter([1, {'a': 2}])))
+      ['[1, {"a": 2}]']
+      >>> ''.join(iter_json_array(range(5), chunk_size=4))
+      '[0, 1, 2, 3, 4]'
+      >>> list(iter_json_array([]))
+      ['[]']
+    '''
+
+    chunk = ['[']
+    size = 1
+    for item in items:
+        if size > 1:
+            chunk.append(', ')
+        encoded = json.dumps(item)
+        chunk.append(encoded)
+        size += len(encoded) + 2
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 2
+    chunk.append(']')
+    yield ''.join(chunk)
+
+def backfill_blob_json(storage):
+    """
+    Stores the encoded JSON of every blob that doesn't have it yet,
+    returning the number of blobs updated.
+    """
+
+    count = 0
+    for blob in storage.iter_blobs_without_json():
+        storage.set_blob_json(blob['user_id'], blob['version'],
+                              json.dumps(blob['data']))
+        count += 1
+    return count
+
 class TwitBlobDb(object):
     def __init__(self, db, token_lifetime=DEFAULT_TOKEN_LIFETIME,
-                 utcnow=datetime.datetime.utcnow, gentoken=gentoken):
-        self.db = db
-        self.db.blobs.ensure_index('screen_name')
-        self.db.blobs.ensure_index('user_id')
-        self.db.auth_tokens.ensure_index('id')
+                 utcnow=datetime.datetime.utcnow, gentoken=gentoken,
+                 lookup_chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE,
+                 cache_size=0, cache_ttl=None, token_secret=None,
+                 token_revocation=False,
+                 revocation_refresh=DEFAULT_REVOCATION_REFRESH,
+                 store_json=False,
+                 request_token_lifetime=DEFAULT_REQUEST_TOKEN_LIFETIME,
+                 token_sweep_interval=DEFAULT_SWEEP_INTERVAL,
+                 user_directory=False,
+                 directory_refresh=DEFAULT_DIRECTORY_REFRESH,
+                 read_replica=None, max_staleness=None,
+                 pin_window=DEFAULT_PIN_WINDOW, purger=None,
+                 blob_quota=None):
+        self.storage = as_backend(db)
         self.utcnow = utcnow
         self.gentoken = gentoken
         self.token_lifetime = token_lifetime
+        self.lookup_chunk_size = lookup_chunk_size
+        self.store_json = store_json
+        # Told which cached responses are stale after every write.
+        self.purger = purger
+        # Maximum size of the encoded data of each blob, if any.
+        self.blob_quota = blob_quota
+
+        # When a token secret is configured, auth tokens are signed
+        # payloads that can be verified without a database lookup.
+        self.signer = None
+        self.revoked = None
+        if token_secret:
+            self.signer = TokenSigner(token_secret)
+            if token_revocation:
+                if isinstance(revocation_refresh, (int, float)):
+                    revocation_refresh = datetime.timedelta(
+                        seconds=revocation_refresh
+                        )
+                self.revoked = RevocationList(
+                    self.storage,
+                    utcnow=utcnow,
+                    refresh_interval=revocation_refresh
+                    )
+
+        # Expired tokens are removed by the backend if it can, and
+        # otherwise swept away whenever someone logs in, since logins
+        # are rare and already wait on Twitter.
+        if isinstance(request_token_lifetime, (int, float)):
+            request_token_lifetime = datetime.timedelta(
+                seconds=request_token_lifetime
+                )
+        if isinstance(token_sweep_interval, (int, float)):
+            token_sweep_interval = datetime.timedelta(
+                seconds=token_sweep_interval
+                )
+        self.sweeper = None
+        if not self.storage.expire_tokens(token_lifetime,
+                                          request_token_lifetime):
+            self.sweeper = TokenSweeper(
+                self.storage, token_lifetime,
+                request_token_lifetime=request_token_lifetime,
+                utcnow=utcnow,
+                interval=token_sweep_interval
+                )
+
+        # Optional in-memory copy of the user list.
+        self.directory = None
+        if user_directory:
+            if isinstance(directory_refresh, (int, float)):
+                directory_refresh = datetime.timedelta(
+                    seconds=directory_refresh
+                    )
+            self.directory = UserDirectory(self.storage, utcnow=utcnow,
+                                           refresh_interval=directory_refresh)
+
+        # Reads of blobs and the user list may go to a replica, while
+        # everything that needs to see the latest writes, such as token
+        # checks, goes to the primary.
+        self.router = None
+        if read_replica is not None:
+            if isinstance(max_staleness, (int, float)):
+                max_staleness = datetime.timedelta(seconds=max_staleness)
+            if isinstance(pin_window, (int, float)):
+                pin_window = datetime.timedelta(seconds=pin_window)
+            self.router = ReadRouter(self.storage, as_backend(read_replica),
+                                     max_staleness=max_staleness,
+                                     pin_window=pin_window, utcnow=utcnow)
+
+        # Optional read cache of blob documents, keyed by screen name,
+        # along with a map from user ids to the screen names currently
+        # in the cache so that id lookups can read through it too.
+        # The versions of the blobs most recently written by this
+        # process are remembered too, so that a read which started
+        # before a write can't cache what it read once the write is
+        # done.
+        self.cache = None
+        self.cached_names = {}
+        self.written_versions = None
+        if isinstance(cache_ttl, (int, float)):
+            cache_ttl = datetime.timedelta(seconds=cache_ttl)
+        if cache_size:
+            self.cache = LRUCache(cache_size, ttl=cache_ttl, utcnow=utcnow,
+                                  on_evict=self.__on_cache_evict)
+            self.written_versions = LRUCache(cache_size)
+
+    def __on_cache_evict(self, screen_name, blob):
+        if self.cached_names.get(blob['user_id']) == screen_name:
+            del self.cached_names[blob['user_id']]
+
+    # cached_names and written_versions are kept in step with the
+    # cache by holding the cache's lock, which __on_cache_evict is
+    # called with.
+
+    def __cache_blob(self, blob):
+        if self.cache is not None:
+            self.cache.lock.acquire()
+            try:
+                written = self.written_versions.peek(blob['user_id'], 0)
+                cached = self.cache.peek(blob['screen_name'])
+                if (blob['version'] < written or
+                    (cached is not None and
+                     cached['user_id'] == blob['user_id'] and
+                     blob['version'] < cached['version'])):
+                    return
+                self.cache.put(blob['screen_name'], blob)
+                self.cached_names[blob['user_id']] = blob['screen_name']
+            finally:
+                self.cache.lock.release()
+
+    def __uncache_user(self, user_id):
+        if self.cache is not None:
+            self.cache.lock.acquire()
+            try:
+                screen_name = self.cached_names.pop(user_id, None)
+                if screen_name is not None:
+                    self.cache.invalidate(screen_name)
+            finally:
+                self.cache.lock.release()
+
+    def __wrote_version(self, user_id, version):
+        if self.cache is not None:
+            self.cache.lock.acquire()
+            try:
+                if version > self.written_versions.peek(user_id, 0):
+                    self.written_versions.put(user_id, version)
+            finally:
+                self.cache.lock.release()
+
+    def __cached_blob_for_id(self, user_id):
+        self.cache.lock.acquire()
+        try:
+            screen_name = self.cached_names.get(user_id)
+            if screen_name is None:
+                return None
+            return self.cache.get(screen_name)
+        finally:
+            self.cache.lock.release()
+
+    def __wrote_user(self, token, version):
+        # The user list only changes when someone is new or renamed,
+        # and only the directory can tell about renames.
+        self.__wrote_version(token['user_id'], version)
+        new_user = (version == 1)
+        listed = new_user
+        if self.directory is not None:
+            if self.directory.saw(token['user_id'], token['screen_name']):
+                listed = True
+        if self.router is not None:
+            self.router.wrote(token['user_id'], token['screen_name'],
+                              new_user=new_user)
+        if self.purger is not None:
+            keys = blob_keys(token['user_id'], token['screen_name'])
+            if listed:
+                keys.append(USER_LIST_KEY)
+            self.purger.purge(keys)
+
+    def __reader(self, screen_name):
+        if self.router is not None:
+            return self.router.for_name(screen_name)
+        return self.storage
 
     def make_token(self, screen_name, user_id):
-        token_id = self.gentoken()
-        while self.db.auth_tokens.find_one({'id': token_id}):
-            token_id = self.gentoken()
-        token = {
+        if self.sweeper is not None:
+            self.sweeper.maybe_sweep()
+        if self.signer:
+            return self.make_signed_token(screen_name, user_id)
+        while True:
+            token = {
+                'id': self.gentoken(),
+                'screen_name': screen_name,
+                'user_id': user_id,
+                'date': self.utcnow()
+                }
+            try:
+                self.storage.insert_token(token)
+            except DuplicateToken:
+                continue
+            return token
+
+    def make_signed_token(self, screen_name, user_id):
+        now = self.utcnow()
+        token_id = self.signer.sign({
+            's': screen_name,
+            'u': user_id,
+            'e': to_timestamp(now + self.token_lifetime),
+            'n': self.gentoken()
+            })
+        return {
             'id': token_id,
             'screen_name': screen_name,
             'user_id': user_id,
-            'date': self.utcnow()
+            'date': now
+            }
+
+    def get_signed_token(self, tokid):
+        payload = self.signer.unsign(tokid)
+        if (payload is None or
+            to_timestamp(self.utcnow()) >= payload.get('e', 0) or
+            (self.revoked is not None and payload.get('n') in self.revoked)):
+            return None
+        return {
+            'id': tokid,
+            'screen_name': payload['s'],
+            'user_id': payload['u'],
+            'expires': datetime.datetime.utcfromtimestamp(payload['e']),
+            'nonce': payload['n']
             }
-        self.db.auth_tokens.insert(token)
-        return token
 
     def get_token(self, tokid):
-        token = self.db.auth_tokens.find_one({'id': tokid})
+        # Tokens issued before signing was enabled have no '.' in
+        # them, so keep looking those up until they expire.
+        if (self.signer and isinstance(tokid, basestring) and
+            '.' in tokid):
+            return self.get_signed_token(tokid)
+        if not isinstance(tokid, basestring):
+            return None
+        token = self.storage.find_token(tokid)
         if (token is not None and
-            self.utcnow() - token['date'] > self.token_lifetime):
+            self.utcnow() - token['date'] >= self.token_lifetime):
             token = None
-            self.db.auth_tokens.remove({'id': tokid})
+            self.storage.remove_token(tokid)
         return token
 
-    def get_user_list(self):
-        return [{'screen_name': blob['screen_name'],
-                 'user_id': blob['user_id']}
-                for blob in self.db.blobs.find()]
+    def revoke_token(self, token):
+        if 'nonce' not in token:
+            self.storage.remove_token(token['id'])
+            return True
+        if self.revoked is None:
+            return False
+        self.revoked.revoke(token['nonce'], token['expires'])
+        return True
 
-    def get_blobs_for_ids(self, ids):
+    def iter_user_list(self, after=None, limit=None):
+        if self.directory is not None:
+            return self.directory.users(after, limit)
+        if self.router is not None:
+            return self.router.for_user_list().iter_users(after, limit)
+        return self.storage.iter_users(after, limit)
+
+    def get_user_list(self, after=None, limit=None):
+        return list(self.iter_user_list(after, limit))
+
+    def _find_blob_docs(self, key, values):
         blobs = {}
-        # TODO: This may be really slow because of the
-        # many requests we're making to the DB. Shouldn't
-        # be hard to optimize, though.
-        for intid in ids:
-            blob = self.db.blobs.find_one({'user_id': intid})
-            if blob is not None:
-                blobs[blob['screen_name']] = blob['data']
+        values = list(set(values))
+        if self.cache is not None:
+            uncached = []
+            for value in values:
+                if key == 'user_id':
+                    blob = self.__cached_blob_for_id(value)
+                else:
+                    blob = self.cache.get(value)
+                if blob is not None and blob[key] == value:
+                    blobs[blob['screen_name']] = blob
+                else:
+                    uncached.append(value)
+            values = uncached
+        plan = [(self.storage, values)]
+        if self.router is not None:
+            plan = self.router.split(key, values)
+        for storage, wanted in plan:
+            for i in range(0, len(wanted), self.lookup_chunk_size):
+                chunk = wanted[i:i+self.lookup_chunk_size]
+                for blob in storage.find_blobs(key, chunk):
+                    blobs[blob['screen_name']] = blob
+                    self.__cache_blob(blob)
         return blobs
 
+    def _find_blobs(self, key, values):
+        return dict((screen_name, blob_data(blob)) for screen_name, blob
+                    in self._find_blob_docs(key, values).items())
+
+    def get_blobs_for_ids(self, ids):
+        return self._find_blobs('user_id', ids)
+
+    def get_blobs_for_names(self, names):
+        return self._find_blobs('screen_name', names)
+
+    def get_blob_docs_for_names(self, names):
+        return self._find_blob_docs('screen_name', names)
+
+    def check_quota(self, encoded):
+        if self.blob_quota and len(encoded) > self.blob_quota:
+            raise QuotaExceeded(len(encoded), self.blob_quota)
+
     def update_user(self, token, data):
-        blob = self.db.blobs.find_one({'screen_name': token['screen_name']})
-        if blob is not None:
-            for name in data:
-                blob['data'][name] = data[name]
-            data = blob['data']
-        self.replace_user(token, data)
+        '''
+        Merges the given keys into the user's blob, returning the size
+        of its encoded data if that's known.
+        '''
+
+        self.__uncache_user(token['user_id'])
+        try:
+            return self.__merge_user(token, data)
+        finally:
+            # A read that raced with the write may have cached the
+            # blob as it was before.
+            self.__uncache_user(token['user_id'])
+
+    def __merge_user(self, token, data):
+        if self.blob_quota:
+            return self.__merge_within_quota(token, data)
+        # Merge the new keys into the stored blob with a single atomic
+        # update, so concurrent POSTs to different keys don't clobber
+        # each other and the existing blob never has to leave the
+        # database.
+        if not self.store_json:
+            blob = self.storage.merge_blob(token['user_id'],
+                                           token['screen_name'], data)
+        else:
+            # The merge drops any stored JSON, so re-encode the merged
+            # blob afterwards. If another write gets in first, the
+            # version check leaves the JSON to it.
+            blob = self.storage.merge_blob(token['user_id'],
+                                           token['screen_name'], data,
+                                           fetch_data=True)
+            self.storage.set_blob_json(token['user_id'], blob['version'],
+                                       json.dumps(blob['data']))
+        self.__wrote_user(token, blob['version'])
+        return None
+
+    def __merge_within_quota(self, token, data):
+        # The size of the merged blob can only be known by merging it
+        # here rather than in the database, so the write is made
+        # conditional on the blob not having changed since it was
+        # read, and tried again, a few times, if it has.
+        for attempt in range(MAX_MERGE_ATTEMPTS):
+            merged = {}
+            version = 0
+            for blob in self.storage.find_blobs('user_id',
+                                                [token['user_id']]):
+                merged = blob['data']
+                version = blob['version']
+            merged.update(data)
+            encoded = json.dumps(merged)
+            self.check_quota(encoded)
+            new_version = self.storage.replace_blob(
+                token['user_id'], token['screen_name'], merged,
+                self.store_json and encoded or None, if_version=version
+                )
+            if new_version is not None:
+                self.__wrote_user(token, new_version)
+                return len(encoded)
+        raise MergeConflict(token['user_id'])
 
     def replace_user(self, token, data):
-        self.db.blobs.update({'user_id': token['user_id']},
-                             {'screen_name': token['screen_name'],
-                              'user_id': token['user_id'],
-                              'data': data},
-                             upsert=True)
+        '''
+        Replaces the user's blob with the given data, returning the
+        size of its encoded data.
+        '''
+
+        blob = {'screen_name': token['screen_name'],
+                'user_id': token['user_id'],
+                'data': data}
+        encoded = json.dumps(data)
+        self.check_quota(encoded)
+        if self.store_json:
+            blob['json'] = encoded
+        self.__uncache_user(token['user_id'])
+        blob['version'] = self.storage.replace_blob(token['user_id'],
+                                                    token['screen_name'],
+                                                    data, blob.get('json'))
+        self.__uncache_user(token['user_id'])
+        self.__cache_blob(blob)
+        self.__wrote_user(token, blob['version'])
+        return len(encoded)
+
+    def backfill_json(self):
+        return backfill_blob_json(self.storage)
+
+    def get_blob_doc(self, screen_name):
+        blob = None
+        if self.cache is not None:
+            blob = self.cache.get(screen_name)
+        if blob is None:
+            storage = self.__reader(screen_name)
+            if self.store_json:
+                # Most blobs will have their JSON stored, so try to avoid
+                # fetching the decoded data as well.
+                blob = storage.find_blob(screen_name, without_data=True)
+                if blob is not None and 'json' not in blob:
+                    blob = storage.find_blob(screen_name)
+            else:
+                blob = storage.find_blob(screen_name)
+            if blob is not None:
+                self.__cache_blob(blob)
+        return blob
 
     def get_blob(self, screen_name):
-        blob = self.db.blobs.find_one({'screen_name': screen_name})
+        blob = self.get_blob_doc(screen_name)
         if blob is not None:
-            return blob['data']
+            return blob_data(blob)
         return None
 
+    def get_blob_version(self, screen_name):
+        if self.cache is not None:
+            blob = self.cache.get(screen_name)
+            if blob is not None:
+                return blob['version']
+        return self.__reader(screen_name).find_blob_version(screen_name)
+
 class TwitBlobApi(object):
     def __init__(self, twitter, db, max_body_size=DEFAULT_MAX_BODY_SIZE,
-                 send_feedback=None, **kwargs):
+                 send_feedback=None, stream_user_list=False,
+                 compress_min_size=None, compressed_cache_size=0,
+                 metrics=False, slow_request_threshold=None,
+                 metrics_token=None,
+                 cache_control=None, surrogate_control=None,
+                 surrogate_keys=False,
+                 feedback_workers=DEFAULT_FEEDBACK_WORKERS,
+                 feedback_max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 feedback_retry_delay=DEFAULT_RETRY_DELAY,
+                 concurrency_limits=None, blob_quota=None, **kwargs):
         twitter.onsuccess = self.__twitter_onsuccess
         self.twitter = twitter
-        self.db = TwitBlobDb(db, **kwargs)
+        self.metrics = None
+        self.metrics_token = metrics_token
+        if metrics:
+            self.metrics = Metrics(slow_request_threshold)
+            backend = as_backend(db)
+            db = InstrumentedStorage(backend, self.metrics)
+            if getattr(twitter, 'request_tokens', None) is \
+               backend.request_tokens:
+                twitter.request_tokens = db.request_tokens
+            if kwargs.get('read_replica') is not None:
+                kwargs['read_replica'] = InstrumentedStorage(
+                    as_backend(kwargs['read_replica']), self.metrics
+                    )
+        # Blobs may grow no bigger than a single request could make
+        # them, unless told otherwise; a quota of 0 turns it off.
+        if blob_quota is None:
+            blob_quota = max_body_size
+        self.db = TwitBlobDb(db, blob_quota=blob_quota, **kwargs)
         self.max_body_size = max_body_size
         self.send_feedback = send_feedback
+        self.stream_user_list = stream_user_list
+        self.compress_min_size = compress_min_size
+        self.compressed_cache = None
+        if compressed_cache_size:
+            self.compressed_cache = LRUCache(compressed_cache_size)
+        self.cache_control = cache_control
+        self.surrogate_control = surrogate_control
+        self.surrogate_keys = surrogate_keys
+        self.admission = None
+        if concurrency_limits:
+            self.admission = AdmissionControl(concurrency_limits)
+
+        # Feedback is queued in storage and delivered in the
+        # background, so posting it doesn't wait on send_feedback.
+        if isinstance(feedback_retry_delay, (int, float)):
+            feedback_retry_delay = datetime.timedelta(
+                seconds=feedback_retry_delay
+                )
+        self.feedback = FeedbackQueue(self.db.storage, self.__deliver_feedback,
+                                      workers=feedback_workers,
+                                      max_attempts=feedback_max_attempts,
+                                      retry_delay=feedback_retry_delay,
+                                      utcnow=self.db.utcnow)
+
+    def cache_headers(self, keys=()):
+        '''
+        Returns the headers that let browsers and shared caches keep a
+        response, tagged with the given surrogate keys.
+        '''
+
+        headers = []
+        if self.cache_control:
+            headers.append(('Cache-Control', self.cache_control))
+        if self.surrogate_control:
+            headers.append(('Surrogate-Control', self.surrogate_control))
+        if self.surrogate_keys and keys:
+            headers.append(('Surrogate-Key',
+                            ' '.join(keys).encode('utf-8')))
+        return headers
+
+    def __deliver_feedback(self, sender, message):
+        self.send_feedback(sender=sender, message=message)
 
     def __twitter_onsuccess(self, environ, start_response):
         token = self.db.make_token(
@@ -137,9 +791,10 @@ class TwitBlobApi(object):
         client_token = {
             'token': token['id'],
             'screen_name': token['screen_name'],
-            'user_id': token['user_id'],
-            'quota': self.max_body_size
+            'user_id': token['user_id']
             }
+        if self.db.blob_quota:
+            client_token['quota'] = self.db.blob_quota
         script = "window.opener.postMessage(%s, '*');" % (
             repr(str(json.dumps(client_token)))
             )
@@ -155,39 +810,118 @@ class TwitBlobApi(object):
             return (obj, self.db.get_token(obj['token']))
         return (obj, None)
 
-    def serve_blob(self, req):
-        if req.path == '/blobs/':
-            if 'ids' in req.qargs:
-                try:
-                    ids = [int(strid)
-                           for strid in req.qargs['ids'].split(",")]
-                except ValueError:
-                    return req.json_error('invalid ids')
-                return req.json_response(self.db.get_blobs_for_ids(ids))
-            return req.json_error('need query args')
-        user = req.path.split('/')[2]
+    def serve_blobs(self, req):
+        if 'ids' in req.qargs:
+            try:
+                ids = parse_ids(req.qargs['ids'])
+            except ValueError:
+                return req.json_error('invalid ids')
+            # The response depends on the blobs of users who don't have
+            # one yet, too.
+            keys = [user_key(user_id) for user_id in unique(ids)]
+            return req.json_response(self.db.get_blobs_for_ids(ids),
+                                     headers=self.cache_headers(keys))
+        if 'names' in req.qargs:
+            try:
+                names = parse_names(req.qargs['names'])
+            except ValueError:
+                return req.json_error('invalid names')
+            # The response also has to be purged when a user it
+            # includes is renamed, which only their user id tags.
+            docs = self.db.get_blob_docs_for_names(names)
+            keys = [name_key(name) for name in unique(names)]
+            keys.extend(user_key(user_id) for user_id in
+                        unique(blob['user_id'] for blob in docs.values()))
+            return req.json_response(
+                dict((screen_name, blob_data(blob))
+                     for screen_name, blob in docs.items()),
+                headers=self.cache_headers(keys)
+                )
+        return req.json_error('need query args')
+
+    def serve_blob(self, req, user):
         if req.method in ['POST', 'PUT']:
             obj, token = self.get_body(req)
             if obj is None:
                 return req.json_error('error parsing JSON body')
-            if not (isinstance(obj, dict) and 
-                    isinstance(obj.get('data'), dict)):
-                return req.json_error('body must contain "data" object')
+            error = blob_body_error(obj)
+            if error:
+                return req.json_error(error)
             if token and token['screen_name'] == user:
-                if req.method == 'POST':
-                    self.db.update_user(token=token, data=obj['data'])
-                else:
-                    self.db.replace_user(token=token, data=obj['data'])
-                return req.json_response({'success': True})
+                try:
+                    if req.method == 'POST':
+                        usage = self.db.update_user(token=token,
+                                                    data=obj['data'])
+                    else:
+                        usage = self.db.replace_user(token=token,
+                                                     data=obj['data'])
+                except QuotaExceeded, e:
+                    return req.json_response(
+                        {'error': 'blob would exceed quota',
+                         'size': e.size, 'quota': e.quota},
+                        status='413 Request Entity Too Large'
+                        )
+                except MergeConflict:
+                    return req.json_error('blob is being changed by another '
+                                          'request, try again',
+                                          status='409 Conflict')
+                result = {'success': True}
+                if usage is not None and self.db.blob_quota:
+                    result.update(usage=usage, quota=self.db.blob_quota,
+                                  remaining=self.db.blob_quota - usage)
+                return req.json_response(result)
             else:
                 return req.json_error('Missing or invalid auth token',
                                       status='403 Forbidden')
         elif req.method == 'GET':
-            blob = self.db.get_blob(user)
+            if 'HTTP_IF_NONE_MATCH' in req.environ:
+                version = self.db.get_blob_version(user)
+                if (version is not None and
+                    req.etag_matches(make_etag(version))):
+                    return req.not_modified(make_etag(version),
+                                            self.cache_headers())
+            blob = self.db.get_blob_doc(user)
             if blob is None:
                 return req.json_error('blob does not exist',
                                       status='404 Not Found')
-            return req.json_response(blob)
+            headers = [('ETag', make_etag(blob['version']))]
+            headers.extend(self.cache_headers(
+                blob_keys(blob['user_id'], blob['screen_name'])
+                ))
+            req.environ[COMPRESSION_CACHE_KEY] = 'blob:%d:%d' % (
+                blob['user_id'], blob['version'])
+            if 'json' in blob:
+                return req.raw_json_response(blob['json'].encode('utf-8'),
+                                             headers=headers)
+            return req.json_response(blob_data(blob), headers=headers)
+
+    def serve_user_list(self, req):
+        # Results are ordered by user id, so clients page through the
+        # list by passing the last user id they received as 'after'.
+        try:
+            after, limit = parse_page(req.qargs)
+        except ValueError:
+            return req.json_error('invalid after or limit')
+        if self.db.directory is not None:
+            return self.serve_user_directory(req, after, limit)
+        headers = self.cache_headers([USER_LIST_KEY])
+        if self.stream_user_list:
+            return req.json_stream(self.db.iter_user_list(after, limit),
+                                   headers=headers)
+        return req.json_response(self.db.get_user_list(after, limit),
+                                 headers=headers)
+
+    def serve_user_directory(self, req, after, limit):
+        if after is None and limit is None:
+            body, etag = self.db.directory.encode()
+        else:
+            body = json.dumps(self.db.directory.users(after, limit))
+            etag = content_etag(body)
+        if req.etag_matches(etag):
+            return req.not_modified(etag, self.cache_headers())
+        req.environ[COMPRESSION_CACHE_KEY] = 'who:%s' % etag
+        headers = [('ETag', etag)] + self.cache_headers([USER_LIST_KEY])
+        return req.raw_json_response(body, headers=headers)
 
     def post_feedback(self, req):
         if req.method != 'POST':
@@ -196,22 +930,58 @@ class TwitBlobApi(object):
         obj, token = self.get_body(req)
         if obj is None:
             return req.json_error('error parsing JSON body')
-        if not (isinstance(obj, dict) and 
-                isinstance(obj.get('message'), basestring)):
-            return req.json_error('body must contain "message" string')
+        error = feedback_body_error(obj)
+        if error:
+            return req.json_error(error)
         if not token:
             return req.json_error('Missing or invalid auth token',
                                   status='403 Forbidden')
         if not self.send_feedback:
             return req.json_error('feedback mechanism not implemented',
                                   status='501 Not Implemented')
-        result = self.send_feedback(sender=token['screen_name'],
-                                    message=obj['message'])
-        return req.json_response(result)
+        feedback_id = self.feedback.put(token['screen_name'], obj['message'])
+        return req.json_response({'queued': True, 'id': feedback_id},
+                                 status='202 Accepted')
+
+    def logout(self, req):
+        if req.method != 'POST':
+            return req.json_error('unsupported method: %s' % req.method,
+                                  status='405 Method Not Allowed')
+        obj, token = self.get_body(req)
+        if obj is None:
+            return req.json_error('error parsing JSON body')
+        if not token:
+            return req.json_error('Missing or invalid auth token',
+                                  status='403 Forbidden')
+        if not self.db.revoke_token(token):
+            return req.json_error('token revocation not enabled',
+                                  status='501 Not Implemented')
+        return req.json_response({'success': True})
+
+    def serve_metrics(self, req):
+        if req.method != 'GET':
+            return req.json_error('unsupported method: %s' % req.method,
+                                  status='405 Method Not Allowed')
+        authorization = req.environ.get('HTTP_AUTHORIZATION', '')
+        if not (self.metrics_token and constant_time_compare(
+                authorization, 'Bearer %s' % self.metrics_token)):
+            return req.json_error('Missing or invalid metrics token',
+                                  status='403 Forbidden')
+        req.start_response('200 OK',
+                           [('Content-Type', 'text/plain; version=0.0.4')])
+        body = [self.metrics.render(), self.feedback.render_metrics()]
+        if self.admission is not None:
+            body.append(self.admission.render_metrics())
+        return body
 
     @allow_cross_origin
+    @instrumented
+    @admitted
+    @negotiate_encoding
     def wsgi_app(self, environ, start_response):
-        if environ['PATH_INFO'].startswith('/login/'):
+        resource, user = route(environ['PATH_INFO'])
+
+        if resource == 'login':
             wsgiref.util.shift_path_info(environ)
             return self.twitter(environ, start_response)
 
@@ -225,12 +995,18 @@ class TwitBlobApi(object):
             start_response('200 OK', [('Content-Length', '0')])
             return []
 
-        if req.path.startswith('/blobs/'):
-            return self.serve_blob(req)
-        if req.path == '/who/':
-            return req.json_response(self.db.get_user_list())
-        if req.path == '/feedback/':
+        if resource == 'blobs':
+            return self.serve_blobs(req)
+        if resource == 'blob':
+            return self.serve_blob(req, user)
+        if resource == 'who':
+            return self.serve_user_list(req)
+        if resource == 'feedback':
             return self.post_feedback(req)
+        if resource == 'logout':
+            return self.logout(req)
+        if resource == 'metrics' and self.metrics is not None:
+            return self.serve_metrics(req)
 
         start_response('404 Not Found',
                        [('Content-Type', 'text/plain')])
@@ -0,0 +1,437 @@
+'''
+A non-blocking HTTP client. Every request it makes is driven by a
+single background thread that polls their sockets, so that any number
+of requests can wait on a slow upstream server at once without each
+tying up a thread of its own.
+'''
+
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import socket
+import httplib
+import logging
+import threading
+import weakref
+from urlparse import urlparse
+from cStringIO import StringIO
+
+from twitblob.http_client import Attempts, ConnectFailed, UpstreamError, \
+     DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES, \
+     DEFAULT_BACKOFF
+
+try:
+    import ssl
+except ImportError:
+    # Python 2.5 has no ssl module.
+    ssl = None
+
+# Making HTTPS requests that verify certificates, as httplib does,
+# needs Python 2.7.9 or later.
+HTTPS_SUPPORTED = hasattr(ssl, 'create_default_context')
+
+# Errors from non-blocking sockets that only mean they'd have to wait.
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# Seconds an idle event loop waits before checking whether it's still
+# in use.
+DEFAULT_POLL_INTERVAL = 1.0
+
+log = logging.getLogger('twitblob.async_http')
+
+def run(loop_ref):
+    # The thread only holds on to its loop while running it, so that
+    # it stops once the loop has been thrown away, as it is when the
+    # app is reloaded.
+    while True:
+        loop = loop_ref()
+        if loop is None:
+            return
+        try:
+            loop.run_once()
+        except Exception:
+            log.exception('running the event loop failed')
+        del loop
+
+def ssl_wants(e):
+    # Returns the event an SSL socket that failed with e is waiting
+    # for, or None if it actually failed.
+    if ssl is None or not isinstance(e, ssl.SSLError):
+        return None
+    return {ssl.SSL_ERROR_WANT_READ: select.POLLIN,
+            ssl.SSL_ERROR_WANT_WRITE: select.POLLOUT}.get(e.args[0])
+
+def ssl_eof(e):
+    return (ssl is not None and isinstance(e, ssl.SSLError) and
+            e.args[0] == ssl.SSL_ERROR_EOF)
+
+class Timer(object):
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def __cmp__(self, other):
+        return cmp(self.when, other.when)
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    '''
+    Calls functions, after a delay if need be, and handles events on
+    file descriptors, all from one daemon thread. Functions may be
+    scheduled from any thread, but file descriptors may only be
+    watched from the loop's own.
+
+      >>> loop = EventLoop()
+      >>> done = threading.Event()
+      >>> timer = loop.call_later(0, done.set)
+      >>> done.wait(5)
+      True
+    '''
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.timers = []
+        self.handlers = {}
+        self.started_in = None
+
+    def start(self):
+        # Threads don't survive a fork, so the loop is started in
+        # whichever process first uses it.
+        if self.started_in == os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            if self.started_in == os.getpid():
+                return
+            self.started_in = os.getpid()
+            self.handlers = {}
+            self.poll = select.poll()
+            self.wakeup_r, self.wakeup_w = os.pipe()
+            for fd in [self.wakeup_r, self.wakeup_w]:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.poll.register(self.wakeup_r, select.POLLIN)
+            thread = threading.Thread(target=run, args=(weakref.ref(self),))
+            thread.setDaemon(True)
+            thread.start()
+        finally:
+            self.lock.release()
+
+    def call_later(self, delay, func, *args):
+        '''
+        Calls func with the given arguments from the loop's thread once
+        delay seconds have passed, unless the returned Timer is
+        cancelled first.
+        '''
+
+        self.start()
+        timer = Timer(time.time() + delay, func, args)
+        self.lock.acquire()
+        try:
+            heapq.heappush(self.timers, timer)
+        finally:
+            self.lock.release()
+        self.wake()
+        return timer
+
+    def call_soon(self, func, *args):
+        return self.call_later(0, func, *args)
+
+    def wake(self):
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, e:
+            # If the pipe is full, the loop is already awake.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def watch(self, fd, events, handler):
+        '''
+        Calls handler with the events that occur on fd, out of those
+        given, until it's unwatched.
+        '''
+
+        if fd in self.handlers:
+            self.poll.modify(fd, events)
+        else:
+            self.poll.register(fd, events)
+        self.handlers[fd] = handler
+
+    def unwatch(self, fd):
+        if self.handlers.pop(fd, None) is not None:
+            self.poll.unregister(fd)
+
+    def run_once(self):
+        self.lock.acquire()
+        try:
+            timeout = self.poll_interval
+            if self.timers:
+                timeout = min(timeout,
+                              max(0, self.timers[0].when - time.time()))
+        finally:
+            self.lock.release()
+        try:
+            events = self.poll.poll(timeout * 1000)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, event in events:
+            if fd == self.wakeup_r:
+                try:
+                    while os.read(self.wakeup_r, 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                continue
+            handler = self.handlers.get(fd)
+            if handler is not None:
+                self.call(handler, event)
+
+        now = time.time()
+        due = []
+        self.lock.acquire()
+        try:
+            while self.timers and self.timers[0].when <= now:
+                due.append(heapq.heappop(self.timers))
+        finally:
+            self.lock.release()
+        for timer in due:
+            if not timer.cancelled:
+                self.call(timer.func, *timer.args)
+
+    def call(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            log.exception('event loop callback failed')
+
+class BufferedSocket(object):
+    # Lets httplib parse a response that has already been read.
+
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args):
+        return StringIO(self.data)
+
+def parse_response(data, method):
+    '''
+    Returns the status code and body of a complete HTTP response.
+
+      >>> parse_response('HTTP/1.1 200 OK\\r\\nContent-Length: 2\\r\\n'
+      ...                '\\r\\nhi', 'GET')
+      (200, 'hi')
+    '''
+
+    response = httplib.HTTPResponse(BufferedSocket(data), method=method)
+    response.begin()
+    return response.status, response.read()
+
+class Exchange(object):
+    '''
+    A single HTTP request and its response, made over a connection of
+    its own that's closed once the response has been read.
+    '''
+
+    def __init__(self, client, url, method, body, headers, callback):
+        self.client = client
+        self.loop = client.loop
+        self.method = method
+        self.callback = callback
+        parts = urlparse(url)
+        self.https = (parts.scheme == 'https')
+        self.host = parts.hostname
+        self.port = parts.port or (self.https and 443 or 80)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        host = self.host
+        if parts.port:
+            host = '%s:%d' % (host, parts.port)
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host,
+                 'Connection: close', 'Accept-Encoding: identity']
+        if body is not None or method in ('POST', 'PUT'):
+            lines.append('Content-Length: %d' % len(body or ''))
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        self.outgoing = '\r\n'.join(lines) + '\r\n\r\n' + (body or '')
+        self.incoming = []
+        self.sock = None
+        self.timer = None
+        self.finished = False
+
+    def start(self):
+        if self.https and not HTTPS_SUPPORTED:
+            return self.finish(error=ConnectFailed(socket.error(
+                'HTTPS requests need Python 2.7.9 or later'
+                )))
+        try:
+            family, socktype, proto, name, address = socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_STREAM
+                )[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.setblocking(0)
+            error = self.sock.connect_ex(address)
+            if error not in (0, errno.EINPROGRESS) + WOULD_BLOCK:
+                raise socket.error(error, os.strerror(error))
+        except socket.error, e:
+            return self.finish(error=ConnectFailed(e))
+        self.timeout(self.client.connect_timeout, connecting=True)
+        self.loop.watch(self.sock.fileno(), select.POLLOUT, self.connected)
+
+    def timeout(self, seconds, connecting=False):
+        if self.timer is not None:
+            self.timer.cancel()
+        error = socket.timeout('timed out')
+        if connecting:
+            error = ConnectFailed(error)
+        self.timer = self.loop.call_later(seconds, self.finish, None, None,
+                                          error)
+
+    def connected(self, event):
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            return self.finish(error=ConnectFailed(
+                socket.error(error, os.strerror(error))
+                ))
+        if not self.https:
+            return self.send()
+        context = ssl.create_default_context()
+        self.loop.unwatch(self.sock.fileno())
+        self.sock = context.wrap_socket(self.sock,
+                                        server_hostname=self.host,
+                                        do_handshake_on_connect=False)
+        self.handshake()
+
+    def handshake(self, event=None):
+        # The handshake counts towards the connect timeout, as it does
+        # for httplib.
+        try:
+            self.sock.do_handshake()
+        except socket.error, e:
+            event = ssl_wants(e)
+            if event is None:
+                return self.finish(error=ConnectFailed(e))
+            return self.loop.watch(self.sock.fileno(), event, self.handshake)
+        self.send()
+
+    def send(self, event=None):
+        if event is None:
+            self.timeout(self.client.read_timeout)
+        try:
+            while self.outgoing:
+                sent = self.sock.send(self.outgoing)
+                self.outgoing = self.outgoing[sent:]
+        except socket.error, e:
+            if ssl_wants(e) is None and e.args[0] not in WOULD_BLOCK:
+                return self.finish(error=e)
+        if self.outgoing:
+            return self.loop.watch(self.sock.fileno(), select.POLLOUT,
+                                   self.send)
+        self.loop.watch(self.sock.fileno(), select.POLLIN, self.receive)
+
+    def receive(self, event):
+        # Like a blocking socket's timeout, the read timeout applies to
+        # each read rather than to the whole response.
+        self.timeout(self.client.read_timeout)
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self.incoming.append(data)
+        except socket.error, e:
+            if ssl_wants(e) is not None or e.args[0] in WOULD_BLOCK:
+                return
+            # The server may close an SSL connection without saying
+            # so, which a complete response is checked for below
+            # anyway.
+            if not ssl_eof(e):
+                return self.finish(error=e)
+        try:
+            status, content = parse_response(''.join(self.incoming),
+                                             self.method)
+        except httplib.HTTPException, e:
+            return self.finish(error=e)
+        self.finish(status, content)
+
+    def finish(self, status=None, content=None, error=None):
+        if self.finished:
+            return
+        self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.sock is not None:
+            self.loop.unwatch(self.sock.fileno())
+            self.sock.close()
+        self.callback(status, content, error)
+
+class AsyncHttpClient(object):
+    '''
+    Makes HTTP and HTTPS requests without blocking, calling back from
+    its event loop's thread with the result of each. Host names are
+    looked up by that thread too, so they should be ones the system
+    can resolve quickly.
+    '''
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, loop=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        if loop is None:
+            loop = EventLoop()
+        self.loop = loop
+
+    def request(self, url, callback, method='GET', body=None, headers=None):
+        '''
+        Makes a request, later calling callback with the status code
+        and body of the response and None, or with None, None and the
+        socket or httplib error it failed with. ConnectFailed is given
+        if it couldn't be sent at all.
+        '''
+
+        exchange = Exchange(self, url, method, body, headers, callback)
+        self.loop.call_soon(exchange.start)
+
+def request_with_retries(client, url, callback, method='GET', body=None,
+                         headers=None, retries=DEFAULT_RETRIES,
+                         backoff=DEFAULT_BACKOFF, prepare=None,
+                         idempotent=True):
+    '''
+    Makes a request with the given AsyncHttpClient, retrying it as
+    http_client.request_with_retries does, and later calls callback
+    with the body of a 200 response and None, or with None and the
+    UpstreamError it failed with.
+    '''
+
+    attempts = Attempts(url, body, headers, retries, backoff, prepare,
+                        idempotent)
+
+    def attempt():
+        url, body, headers = attempts.next()
+        client.request(url, finished, method, body, headers)
+
+    def finished(status, content, error):
+        try:
+            if error is not None:
+                delay = attempts.failed(error)
+            elif status == 200:
+                return callback(content, None)
+            else:
+                delay = attempts.bad_status(status)
+        except UpstreamError, e:
+            return callback(None, e)
+        client.loop.call_later(delay, attempt)
+
+    client.loop.call_soon(attempt)
@@ -0,0 +1,150 @@
+import datetime
+import threading
+
+class LRUCache(object):
+    '''
+    A bounded, thread-safe least-recently-used cache whose entries
+    optionally expire after a fixed lifetime.
+
+      >>> c = LRUCache(maxsize=2)
+      >>> c.put('a', 1)
+      >>> c.put('b', 2)
+      >>> c.get('a')
+      1
+      >>> c.put('c', 3)
+      >>> c.get('b') is None
+      True
+      >>> sorted(c.stats().items())
+      [('evictions', 1), ('hits', 1), ('misses', 1), ('size', 2)]
+
+    Entries older than the ttl are treated as misses:
+
+      >>> now = [datetime.datetime(2010, 1, 1)]
+      >>> c = LRUCache(maxsize=2, ttl=datetime.timedelta(seconds=5),
+      ...              utcnow=lambda: now[0])
+      >>> c.put('a', 1)
+      >>> now[0] += datetime.timedelta(seconds=6)
+      >>> c.get('a') is None
+      True
+    '''
+
+    def __init__(self, maxsize, ttl=None, utcnow=datetime.datetime.utcnow,
+                 on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.utcnow = utcnow
+        self.on_evict = on_evict
+        # Reentrant, so that callers can hold it across several calls
+        # to keep their own bookkeeping in step with the cache, as
+        # on_evict is called with it held.
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps keys to [value, expiry, prev key, next key]; the
+        # linked list runs from least to most recently used.
+        self.entries = {}
+        self.oldest = None
+        self.newest = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unlink(self, key):
+        entry = self.entries.pop(key)
+        prev, next = entry[2], entry[3]
+        if prev is None:
+            self.oldest = next
+        else:
+            self.entries[prev][3] = next
+        if next is None:
+            self.newest = prev
+        else:
+            self.entries[next][2] = prev
+        return entry
+
+    def _link(self, key, value, expiry):
+        self.entries[key] = [value, expiry, self.newest, None]
+        if self.newest is None:
+            self.oldest = key
+        else:
+            self.entries[self.newest][3] = key
+        self.newest = key
+
+    def _evict(self, key):
+        value = self._unlink(key)[0]
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            value, expiry = self._unlink(key)[:2]
+            if expiry is not None and self.utcnow() >= expiry:
+                self.misses += 1
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(key, value)
+                return default
+            self._link(key, value, expiry)
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def peek(self, key, default=None):
+        '''
+        Returns the value for a key without counting a hit or miss or
+        marking it as recently used, whether or not it has expired.
+        '''
+
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                return default
+            return self.entries[key][0]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expiry = None
+        if self.ttl is not None:
+            expiry = self.utcnow() + self.ttl
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._unlink(key)
+            self._link(key, value, expiry)
+            while len(self.entries) > self.maxsize:
+                self._evict(self.oldest)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._unlink(key)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.oldest = None
+            self.newest = None
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries)}
@@ -0,0 +1,231 @@
+import zlib
+
+# Key under which a handler can store, in the WSGI environment, a
+# string that uniquely identifies the body of its response, so that
+# the compressed form of that body can be cached.
+CACHE_KEY = 'twitblob.compression_cache_key'
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+ENCODINGS = ('gzip', 'deflate')
+
+def choose_encoding(accept_encoding):
+    '''
+    Picks the content-coding to use for a response, given the value of
+    the request's Accept-Encoding header.
+
+      >>> choose_encoding('gzip, deflate')
+      'gzip'
+      >>> choose_encoding('deflate;q=0.5, gzip;q=0')
+      'deflate'
+      >>> choose_encoding('*')
+      'gzip'
+      >>> choose_encoding('identity') is None
+      True
+    '''
+
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    for coding in ENCODINGS:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > 0:
+            return coding
+    return None
+
+def compressor(encoding):
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(6)
+
+def compress(body, encoding):
+    c = compressor(encoding)
+    return c.compress(body) + c.flush()
+
+def iter_compressed(result, encoding):
+    c = compressor(encoding)
+    try:
+        for chunk in result:
+            data = c.compress(chunk)
+            if data:
+                yield data
+        yield c.flush()
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+def add_vary(headers, field):
+    '''
+    Adds a field to the Vary header in a list of headers, creating it
+    if necessary.
+
+      >>> add_vary([('Vary', 'Origin')], 'Accept-Encoding')
+      [('Vary', 'Origin, Accept-Encoding')]
+      >>> add_vary([], 'Accept-Encoding')
+      [('Vary', 'Accept-Encoding')]
+    '''
+
+    result = []
+    added = False
+    for name, value in headers:
+        if name.lower() == 'vary':
+            fields = [f.strip().lower() for f in value.split(',')]
+            if field.lower() not in fields:
+                value = '%s, %s' % (value, field)
+            added = True
+        result.append((name, value))
+    if not added:
+        result.append(('Vary', field))
+    return result
+
+def encoded_etag(etag, encoding):
+    '''
+    Tags a compressed representation differently from the identity
+    one, as byte-for-byte they differ.
+
+      >>> encoded_etag('"5"', 'gzip')
+      '"5-gzip"'
+      >>> encoded_etag('W/"5"', 'deflate')
+      'W/"5-deflate"'
+    '''
+
+    return '%s-%s"' % (etag[:-1], encoding)
+
+def decoded_etags(if_none_match):
+    '''
+    Strips the encoding from the entity tags in an If-None-Match header,
+    so that handlers can compare them with the tags they send.
+
+      >>> decoded_etags('"5-gzip", W/"6-deflate", "7", *')
+      '"5", W/"6", "7", *'
+    '''
+
+    candidates = []
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        for encoding in ENCODINGS:
+            suffix = '-%s"' % encoding
+            if candidate.endswith(suffix):
+                candidate = candidate[:-len(suffix)] + '"'
+        candidates.append(candidate)
+    return ', '.join(candidates)
+
+def with_encoded_etag(headers, encoding):
+    etag = get_header(headers, 'ETag')
+    if etag is None:
+        return headers
+    return without_header(headers, 'ETag') + [('ETag',
+                                               encoded_etag(etag, encoding))]
+
+def get_header(headers, name):
+    for header, value in headers:
+        if header.lower() == name.lower():
+            return value
+    return None
+
+def without_header(headers, name):
+    return [(header, value) for header, value in headers
+            if header.lower() != name.lower()]
+
+def negotiate_encoding(func):
+    '''
+    Decorates a WSGI method so that its responses are compressed with
+    gzip or deflate when the client accepts it.
+
+    The decorated method's object must have a 'compress_min_size'
+    attribute; responses smaller than it are sent as-is, and if it's
+    None, nothing is compressed. Responses whose length isn't known in
+    advance are always compressed. If the object's 'compressed_cache'
+    attribute isn't None, it's used as an LRUCache of compressed
+    bodies for responses that set CACHE_KEY in their environment.
+
+    Compressed responses have their encoding added to their ETag, and
+    taken off again in If-None-Match before the method sees it.
+    '''
+
+    def wsgi_wrapper(self, environ, start_response):
+        if self.compress_min_size is None:
+            return func(self, environ, start_response)
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = decoded_etags(if_none_match)
+
+        response = []
+        body = []
+        def capture_start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return body.append
+
+        result = func(self, environ, capture_start_response)
+        status, headers = response
+
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+        etag = get_header(headers, 'ETag')
+        if status.startswith('304') and etag and encoding:
+            # The client's copy was compressed if the tag it sent was.
+            candidates = [candidate.strip()
+                          for candidate in if_none_match.split(',')]
+            if encoded_etag(etag, encoding) in candidates:
+                headers = add_vary(with_encoded_etag(headers, encoding),
+                                   'Accept-Encoding')
+
+        content_type = get_header(headers, 'Content-Type') or ''
+        if (not status.startswith('200') or
+            get_header(headers, 'Content-Encoding') or
+            not content_type.startswith(COMPRESSIBLE_TYPES)):
+            start_response(status, headers)
+            return body + list(result)
+
+        if not isinstance(result, list):
+            # This is a streamed response.
+            headers = add_vary(without_header(headers, 'Content-Length'),
+                               'Accept-Encoding')
+            if encoding is None:
+                start_response(status, headers)
+                return result
+            start_response(status,
+                           with_encoded_etag(headers, encoding) +
+                           [('Content-Encoding', encoding)])
+            return iter_compressed(result, encoding)
+
+        body = ''.join(body + result)
+        if len(body) < self.compress_min_size:
+            start_response(status, headers)
+            return [body]
+
+        headers = add_vary(headers, 'Accept-Encoding')
+        if encoding is None:
+            start_response(status, headers)
+            return [body]
+
+        cache = self.compressed_cache
+        key = environ.get(CACHE_KEY)
+        compressed = None
+        if cache is not None and key is not None:
+            compressed = cache.get((key, encoding))
+        if compressed is None:
+            compressed = compress(body, encoding)
+            if cache is not None and key is not None:
+                cache.put((key, encoding), compressed)
+
+        headers = with_encoded_etag(without_header(headers, 'Content-Length'),
+                                    encoding)
+        start_response(status,
+                       headers + [('Content-Encoding', encoding),
+                                  ('Content-Length', str(len(compressed)))])
+        return [compressed]
+
+    wsgi_wrapper.__name__ = func.__name__
+    return wsgi_wrapper
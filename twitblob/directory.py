@@ -0,0 +1,158 @@
+import bisect
+import datetime
+import hashlib
+import threading
+
+from twitblob import codec as json
+
+# By default, users added by other processes show up within a minute.
+DEFAULT_DIRECTORY_REFRESH = datetime.timedelta(seconds=60)
+
+def content_etag(body):
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+class UserDirectory(object):
+    '''
+    An in-memory copy of the screen names and user ids of everyone
+    with a blob, ordered by user id, so that listing them needs no
+    database access. It's updated as this process writes blobs, and
+    periodically re-read from storage to pick up users added by other
+    processes.
+
+      >>> from twitblob.storage import MemoryBackend
+      >>> b = MemoryBackend()
+      >>> b.replace_blob(2, 'jane', {})
+      1
+      >>> d = UserDirectory(b)
+      >>> d.saw(1, 'bob')
+      True
+      >>> [user['screen_name'] for user in d.users()]
+      ['bob', 'jane']
+      >>> [user['screen_name'] for user in d.users(after=1)]
+      ['jane']
+      >>> [user['user_id'] for user in json.loads(d.encode()[0])]
+      [1, 2]
+    '''
+
+    def __init__(self, storage, utcnow=datetime.datetime.utcnow,
+                 refresh_interval=DEFAULT_DIRECTORY_REFRESH):
+        self.storage = storage
+        self.utcnow = utcnow
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.user_ids = []
+        self.names = {}
+        self.json = None
+        self.etag = None
+        self.next_refresh = None
+        # Users seen while storage is being re-read, who may have been
+        # written too late to be in what's read.
+        self.seen_during_refresh = None
+
+    def refresh(self):
+        self.refresh_lock.acquire()
+        try:
+            self.__refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def __refresh(self):
+        now = self.utcnow()
+        self.lock.acquire()
+        try:
+            self.seen_during_refresh = []
+        finally:
+            self.lock.release()
+        try:
+            users = list(self.storage.iter_users())
+        except:
+            self.seen_during_refresh = None
+            raise
+        self.lock.acquire()
+        try:
+            self.user_ids = [user['user_id'] for user in users]
+            self.names = dict((user['user_id'], user['screen_name'])
+                              for user in users)
+            for user_id, screen_name in self.seen_during_refresh:
+                self.__add(user_id, screen_name)
+            self.seen_during_refresh = None
+            self.json = None
+            self.next_refresh = now + self.refresh_interval
+        finally:
+            self.lock.release()
+
+    def maybe_refresh(self):
+        if (self.next_refresh is not None and
+            self.utcnow() < self.next_refresh):
+            return
+        # Only one thread needs to refresh; the others carry on with
+        # the users they have, unless there aren't any yet.
+        if not self.refresh_lock.acquire(self.next_refresh is None):
+            return
+        try:
+            if (self.next_refresh is None or
+                self.utcnow() >= self.next_refresh):
+                self.__refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def saw(self, user_id, screen_name):
+        '''
+        Records that the given user has a blob, which is only news if
+        they're new or have changed their screen name. Returns whether
+        it was.
+        '''
+
+        self.maybe_refresh()
+        self.lock.acquire()
+        try:
+            if self.seen_during_refresh is not None:
+                self.seen_during_refresh.append((user_id, screen_name))
+            return self.__add(user_id, screen_name)
+        finally:
+            self.lock.release()
+
+    def __add(self, user_id, screen_name):
+        old_name = self.names.get(user_id)
+        if old_name == screen_name:
+            return False
+        if old_name is None:
+            bisect.insort(self.user_ids, user_id)
+        self.names[user_id] = screen_name
+        self.json = None
+        return True
+
+    def users(self, after=None, limit=None):
+        self.maybe_refresh()
+        self.lock.acquire()
+        try:
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(self.user_ids, after)
+            end = None
+            if limit:
+                end = start + limit
+            return [{'screen_name': self.names[user_id], 'user_id': user_id}
+                    for user_id in self.user_ids[start:end]]
+        finally:
+            self.lock.release()
+
+    def encode(self):
+        '''
+        Returns the encoded JSON of the whole directory and its entity
+        tag, which are only recomputed after it has changed.
+        '''
+
+        self.maybe_refresh()
+        self.lock.acquire()
+        try:
+            if self.json is None:
+                self.json = json.dumps([
+                    {'screen_name': self.names[user_id], 'user_id': user_id}
+                    for user_id in self.user_ids
+                    ])
+                self.etag = content_etag(self.json)
+            return self.json, self.etag
+        finally:
+            self.lock.release()
@@ -1,19 +1,118 @@
 import oauth2 as oauth
 from twitblob.api import TwitBlobApi
-from twitblob.mongo_storage import MongoStorage
+from twitblob.storage import MemoryBackend
+from twitblob.mongo_storage import MongoBackend
+from twitblob.sqlite_storage import SqliteBackend
+from twitblob.sharded_storage import ShardedBackend
+from twitblob.purge import HttpPurger, BackgroundPurger
 from twitblob.twitter_client import TwitterOauthClientApp
+from twitblob.async_http import AsyncHttpClient
+from twitblob.http_client import ConnectionPool, DEFAULT_CONNECT_TIMEOUT, \
+     DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES
 
-def make_wsgi_app(conn, db_name, consumer_key, consumer_secret, **kwargs):
-    db = conn[db_name]
+STORAGE_BACKENDS = ['mongo', 'sqlite', 'memory']
+
+def make_storage(storage, conn, db_name, shards=None, retired_shards=(),
+                 connect=None):
+    '''
+    Makes a storage backend. If shards are given, blobs and auth tokens
+    are spread across them, each being the name of a database or an
+    object with a 'db_name' and, for MongoDB, the 'host' and 'port' of
+    the server it's on; the connect function is called with these to
+    connect to servers other than conn's.
+    '''
+
+    if shards:
+        connections = {}
+
+        def make_shard(shard):
+            if not isinstance(shard, dict):
+                shard = {'db_name': shard}
+            shard_conn = conn
+            if storage == 'mongo' and ('host' in shard or 'port' in shard):
+                address = (shard.get('host'), shard.get('port'))
+                if address not in connections:
+                    connections[address] = connect(*address)
+                shard_conn = connections[address]
+            return make_storage(storage, shard_conn,
+                                shard.get('db_name', db_name))
+
+        return ShardedBackend([make_shard(shard) for shard in shards],
+                              [make_shard(shard) for shard in retired_shards])
+    if storage == 'mongo':
+        return MongoBackend(conn[db_name])
+    if storage == 'sqlite':
+        return SqliteBackend(db_name)
+    if storage == 'memory':
+        return MemoryBackend()
+    raise ValueError('unknown storage backend: %s' % storage)
+
+def make_read_replica(storage, conn, db_name, replica, connect=None):
+    '''
+    Makes a read-only storage backend for a replica of the database,
+    described like a shard. For MongoDB, it may also have a
+    'read_preference', such as 'secondary' or 'nearest', saying which
+    members of a replica set to read from; by default, secondaries are
+    preferred. If the storage is sharded, the replica is a list with
+    one entry per shard.
+    '''
+
+    if isinstance(replica, list):
+        return ShardedBackend([make_read_replica(storage, conn, db_name,
+                                                 shard, connect)
+                               for shard in replica])
+    if not isinstance(replica, dict):
+        replica = {'db_name': replica}
+    db_name = replica.get('db_name', db_name)
+    if storage == 'mongo':
+        from pymongo import ReadPreference
+        from pymongo.database import Database
+
+        if 'host' in replica or 'port' in replica:
+            conn = connect(replica.get('host'), replica.get('port'))
+        preference = getattr(ReadPreference, replica.get(
+            'read_preference', 'secondary_preferred'
+            ).upper())
+        return MongoBackend(Database(conn, db_name,
+                                     read_preference=preference),
+                            read_only=True)
+    return make_storage(storage, conn, db_name)
+
+def make_wsgi_app(conn, db_name, consumer_key, consumer_secret,
+                  storage='mongo',
+                  twitter_connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                  twitter_read_timeout=DEFAULT_READ_TIMEOUT,
+                  twitter_retries=DEFAULT_RETRIES,
+                  nonblocking_twitter=False, shards=None,
+                  retired_shards=(), connect=None, read_replica=None,
+                  purge_url=None, purge_headers=None, **kwargs):
+    backend = make_storage(storage, conn, db_name, shards, retired_shards,
+                           connect)
+    if read_replica is not None:
+        kwargs['read_replica'] = make_read_replica(storage, conn, db_name,
+                                                   read_replica, connect)
+    if purge_url is not None:
+        kwargs['purger'] = BackgroundPurger(
+            HttpPurger(purge_url, headers=purge_headers)
+            )
 
     consumer = oauth.Consumer(consumer_key, consumer_secret)
 
+    async_http = None
+    if nonblocking_twitter:
+        async_http = AsyncHttpClient(connect_timeout=twitter_connect_timeout,
+                                     read_timeout=twitter_read_timeout)
+
     twitter = TwitterOauthClientApp(
         consumer=consumer,
         oauth=oauth,
-        request_tokens=MongoStorage(db.twitter_oauth_request_tokens)
+        request_tokens=backend.request_tokens,
+        http=ConnectionPool(connect_timeout=twitter_connect_timeout,
+                            read_timeout=twitter_read_timeout),
+        retries=twitter_retries,
+        async_http=async_http
         )
 
-    api = TwitBlobApi(twitter=twitter, db=db, **kwargs)
+    api = TwitBlobApi(twitter=twitter, db=backend, **kwargs)
 
     return api.wsgi_app
@@ -0,0 +1,240 @@
+'''
+A durable queue of feedback messages, delivered by a pool of
+background threads so that posting feedback doesn't wait on however
+slow the delivery mechanism is.
+'''
+
+import os
+import logging
+import datetime
+import threading
+import weakref
+
+from twitblob.metrics import Histogram, format_labels
+
+DEFAULT_FEEDBACK_WORKERS = 2
+
+# Number of messages each worker claims at a time.
+DEFAULT_BATCH_SIZE = 10
+
+# Number of delivery attempts made before a message is dead-lettered.
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Delay before the first retry of a failed delivery, which doubles
+# with each further attempt.
+DEFAULT_RETRY_DELAY = datetime.timedelta(seconds=30)
+
+# Time a claimed message is hidden from other workers for. If its
+# worker dies before it's delivered, it's retried once this has
+# passed.
+DEFAULT_LEASE = datetime.timedelta(minutes=5)
+
+# Seconds an idle worker waits before checking the queue again, in
+# case another process has added to it.
+DEFAULT_POLL_INTERVAL = 1.0
+
+LATENCY_BUCKETS = [0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0,
+                   3600.0]
+
+log = logging.getLogger('twitblob.feedback')
+
+def seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def work(queue_ref):
+    # Workers only hold on to their queue while draining it, so that
+    # they stop once it's been thrown away, as it is when the app is
+    # reloaded.
+    while True:
+        queue = queue_ref()
+        if queue is None:
+            return
+        try:
+            claimed = queue.drain()
+        except Exception:
+            log.exception('draining the feedback queue failed')
+            claimed = 0
+        wakeup, poll_interval = queue.wakeup, queue.poll_interval
+        del queue
+        if not claimed:
+            wakeup.wait(poll_interval)
+            wakeup.clear()
+
+class FeedbackQueue(object):
+    '''
+    Queues feedback messages in storage and delivers them by calling
+    deliver(sender, message), retrying failed deliveries with
+    exponential backoff and setting aside those that fail too many
+    times. Messages are delivered at least once.
+
+      >>> from twitblob.storage import MemoryBackend
+      >>> now = [datetime.datetime(2010, 6, 17)]
+      >>> sent = []
+      >>> def deliver(sender, message):
+      ...     if message == 'bad':
+      ...         raise ValueError(message)
+      ...     sent.append((sender, message))
+      >>> q = FeedbackQueue(MemoryBackend(), deliver, workers=0,
+      ...                   max_attempts=2, utcnow=lambda: now[0])
+      >>> q.put('bob', 'o hai')
+      1
+      >>> q.put('bob', 'bad')
+      2
+      >>> q.drain()
+      2
+      >>> sent
+      [('bob', 'o hai')]
+      >>> now[0] += DEFAULT_RETRY_DELAY
+      >>> q.drain()
+      1
+      >>> [q.stats()[name] for name in ['queued', 'dead', 'delivered',
+      ...                               'retried', 'dead_lettered']]
+      [0, 1, 1, 1, 1]
+    '''
+
+    def __init__(self, storage, deliver, workers=DEFAULT_FEEDBACK_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY, lease=DEFAULT_LEASE,
+                 poll_interval=DEFAULT_POLL_INTERVAL,
+                 utcnow=datetime.datetime.utcnow):
+        self.storage = storage
+        self.deliver = deliver
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.utcnow = utcnow
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.started_in = None
+        self.delivered = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+
+    def start(self):
+        # Threads don't survive a fork, so workers are started in
+        # whichever process first uses the queue.
+        if not self.workers or self.started_in == os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            if self.started_in == os.getpid():
+                return
+            self.started_in = os.getpid()
+            for i in range(self.workers):
+                thread = threading.Thread(target=work,
+                                          args=(weakref.ref(self),))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self.lock.release()
+
+    def put(self, sender, message):
+        '''
+        Queues a message for delivery and returns its id.
+        '''
+
+        feedback_id = self.storage.enqueue_feedback(sender, message,
+                                                    self.utcnow())
+        self.start()
+        self.wakeup.set()
+        return feedback_id
+
+    def count(self, name, latency=None):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+            if latency is not None:
+                self.latency.observe(latency)
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        '''
+        Claims a batch of messages that are due for delivery and
+        delivers them, returning the number claimed.
+        '''
+
+        now = self.utcnow()
+        batch = self.storage.claim_feedback(now, now + self.lease,
+                                            self.batch_size)
+        for item in batch:
+            self.attempt(item)
+        return len(batch)
+
+    def attempt(self, item):
+        try:
+            self.deliver(sender=item['sender'], message=item['message'])
+        except Exception, e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+            if item['attempts'] >= self.max_attempts:
+                self.storage.dead_letter_feedback(item['id'], error)
+                log.error('gave up delivering feedback %s from %s after '
+                          '%d attempts: %s', item['id'], item['sender'],
+                          item['attempts'], error)
+                self.count('dead_lettered')
+            else:
+                delay = self.retry_delay * 2 ** (item['attempts'] - 1)
+                self.storage.retry_feedback(item['id'],
+                                            self.utcnow() + delay, error)
+                log.warning('delivering feedback %s from %s failed, '
+                            'retrying in %s: %s', item['id'],
+                            item['sender'], delay, error)
+                self.count('retried')
+            return
+        self.storage.finish_feedback(item['id'])
+        self.count('delivered',
+                   seconds(self.utcnow() - item['enqueued']))
+
+    def stats(self):
+        '''
+        Returns the number of messages queued and dead-lettered, the
+        age in seconds of the oldest queued one, and the number of
+        deliveries, retries and dead-letterings made by this process.
+        '''
+
+        stats = self.storage.feedback_stats()
+        oldest = stats.pop('oldest')
+        stats['oldest_age'] = 0
+        if oldest is not None:
+            stats['oldest_age'] = max(0, seconds(self.utcnow() - oldest))
+        self.lock.acquire()
+        try:
+            stats.update(delivered=self.delivered, retried=self.retried,
+                         dead_lettered=self.dead_lettered)
+        finally:
+            self.lock.release()
+        return stats
+
+    def render_metrics(self):
+        '''
+        Renders the queue's statistics in the Prometheus text
+        exposition format.
+        '''
+
+        stats = self.stats()
+        lines = []
+        for name, key in [('twitblob_feedback_queued', 'queued'),
+                          ('twitblob_feedback_dead', 'dead'),
+                          ('twitblob_feedback_oldest_age_seconds',
+                           'oldest_age')]:
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %s' % (name, stats[key]))
+        lines.append('# TYPE twitblob_feedback_deliveries_total counter')
+        for outcome in ['delivered', 'retried', 'dead_lettered']:
+            lines.append('twitblob_feedback_deliveries_total%s %d' % (
+                format_labels([('outcome', outcome)]), stats[outcome]
+                ))
+        lines.append('# TYPE twitblob_feedback_latency_seconds histogram')
+        self.lock.acquire()
+        try:
+            lines.extend(self.latency.lines(
+                'twitblob_feedback_latency_seconds', []
+                ))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
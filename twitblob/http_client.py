@@ -0,0 +1,268 @@
+import time
+import socket
+import httplib
+import threading
+from urlparse import urlparse
+
+# Seconds allowed for establishing a connection to an upstream
+# server, and for each read from it once connected.
+DEFAULT_CONNECT_TIMEOUT = 5
+
+DEFAULT_READ_TIMEOUT = 10
+
+# Maximum number of idle connections kept open to each server.
+DEFAULT_MAX_IDLE = 10
+
+DEFAULT_RETRIES = 2
+
+# Seconds waited before the first retry; each further retry waits
+# twice as long as the last.
+DEFAULT_BACKOFF = 0.25
+
+class UpstreamError(Exception):
+    '''
+    Raised when an upstream server can't be reached or returns an
+    unexpected response.
+    '''
+
+    status = '502 Bad Gateway'
+
+class UpstreamTimeout(UpstreamError):
+    '''
+    Raised when an upstream server takes too long to respond.
+    '''
+
+    status = '504 Gateway Timeout'
+
+class ConnectFailed(socket.error):
+    '''
+    Raised by ConnectionPool when a connection to a server can't be
+    made, so that the request was certainly never sent.
+    '''
+
+    def __init__(self, error):
+        socket.error.__init__(self, str(error))
+        self.timed_out = isinstance(error, socket.timeout)
+
+class ConnectionPool(object):
+    '''
+    Makes HTTP and HTTPS requests, keeping connections alive between
+    them so that repeated requests to a server don't pay for a new TCP
+    connection and TLS handshake every time. It can be shared between
+    threads.
+    '''
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port,
+                                           timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port,
+                                          timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except socket.error, e:
+            raise ConnectFailed(e)
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def checkout(self, key):
+        self.lock.acquire()
+        try:
+            if self.idle.get(key):
+                return self.idle[key].pop()
+        finally:
+            self.lock.release()
+        return None
+
+    def checkin(self, key, conn):
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def request(self, url, method='GET', body=None, headers=None,
+                idempotent=True):
+        '''
+        Returns the status code and body of the response to the given
+        request, raising socket or httplib errors if it fails, or
+        ConnectFailed if it couldn't be sent at all. Requests that fail
+        on a kept-alive connection are sent again on a new one, unless
+        they aren't idempotent and got as far as being sent.
+        '''
+
+        parts = urlparse(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn = self.checkout(key)
+        if conn is not None:
+            sent = False
+            try:
+                self.send(conn, method, path, body, headers)
+                sent = True
+                return self.receive(key, conn)
+            except socket.timeout:
+                raise
+            except (socket.error, httplib.HTTPException):
+                # The server may have closed the idle connection, so
+                # try again with a new one, unless the request may have
+                # been acted on and can't safely be made twice.
+                if sent and not idempotent:
+                    raise
+        conn = self.connect(key)
+        self.send(conn, method, path, body, headers)
+        return self.receive(key, conn)
+
+    def send(self, conn, method, path, body, headers):
+        try:
+            conn.request(method, path, body, headers or {})
+        except:
+            conn.close()
+            raise
+
+    def receive(self, key, conn):
+        try:
+            response = conn.getresponse()
+            content = response.read()
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.checkin(key, conn)
+        return response.status, content
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+        finally:
+            self.lock.release()
+
+class Attempts(object):
+    '''
+    Decides whether a failed request is tried again, and after how
+    long, independently of how it's made, so that blocking and
+    non-blocking clients retry alike.
+
+    If prepare is given, it's called before every attempt and returns
+    the url, body and headers to send, so that each one can be signed
+    afresh. Requests that aren't idempotent are only retried if they
+    couldn't be sent at all, since the server may have acted on them.
+
+      >>> a = Attempts('http://x/', retries=1, backoff=1)
+      >>> a.next()
+      ('http://x/', None, None)
+      >>> a.bad_status(503)
+      1
+      >>> a.next()
+      ('http://x/', None, None)
+      >>> a.bad_status(503)
+      Traceback (most recent call last):
+      ...
+      UpstreamError: http://x/ returned status 503
+    '''
+
+    def __init__(self, url, body=None, headers=None, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, prepare=None, idempotent=True):
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.retries = retries
+        self.backoff = backoff
+        self.prepare = prepare
+        self.idempotent = idempotent
+        self.attempt = 0
+
+    def next(self):
+        '''
+        Returns the url, body and headers to send in the next attempt.
+        '''
+
+        if self.prepare is not None:
+            self.url, self.body, self.headers = self.prepare()
+        return self.url, self.body, self.headers
+
+    def bad_status(self, status):
+        '''
+        Returns the number of seconds to wait before trying again after
+        the server returned a status other than 200, or raises
+        UpstreamError if the request shouldn't be tried again.
+        '''
+
+        error = UpstreamError('%s returned status %d' % (self.url, status))
+        return self.retry(error, self.idempotent and status >= 500)
+
+    def failed(self, e):
+        '''
+        Returns the number of seconds to wait before trying again after
+        the request failed with the given socket or httplib error, or
+        raises UpstreamError or UpstreamTimeout if it shouldn't be tried
+        again.
+        '''
+
+        retry = self.idempotent
+        if isinstance(e, ConnectFailed):
+            if e.timed_out:
+                error = UpstreamTimeout('%s timed out' % self.url)
+            else:
+                error = UpstreamError('%s failed: %s' % (self.url, e))
+            retry = True
+        elif isinstance(e, socket.timeout):
+            error = UpstreamTimeout('%s timed out' % self.url)
+        else:
+            error = UpstreamError('%s failed: %s' % (self.url, e))
+        return self.retry(error, retry)
+
+    def retry(self, error, retry):
+        if not retry or self.attempt >= self.retries:
+            raise error
+        delay = self.backoff * 2 ** self.attempt
+        self.attempt += 1
+        return delay
+
+def request_with_retries(pool, url, method='GET', body=None, headers=None,
+                         retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                         sleep=time.sleep, prepare=None, idempotent=True):
+    '''
+    Makes a request with the given ConnectionPool, retrying it as
+    Attempts decides if it fails or the server returns a 5xx status.
+    Returns the body of a 200 response, or raises UpstreamError or
+    UpstreamTimeout.
+    '''
+
+    attempts = Attempts(url, body, headers, retries, backoff, prepare,
+                        idempotent)
+    while True:
+        url, body, headers = attempts.next()
+        try:
+            status, content = pool.request(url, method, body, headers,
+                                           idempotent)
+        except (socket.error, httplib.HTTPException), e:
+            delay = attempts.failed(e)
+        else:
+            if status == 200:
+                return content
+            delay = attempts.bad_status(status)
+        sleep(delay)
@@ -0,0 +1,401 @@
+import copy
+import time
+import types
+import logging
+import threading
+from cgi import parse_qsl
+
+from twitblob.routes import route
+from twitblob.storage import Backend
+from twitblob.sharded_storage import ShardedBackend
+from twitblob.workers import Deferred
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0]
+
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000]
+
+STORAGE_CALL_BUCKETS = [0, 1, 2, 3, 5, 10, 25, 100]
+
+logger = logging.getLogger('twitblob.metrics')
+
+# Key of the WSGI environment under which a deferred request's stats
+# are kept until it's resumed.
+SUSPENDED_KEY = 'twitblob.metrics_request'
+
+def route_name(path, qargs):
+    '''
+    Classifies a request path into one of a small number of routes,
+    splitting lookups of several blobs by what they're looked up by.
+
+      >>> route_name('/blobs/bob', {})
+      'blob'
+      >>> route_name('/blobs/', {'ids': '1,2'})
+      'blobs_ids'
+      >>> route_name('/login/callback', {})
+      'login'
+      >>> route_name('/wp-admin/', {})
+      'other'
+    '''
+
+    resource = route(path)[0]
+    if resource is None:
+        return 'other'
+    if resource == 'blobs':
+        for arg in ['ids', 'names']:
+            if arg in qargs:
+                return 'blobs_%s' % arg
+    return resource
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', ''))
+                             for name, value in labels)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield '%s_bucket%s %d' % (name,
+                                      format_labels(labels + [('le', bound)]),
+                                      count)
+        yield '%s_bucket%s %d' % (name, format_labels(labels + [('le',
+                                                                 '+Inf')]),
+                                  self.count)
+        yield '%s_sum%s %s' % (name, format_labels(labels), self.sum)
+        yield '%s_count%s %d' % (name, format_labels(labels), self.count)
+
+class Metrics(object):
+    '''
+    Collects per-route request statistics and storage call statistics,
+    and renders them in the Prometheus text exposition format.
+
+      >>> m = Metrics()
+      >>> m.begin_request()
+      >>> m.record_storage_call('find_blob', 0.002)
+      >>> m.end_request('blob', 'GET', '200 OK', 0.01, 15)
+      >>> print m.render() # doctest: +ELLIPSIS
+      # TYPE twitblob_requests_total counter
+      twitblob_requests_total{route="blob",method="GET",status="200"} 1
+      ...
+      twitblob_storage_operations_total{operation="find_blob"} 1
+      ...
+    '''
+
+    def __init__(self, slow_request_threshold=None):
+        self.slow_request_threshold = slow_request_threshold
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.requests = {}
+        self.latencies = {}
+        self.sizes = {}
+        self.request_storage_calls = {}
+        self.storage_calls = {}
+        self.storage_seconds = {}
+        self.slow_requests = 0
+
+    def begin_request(self):
+        # A request's storage calls may be made from other threads, so
+        # they're counted in an object those threads can be given.
+        self.local.request = {'storage_calls': 0, 'storage_seconds': 0.0}
+
+    def suspend_request(self):
+        # Sets aside the current request's stats while it's deferred,
+        # returning them to be given back to resume_request().
+        request = getattr(self.local, 'request', None)
+        self.local.request = None
+        return request
+
+    def resume_request(self, request):
+        self.local.request = request
+
+    def carry(self, func):
+        '''
+        Returns a function that calls func with the storage calls it
+        makes counted toward the current request, even if it's called
+        from another thread.
+        '''
+
+        request = getattr(self.local, 'request', None)
+        def carried(*args, **kwargs):
+            previous = getattr(self.local, 'request', None)
+            self.local.request = request
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.request = previous
+        return carried
+
+    def record_storage_call(self, operation, seconds, per_request=True):
+        request = getattr(self.local, 'request', None)
+        self.lock.acquire()
+        try:
+            if per_request and request is not None:
+                request['storage_calls'] += 1
+                request['storage_seconds'] += seconds
+            self.storage_calls[operation] = (
+                self.storage_calls.get(operation, 0) + 1
+                )
+            self.storage_seconds[operation] = (
+                self.storage_seconds.get(operation, 0.0) + seconds
+                )
+        finally:
+            self.lock.release()
+
+    def end_request(self, route, method, status, seconds, size, path=None):
+        request = getattr(self.local, 'request', None) or {}
+        self.local.request = None
+        code = status.split()[0]
+        self.lock.acquire()
+        try:
+            storage_calls = request.get('storage_calls', 0)
+            storage_seconds = request.get('storage_seconds', 0.0)
+            key = (route, method, code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for histograms, buckets, value in [
+                (self.latencies, LATENCY_BUCKETS, seconds),
+                (self.sizes, SIZE_BUCKETS, size),
+                (self.request_storage_calls, STORAGE_CALL_BUCKETS,
+                 storage_calls)
+                ]:
+                if route not in histograms:
+                    histograms[route] = Histogram(buckets)
+                histograms[route].observe(value)
+            slow = (self.slow_request_threshold is not None and
+                    seconds >= self.slow_request_threshold)
+            if slow:
+                self.slow_requests += 1
+        finally:
+            self.lock.release()
+        if slow:
+            logger.warning('slow request: %s %s -> %s in %.3fs '
+                           '(%d storage calls, %.3fs)', method,
+                           path or route, code, seconds, storage_calls,
+                           storage_seconds)
+
+    def render(self):
+        self.lock.acquire()
+        try:
+            lines = ['# TYPE twitblob_requests_total counter']
+            for key in sorted(self.requests):
+                route, method, code = key
+                lines.append('twitblob_requests_total%s %d' % (
+                    format_labels([('route', route), ('method', method),
+                                   ('status', code)]),
+                    self.requests[key]
+                    ))
+            for name, histograms in [
+                ('twitblob_request_duration_seconds', self.latencies),
+                ('twitblob_response_size_bytes', self.sizes),
+                ('twitblob_request_storage_operations',
+                 self.request_storage_calls)
+                ]:
+                lines.append('# TYPE %s histogram' % name)
+                for route in sorted(histograms):
+                    lines.extend(histograms[route].lines(
+                        name, [('route', route)]
+                        ))
+            lines.append('# TYPE twitblob_storage_operations_total counter')
+            for operation in sorted(self.storage_calls):
+                lines.append('twitblob_storage_operations_total%s %d' % (
+                    format_labels([('operation', operation)]),
+                    self.storage_calls[operation]
+                    ))
+            lines.append('# TYPE twitblob_storage_seconds_total counter')
+            for operation in sorted(self.storage_seconds):
+                lines.append('twitblob_storage_seconds_total%s %s' % (
+                    format_labels([('operation', operation)]),
+                    self.storage_seconds[operation]
+                    ))
+            lines.append('# TYPE twitblob_slow_requests_total counter')
+            lines.append('twitblob_slow_requests_total %d' %
+                         self.slow_requests)
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+def timed(metrics, operation, method, per_request=True):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+        except:
+            metrics.record_storage_call(operation, time.time() - start,
+                                        per_request)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return timed_iter(metrics, operation, result,
+                              time.time() - start, per_request)
+        metrics.record_storage_call(operation, time.time() - start,
+                                    per_request)
+        return result
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+def timed_iter(metrics, operation, items, seconds, per_request):
+    # Generators only query storage as they're consumed, so the call
+    # is recorded once they're finished with, timing just the work
+    # done inside them.
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = items.next()
+            except StopIteration:
+                return
+            finally:
+                seconds += time.time() - start
+            yield item
+    finally:
+        items.close()
+        metrics.record_storage_call(operation, seconds, per_request)
+
+class InstrumentedRequestTokens(object):
+    def __init__(self, request_tokens, metrics):
+        self.request_tokens = request_tokens
+        for name in ['__contains__', '__getitem__', '__setitem__',
+                     '__delitem__', 'pop']:
+            setattr(self, name.strip('_'),
+                    timed(metrics, 'request_tokens.%s' % name.strip('_'),
+                          getattr(request_tokens, name)))
+
+    def __contains__(self, name):
+        return self.contains(name)
+
+    def __getitem__(self, name):
+        return self.getitem(name)
+
+    def __setitem__(self, name, value):
+        self.setitem(name, value)
+
+    def __delitem__(self, name):
+        self.delitem(name)
+
+class InstrumentedStorage(Backend):
+    '''
+    Wraps a storage backend, recording the number and duration of the
+    calls made to it.
+
+    The shards of a sharded backend are wrapped too, since they're
+    what's actually queried, and it's their calls, made from a pool of
+    threads, that count toward each request.
+    '''
+
+    def __init__(self, backend, metrics, prefix=''):
+        self.backend = backend
+        self.request_tokens = InstrumentedRequestTokens(
+            backend.request_tokens, metrics
+            )
+        per_request = True
+        if isinstance(backend, ShardedBackend):
+            backend = instrument_shards(backend, metrics)
+            per_request = False
+        for name in dir(Backend):
+            if not name.startswith('_'):
+                setattr(self, name, timed(metrics, prefix + name,
+                                          getattr(backend, name),
+                                          per_request))
+
+def instrument_shards(backend, metrics):
+    # A copy is instrumented, so that the backend itself is left as
+    # it was, while the two share their cache of which shard holds
+    # each screen name.
+    sharded = copy.copy(backend)
+    sharded.shards = [InstrumentedStorage(shard, metrics, 'shard.')
+                      for shard in backend.shards]
+    sharded.retired = [InstrumentedStorage(shard, metrics, 'shard.')
+                       for shard in backend.retired]
+    sharded.map = lambda func, items: backend.map(metrics.carry(func), items)
+    return sharded
+
+class CountingIterable(object):
+    '''
+    Passes on a streamed response, counting its size, and records the
+    request once the server closes it, whether or not it was read.
+    '''
+
+    def __init__(self, result, finish):
+        self.result = result
+        self.finish = finish
+        self.size = 0
+        self.finished = False
+
+    def __iter__(self):
+        for chunk in self.result:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            if not self.finished:
+                self.finished = True
+                self.finish(self.size)
+
+def instrumented(func):
+    '''
+    Decorates a WSGI method so that the requests it serves are recorded
+    by the Metrics instance in its object's 'metrics' attribute, if
+    that isn't None.
+    '''
+
+    def wsgi_wrapper(self, environ, start_response):
+        metrics = self.metrics
+        if metrics is None:
+            return func(self, environ, start_response)
+
+        path = environ['PATH_INFO']
+        route = route_name(path, dict(parse_qsl(environ.get('QUERY_STRING',
+                                                            ''))))
+        method = environ['REQUEST_METHOD']
+        status = []
+        def new_start_response(s, headers, exc_info=None):
+            status[:] = [s]
+            return start_response(s, headers)
+
+        def finish(size):
+            metrics.end_request(route, method, status and status[0] or '500',
+                                time.time() - start, size, path)
+
+        # A deferred request is counted once, when it's finished, from
+        # when it first started.
+        suspended = environ.pop(SUSPENDED_KEY, None)
+        if suspended is None:
+            metrics.begin_request()
+            start = time.time()
+        else:
+            request, start = suspended
+            metrics.resume_request(request)
+        try:
+            result = func(self, environ, new_start_response)
+        except Deferred:
+            environ[SUSPENDED_KEY] = (metrics.suspend_request(), start)
+            raise
+        except:
+            status[:] = ['500 Internal Server Error']
+            finish(0)
+            raise
+
+        if isinstance(result, list):
+            finish(sum(len(chunk) for chunk in result))
+            return result
+
+        return CountingIterable(result, finish)
+
+    wsgi_wrapper.__name__ = func.__name__
+    return wsgi_wrapper
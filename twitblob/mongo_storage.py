@@ -1,5 +1,11 @@
 import datetime
 
+from bson.objectid import ObjectId
+from pymongo import ReadPreference
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from twitblob.storage import Backend, DuplicateToken, FEEDBACK_KEYS
+
 class MongoStorage(object):
     '''
     Note that this example code assumes a MongoDB server is active on
@@ -22,25 +28,40 @@ class MongoStorage(object):
       >>> del s['blah']
       >>> 'blah' in s
       False
+
+      >>> s['blah'] = {'foo': 2}
+      >>> s.pop('blah')
+      {u'foo': 2}
+      >>> s.pop('blah', None)
     '''
 
-    def __init__(self, collection):
+    def __init__(self, collection, read_only=False):
         self.collection = collection
-        self.collection.ensure_index('name')
+        if not read_only:
+            ensure_index(self.collection, 'name', unique=True)
 
     def __contains__(self, name):
-        doc = self.collection.find_one({'name': name})
+        doc = self.collection.find_one({'name': name}, fields=['_id'])
         return (doc is not None)
 
     def __delitem__(self, name):
-        if not name in self:
+        if not self.collection.remove({'name': name}, safe=True)['n']:
             raise KeyError(name)
-        self.collection.remove({'name': name})
 
     def __getitem__(self, name):
-        if not name in self:
+        doc = self.collection.find_one({'name': name}, fields=['value'])
+        if doc is None:
             raise KeyError(name)
-        return self.collection.find_one({'name': name})['value']
+        return doc['value']
+
+    def pop(self, name, *default):
+        doc = self.collection.find_and_modify({'name': name}, remove=True,
+                                              fields=['value'])
+        if doc is None:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        return doc['value']
 
     def __setitem__(self, name, value):
         self.collection.update({'name': name},
@@ -48,3 +69,328 @@ class MongoStorage(object):
                                 'value': value,
                                 'date': datetime.datetime.utcnow()},
                                upsert=True)
+
+class MongoBackend(Backend):
+    '''
+    A storage backend that keeps everything in a MongoDB database. A
+    read-only backend, such as one reading from secondaries, leaves the
+    database's indexes alone.
+    '''
+
+    def __init__(self, db, read_only=False):
+        self.db = db
+        if not read_only:
+            self.db.blobs.ensure_index('screen_name')
+            # Each user has one blob, which lets a write that's only
+            # meant to create a blob fail if another got there first.
+            ensure_index(self.db.blobs, 'user_id', unique=True)
+            ensure_index(self.db.auth_tokens, 'id', unique=True)
+            # Revocations are removed by MongoDB once they've expired.
+            ensure_index(self.db.revoked_tokens, 'expires',
+                         expireAfterSeconds=0)
+            self.db.feedback_queue.ensure_index([('dead', 1),
+                                                 ('available', 1)])
+        self.request_tokens = MongoStorage(db.twitter_oauth_request_tokens,
+                                           read_only)
+
+    def find_blob(self, screen_name, without_data=False):
+        fields = None
+        if without_data:
+            fields = {'_id': False, 'data': False}
+        blob = self.db.blobs.find_one({'screen_name': screen_name},
+                                      fields=fields)
+        return blob_doc(blob, without_data)
+
+    def find_blob_version(self, screen_name):
+        blob = self.db.blobs.find_one({'screen_name': screen_name},
+                                      fields=['version'])
+        if blob is None:
+            return None
+        return blob.get('version', 0)
+
+    def find_blobs(self, key, values):
+        for blob in self.db.blobs.find({key: {'$in': values}},
+                                       fields=BLOB_FIELDS):
+            yield blob_doc(blob)
+
+    def iter_users(self, after=None, limit=None):
+        query = {}
+        if after is not None:
+            query['user_id'] = {'$gt': after}
+        cursor = self.db.blobs.find(query, fields=['screen_name', 'user_id'])
+        cursor = cursor.sort('user_id')
+        if limit:
+            cursor = cursor.limit(limit)
+        for blob in cursor:
+            yield {'screen_name': blob['screen_name'],
+                   'user_id': blob['user_id']}
+
+    def iter_blobs_without_json(self):
+        for blob in self.db.blobs.find({'json': {'$exists': False}},
+                                       fields=BLOB_FIELDS):
+            yield blob_doc(blob)
+
+    def iter_blobs(self, after=None, limit=None, until=None):
+        query = {}
+        if after is not None:
+            query['user_id'] = {'$gt': after}
+        if until is not None:
+            query.setdefault('user_id', {})['$lte'] = until
+        cursor = self.db.blobs.find(query, fields={'_id': False})
+        cursor = cursor.sort('user_id')
+        if limit:
+            cursor = cursor.limit(limit)
+        for blob in cursor:
+            yield blob_doc(blob)
+
+    def user_id_range(self):
+        ends = []
+        for direction in [1, -1]:
+            blob = self.db.blobs.find_one(sort=[('user_id', direction)],
+                                          fields=['user_id'])
+            if blob is None:
+                return None
+            ends.append(blob['user_id'])
+        return tuple(ends)
+
+    def restore_blob(self, blob):
+        self.db.blobs.update({'user_id': blob['user_id']}, dict(blob),
+                             upsert=True, safe=True)
+
+    def restore_blobs(self, blobs):
+        blobs = list(blobs)
+        if not blobs:
+            return
+        bulk = self.db.blobs.initialize_unordered_bulk_op()
+        for blob in blobs:
+            bulk.find({'user_id': blob['user_id']}).upsert().replace_one(
+                dict(blob)
+                )
+        bulk.execute()
+
+    def remove_blob(self, user_id):
+        self.db.blobs.remove({'user_id': user_id}, safe=True)
+
+    def merge_blob(self, user_id, screen_name, data, fetch_data=False):
+        changes = {'screen_name': screen_name, 'user_id': user_id}
+        for name in data:
+            changes['data.%s' % name] = data[name]
+        update = {'$set': changes, '$inc': {'version': 1},
+                  '$unset': {'json': 1}}
+        fields = ['version']
+        if fetch_data:
+            fields.append('data')
+        blob = self.__upsert_blob({'user_id': user_id}, update, fields)
+        result = {'version': blob['version']}
+        if fetch_data:
+            result['data'] = blob.get('data', {})
+        return result
+
+    def replace_blob(self, user_id, screen_name, data, json=None,
+                     if_version=None):
+        blob = {'screen_name': screen_name,
+                'user_id': user_id,
+                'data': data}
+        update = {'$set': blob, '$inc': {'version': 1}}
+        if json is None:
+            update['$unset'] = {'json': 1}
+        else:
+            blob['json'] = json
+        query = {'user_id': user_id}
+        if if_version == 0:
+            # If the user already has a versioned blob, the upsert
+            # tries to insert another and the unique index on user ids
+            # stops it. Blobs stored before versioning was introduced
+            # have no version field at all.
+            query['version'] = {'$in': [None, 0]}
+            try:
+                result = self.db.blobs.find_and_modify(query, update,
+                                                       upsert=True, new=True,
+                                                       fields=['version'])
+            except DuplicateKeyError:
+                return None
+        elif if_version is not None:
+            query['version'] = if_version
+            result = self.db.blobs.find_and_modify(query, update, new=True,
+                                                   fields=['version'])
+        else:
+            result = self.__upsert_blob(query, update, ['version'])
+        if result is None:
+            return None
+        return result['version']
+
+    def __upsert_blob(self, query, update, fields):
+        try:
+            return self.db.blobs.find_and_modify(query, update, upsert=True,
+                                                 new=True, fields=fields)
+        except DuplicateKeyError:
+            # Another write created the blob after this one looked for
+            # it, so it's there to update now.
+            return self.db.blobs.find_and_modify(query, update, new=True,
+                                                 fields=fields)
+
+    def set_blob_json(self, user_id, version, json):
+        query = {'user_id': user_id, 'version': version}
+        if not version:
+            # Blobs stored before versioning was introduced have no
+            # version field at all.
+            query['version'] = {'$in': [None, 0]}
+        self.db.blobs.update(query, {'$set': {'json': json}})
+
+    def insert_token(self, token):
+        try:
+            self.db.auth_tokens.insert(dict(token), safe=True)
+        except DuplicateKeyError:
+            raise DuplicateToken(token['id'])
+
+    def find_token(self, token_id):
+        return self.db.auth_tokens.find_one({'id': token_id},
+                                            fields={'_id': False})
+
+    def remove_token(self, token_id):
+        self.db.auth_tokens.remove({'id': token_id})
+
+    def iter_tokens(self):
+        return self.db.auth_tokens.find(fields={'_id': False})
+
+    def insert_revocation(self, nonce, expires):
+        self.db.revoked_tokens.insert({'nonce': nonce, 'expires': expires})
+
+    def find_revocations(self, now):
+        for doc in self.db.revoked_tokens.find({'expires': {'$gt': now}},
+                                               fields=['nonce', 'expires']):
+            yield (doc['nonce'], doc['expires'])
+
+    def expire_tokens(self, token_lifetime, request_token_lifetime):
+        # MongoDB removes documents from a collection with a TTL index
+        # once the date in the indexed field is older than the index's
+        # lifetime.
+        for collection, lifetime in [
+            (self.db.auth_tokens, token_lifetime),
+            (self.request_tokens.collection, request_token_lifetime)
+            ]:
+            ensure_index(collection, 'date', expireAfterSeconds=(
+                lifetime.days * 86400 + lifetime.seconds
+                ))
+        return True
+
+    def remove_expired_tokens(self, tokens_before, request_tokens_before,
+                              revocations_before):
+        removed = 0
+        for collection, query in [
+            (self.db.auth_tokens, {'date': {'$lt': tokens_before}}),
+            (self.request_tokens.collection,
+             {'date': {'$lt': request_tokens_before}}),
+            (self.db.revoked_tokens, {'expires': {'$lt': revocations_before}})
+            ]:
+            removed += collection.remove(query, safe=True)['n']
+        return removed
+
+    def enqueue_feedback(self, sender, message, now):
+        feedback_id = self.db.feedback_queue.insert({
+            'sender': sender, 'message': message, 'enqueued': now,
+            'available': now, 'attempts': 0, 'dead': False
+            }, safe=True)
+        return str(feedback_id)
+
+    def claim_feedback(self, now, lease_until, limit):
+        # Each message is claimed atomically, so that no two workers
+        # can claim the same one.
+        claimed = []
+        while len(claimed) < limit:
+            item = self.db.feedback_queue.find_and_modify(
+                {'dead': False, 'available': {'$lte': now}},
+                {'$set': {'available': lease_until}, '$inc': {'attempts': 1}},
+                sort=[('_id', 1)], new=True
+                )
+            if item is None:
+                break
+            item['id'] = str(item['_id'])
+            claimed.append(dict((key, item[key]) for key in FEEDBACK_KEYS))
+        return claimed
+
+    def finish_feedback(self, feedback_id):
+        self.db.feedback_queue.remove({'_id': ObjectId(feedback_id)},
+                                      safe=True)
+
+    def retry_feedback(self, feedback_id, available, error):
+        self.db.feedback_queue.update(
+            {'_id': ObjectId(feedback_id)},
+            {'$set': {'available': available, 'error': error}},
+            safe=True
+            )
+
+    def dead_letter_feedback(self, feedback_id, error):
+        self.db.feedback_queue.update(
+            {'_id': ObjectId(feedback_id)},
+            {'$set': {'dead': True, 'error': error}},
+            safe=True
+            )
+
+    def requeue_dead_feedback(self, now):
+        return self.db.feedback_queue.update(
+            {'dead': True},
+            {'$set': {'dead': False, 'available': now, 'attempts': 0}},
+            multi=True, safe=True
+            )['n']
+
+    def feedback_stats(self):
+        oldest = self.db.feedback_queue.find_one({'dead': False},
+                                                 fields=['enqueued'],
+                                                 sort=[('_id', 1)])
+        queue = self.db.feedback_queue
+        return {'queued': queue.find({'dead': False}).count(),
+                'dead': queue.find({'dead': True}).count(),
+                'oldest': oldest and oldest['enqueued']}
+
+    def replication_lag(self):
+        # Reads may be served by any secondary, so the lag is that of
+        # the one furthest behind the primary.
+        try:
+            status = self.db.connection.admin.command(
+                'replSetGetStatus',
+                read_preference=ReadPreference.PRIMARY_PREFERRED
+                )
+        except OperationFailure:
+            # Not a replica set, so there's nothing to lag behind.
+            return datetime.timedelta(0)
+        optimes = {'PRIMARY': [], 'SECONDARY': []}
+        for member in status['members']:
+            if member['stateStr'] in optimes:
+                optimes[member['stateStr']].append(member['optimeDate'])
+        if not optimes['PRIMARY']:
+            return None
+        return optimes['PRIMARY'][0] - min(optimes['PRIMARY'] +
+                                           optimes['SECONDARY'])
+
+# Error code for an index that already exists with different options.
+INDEX_OPTIONS_CONFLICT = 85
+
+def ensure_index(collection, key, **options):
+    try:
+        collection.ensure_index(key, **options)
+    except OperationFailure, e:
+        # A TTL index whose lifetime has changed can be changed in
+        # place. Anything else, such as a unique index that can't be
+        # built because of duplicates, needs someone to look at it,
+        # rather than the index being dropped.
+        if (e.code != INDEX_OPTIONS_CONFLICT or
+            'expireAfterSeconds' not in options):
+            raise
+        collection.database.command('collMod', collection.name, index={
+            'keyPattern': {key: 1},
+            'expireAfterSeconds': options['expireAfterSeconds']
+            })
+
+BLOB_FIELDS = {'_id': False, 'screen_name': True, 'user_id': True,
+               'data': True, 'version': True}
+
+def blob_doc(blob, without_data=False):
+    # Blobs stored before versioning was introduced are version 0, and
+    # blobs created by merging an empty object have no data.
+    if blob is not None:
+        blob.setdefault('version', 0)
+        blob.pop('_id', None)
+        if not without_data:
+            blob.setdefault('data', {})
+    return blob
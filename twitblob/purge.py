@@ -0,0 +1,197 @@
+'''
+Surrogate keys, which tag the responses that a CDN or caching reverse
+proxy keeps so that they can be purged by tag, and purgers, which are
+called with the keys of responses that a write has made stale.
+'''
+
+import os
+import logging
+import threading
+import weakref
+
+from twitblob.http_client import ConnectionPool, UpstreamError, \
+     request_with_retries, DEFAULT_RETRIES
+
+# Tags /who/ responses.
+USER_LIST_KEY = 'users'
+
+# Maximum number of keys sent in a single purge.
+DEFAULT_BATCH_SIZE = 100
+
+# Maximum number of keys waiting to be purged in the background, past
+# which more are dropped.
+DEFAULT_MAX_PENDING = 10000
+
+# Seconds an idle purging thread waits before checking whether its
+# purger is still in use.
+DEFAULT_POLL_INTERVAL = 1.0
+
+log = logging.getLogger('twitblob.purge')
+
+def user_key(user_id):
+    return 'user-%s' % user_id
+
+def name_key(screen_name):
+    return 'name-%s' % screen_name
+
+def blob_keys(user_id, screen_name):
+    '''
+    Returns the keys of every response that includes the given user's
+    blob, whether it was asked for by user id or screen name.
+
+      >>> blob_keys(1, 'bob')
+      ['user-1', 'name-bob']
+    '''
+
+    return [user_key(user_id), name_key(screen_name)]
+
+class RecordingPurger(object):
+    '''
+    A purger that only records the keys it's asked to purge, for
+    testing.
+
+      >>> p = RecordingPurger()
+      >>> p.purge(['user-1', 'name-bob'])
+      >>> p.purged
+      [['user-1', 'name-bob']]
+    '''
+
+    def __init__(self):
+        self.purged = []
+
+    def purge(self, keys):
+        self.purged.append(list(keys))
+
+class HttpPurger(object):
+    '''
+    Purges keys by sending them, space-separated, in the Surrogate-Key
+    header of a request to a CDN's purge endpoint, as Fastly's API
+    expects. Other headers, such as API keys, can be given as well.
+    Failures are logged rather than raised, since the write that made
+    the responses stale has already succeeded.
+    '''
+
+    def __init__(self, url, method='POST', headers=None, http=None,
+                 retries=DEFAULT_RETRIES):
+        self.url = url
+        self.method = method
+        self.headers = dict(headers or {})
+        if http is None:
+            http = ConnectionPool()
+        self.http = http
+        self.retries = retries
+
+    def purge(self, keys):
+        headers = dict(self.headers)
+        headers['Surrogate-Key'] = ' '.join(keys)
+        try:
+            request_with_retries(self.http, self.url, self.method, '',
+                                 headers, retries=self.retries)
+        except UpstreamError, e:
+            log.warning('purging %s failed: %s', headers['Surrogate-Key'], e)
+
+def work(purger_ref):
+    # The thread only holds on to its purger while flushing it, so
+    # that it stops once the purger has been thrown away, as it is
+    # when the app is reloaded.
+    while True:
+        purger = purger_ref()
+        if purger is None:
+            return
+        try:
+            purger.flush()
+        except Exception:
+            log.exception('purging in the background failed')
+        wakeup, poll_interval = purger.wakeup, purger.poll_interval
+        del purger
+        wakeup.wait(poll_interval)
+        wakeup.clear()
+
+class BackgroundPurger(object):
+    '''
+    Passes keys on to another purger from a background thread, so that
+    writes don't wait on the CDN. Keys that pile up while a purge is
+    being made are sent together, without duplicates, in the next.
+
+      >>> p = BackgroundPurger(RecordingPurger(), threads=0)
+      >>> p.purge(['user-1', 'name-bob'])
+      >>> p.purge(['user-1', 'users'])
+      >>> p.flush()
+      3
+      >>> p.purger.purged
+      [['user-1', 'name-bob', 'users']]
+    '''
+
+    def __init__(self, purger, threads=1, batch_size=DEFAULT_BATCH_SIZE,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.purger = purger
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = []
+        self.pending_keys = set()
+        self.dropped = 0
+        self.started_in = None
+
+    def start(self):
+        # Threads don't survive a fork, so they're started in whichever
+        # process first purges anything.
+        if not self.threads or self.started_in == os.getpid():
+            return
+        self.lock.acquire()
+        try:
+            if self.started_in == os.getpid():
+                return
+            self.started_in = os.getpid()
+            for i in range(self.threads):
+                thread = threading.Thread(target=work,
+                                          args=(weakref.ref(self),))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self.lock.release()
+
+    def purge(self, keys):
+        dropped = 0
+        self.lock.acquire()
+        try:
+            for key in keys:
+                if key in self.pending_keys:
+                    continue
+                if len(self.pending) >= self.max_pending:
+                    dropped += 1
+                    continue
+                self.pending.append(key)
+                self.pending_keys.add(key)
+            self.dropped += dropped
+        finally:
+            self.lock.release()
+        if dropped:
+            log.warning('dropped %d key(s) to purge; too many pending',
+                        dropped)
+        self.start()
+        self.wakeup.set()
+
+    def flush(self):
+        '''
+        Purges the keys that are waiting, in batches, returning how
+        many there were.
+        '''
+
+        count = 0
+        while True:
+            self.lock.acquire()
+            try:
+                batch = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+                self.pending_keys.difference_update(batch)
+            finally:
+                self.lock.release()
+            if not batch:
+                return count
+            self.purger.purge(batch)
+            count += len(batch)
@@ -0,0 +1,140 @@
+import datetime
+import threading
+
+from twitblob.cache import LRUCache
+
+# Blobs are read from the primary for this long after they're written,
+# so that whoever wrote them sees their change on their next read.
+DEFAULT_PIN_WINDOW = datetime.timedelta(seconds=10)
+
+DEFAULT_LAG_CHECK_INTERVAL = datetime.timedelta(seconds=1)
+
+# Maximum number of recently written blobs that are remembered.
+DEFAULT_MAX_PINS = 10000
+
+class ReadRouter(object):
+    '''
+    Decides whether reads of blobs and of the user list, which can
+    tolerate a little staleness, are sent to a read replica or to the
+    primary.
+
+    The replica is only used while its data is known to be no more
+    than max_staleness behind, if that's given. Its lag is checked
+    every check_interval, and assumed to grow by at most the time
+    since then, as it would if replication stopped altogether.
+
+      >>> from twitblob.storage import MemoryBackend
+      >>> primary, replica = MemoryBackend(), MemoryBackend()
+      >>> now = [datetime.datetime(2010, 6, 17)]
+      >>> router = ReadRouter(primary, replica, utcnow=lambda: now[0])
+      >>> router.for_name('bob') is replica
+      True
+
+    Blobs that were just written are read from the primary for a
+    while:
+
+      >>> router.wrote(1, 'bob')
+      >>> router.for_name('bob') is primary
+      True
+      >>> [(b is primary, ids) for b, ids in router.split('user_id', [1, 2])]
+      [(True, [1]), (False, [2])]
+      >>> now[0] += DEFAULT_PIN_WINDOW
+      >>> router.for_name('bob') is replica
+      True
+
+    Between checks, the replica's lag is assumed to grow:
+
+      >>> replica.replication_lag = lambda: datetime.timedelta(seconds=4)
+      >>> router = ReadRouter(primary, replica,
+      ...                     max_staleness=datetime.timedelta(seconds=5),
+      ...                     check_interval=datetime.timedelta(seconds=10),
+      ...                     utcnow=lambda: now[0])
+      >>> router.for_name('bob') is replica
+      True
+      >>> now[0] += datetime.timedelta(seconds=2)
+      >>> router.for_name('bob') is primary
+      True
+    '''
+
+    def __init__(self, primary, replica, max_staleness=None,
+                 pin_window=DEFAULT_PIN_WINDOW,
+                 check_interval=DEFAULT_LAG_CHECK_INTERVAL,
+                 utcnow=datetime.datetime.utcnow, max_pins=DEFAULT_MAX_PINS):
+        self.primary = primary
+        self.replica = replica
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self.utcnow = utcnow
+        self.pins = LRUCache(max_pins, ttl=pin_window, utcnow=utcnow)
+        self.lock = threading.Lock()
+        self.lag = None
+        self.checked = None
+
+    def check_lag(self):
+        self.lag = self.replica.replication_lag()
+        self.checked = self.utcnow()
+
+    def replica_is_fresh(self):
+        if self.max_staleness is None:
+            return True
+        now = self.utcnow()
+        # Only one thread needs to check; the others go by the last
+        # check.
+        due = (self.checked is None or
+               now - self.checked >= self.check_interval)
+        if due and self.lock.acquire(False):
+            try:
+                self.check_lag()
+            finally:
+                self.lock.release()
+        lag, checked = self.lag, self.checked
+        if lag is None or checked is None:
+            return False
+        return lag + (now - checked) <= self.max_staleness
+
+    def wrote(self, user_id, screen_name, new_user=False):
+        '''
+        Records that the given user's blob was just written, and
+        whether it was the first time.
+        '''
+
+        self.pins.put(('user_id', user_id), True)
+        self.pins.put(('screen_name', screen_name), True)
+        if new_user:
+            self.pins.put('users', True)
+
+    def is_pinned(self, key, value):
+        return self.pins.get((key, value)) is not None
+
+    def for_name(self, screen_name):
+        if (self.is_pinned('screen_name', screen_name) or
+            not self.replica_is_fresh()):
+            return self.primary
+        return self.replica
+
+    def for_user_list(self):
+        # Someone who just created their blob expects to be listed.
+        if self.pins.get('users') is not None or not self.replica_is_fresh():
+            return self.primary
+        return self.replica
+
+    def split(self, key, values):
+        '''
+        Returns a list of (backend, values) tuples saying where to look
+        up the blobs whose screen names or user ids, as given by key,
+        are among the given values.
+        '''
+
+        if not self.replica_is_fresh():
+            return [(self.primary, list(values))]
+        pinned = []
+        unpinned = []
+        for value in values:
+            if self.is_pinned(key, value):
+                pinned.append(value)
+            else:
+                unpinned.append(value)
+        return [(backend, chunk)
+                for backend, chunk in [(self.primary, pinned),
+                                       (self.replica, unpinned)]
+                if chunk]
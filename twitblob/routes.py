@@ -0,0 +1,28 @@
+def route(path):
+    '''
+    Returns the name of the resource a request path refers to, and the
+    screen name it's for, if any. The API dispatches on this, and
+    metrics and admission control classify requests by it, so that
+    they always agree.
+
+      >>> route('/blobs/bob')
+      ('blob', 'bob')
+      >>> route('/blobs/')
+      ('blobs', None)
+      >>> route('/login/callback')
+      ('login', None)
+      >>> route('/nothing/')
+      (None, None)
+    '''
+
+    if path.startswith('/login/'):
+        return ('login', None)
+    if path == '/blobs/':
+        return ('blobs', None)
+    if path.startswith('/blobs/'):
+        return ('blob', path.split('/')[2])
+    for name, resource in [('/who/', 'who'), ('/feedback/', 'feedback'),
+                           ('/logout/', 'logout'), ('/metrics/', 'metrics')]:
+        if path == name:
+            return (resource, None)
+    return (None, None)
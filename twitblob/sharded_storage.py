@@ -0,0 +1,372 @@
+import os
+import heapq
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from twitblob.cache import LRUCache
+from twitblob.storage import Backend, DuplicateToken
+
+# Number of screen names whose user ids are remembered, so that
+# looking up a blob by screen name usually only involves one shard.
+DEFAULT_NAME_HINTS = 100000
+
+# Number of threads, per shard, that query shards in parallel.
+DEFAULT_THREADS_PER_SHARD = 4
+
+# Number of blobs read at a time when rebalancing.
+REBALANCE_BATCH_SIZE = 100
+
+def stable_hash(key):
+    '''
+    Returns a 64-bit hash of the given user id or token id that's the
+    same in every process, unlike Python's hash().
+
+      >>> stable_hash(1) == stable_hash(1L) == stable_hash(u'1')
+      True
+    '''
+
+    return int(hashlib.md5(unicode(key).encode('utf-8')).hexdigest()[:16],
+               16)
+
+def jump_hash(key, buckets):
+    '''
+    Maps a 64-bit key to one of the given number of buckets with
+    Lamping and Veach's jump consistent hash, so that adding a bucket
+    only moves the keys that now belong in the new one.
+
+      >>> before = [jump_hash(stable_hash(i), 3) for i in range(1000)]
+      >>> after = [jump_hash(stable_hash(i), 4) for i in range(1000)]
+      >>> sorted(set(before))
+      [0, 1, 2]
+      >>> set(a for b, a in zip(before, after) if a != b)
+      set([3])
+    '''
+
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+# Thread pools by process id and size, shared between backends.
+pools = {}
+
+pools_lock = threading.Lock()
+
+def get_pool(threads):
+    # Threads don't survive a fork, so every process needs its own
+    # pools.
+    key = (os.getpid(), threads)
+    pools_lock.acquire()
+    try:
+        if key not in pools:
+            pools[key] = ThreadPool(threads)
+        return pools[key]
+    finally:
+        pools_lock.release()
+
+def by_user_id(results):
+    '''
+    Merges lists of documents ordered by user id into one, dropping
+    any duplicates.
+    '''
+
+    merged = []
+    for user_id, doc in heapq.merge(*[[(doc['user_id'], doc)
+                                       for doc in docs]
+                                      for docs in results]):
+        if not merged or merged[-1]['user_id'] != user_id:
+            merged.append(doc)
+    return merged
+
+class ShardedBackend(Backend):
+    '''
+    A storage backend that spreads blobs across several other backends
+    by a stable hash of their user id, and auth tokens by a hash of
+    their id. Revocations, OAuth request tokens and queued feedback,
+    of which there are few, are kept in the first shard.
+
+    Lookups that involve more than one shard are made on all of them
+    in parallel.
+
+      >>> from twitblob.storage import MemoryBackend
+      >>> b = ShardedBackend([MemoryBackend() for i in range(3)])
+      >>> for user_id in range(1, 9):
+      ...     version = b.replace_blob(user_id, 'user%d' % user_id, {})
+      >>> [len(shard.blobs) for shard in b.shards]
+      [2, 3, 3]
+      >>> [user['user_id'] for user in b.iter_users(after=2, limit=3)]
+      [3, 4, 5]
+      >>> b.find_blob('user4')['user_id']
+      4
+
+    Shards that are being retired from service can be given as well;
+    they're only used by rebalance().
+    '''
+
+    def __init__(self, shards, retired=(), threads=None,
+                 name_hints=DEFAULT_NAME_HINTS):
+        self.shards = list(shards)
+        self.retired = list(retired)
+        self.request_tokens = self.shards[0].request_tokens
+        if threads is None:
+            threads = len(self.shards) * DEFAULT_THREADS_PER_SHARD
+        self.threads = threads
+        self.names = LRUCache(maxsize=name_hints)
+
+    def shard_for(self, user_id):
+        return self.shards[jump_hash(stable_hash(user_id), len(self.shards))]
+
+    def token_shard_for(self, token_id):
+        return self.shards[jump_hash(stable_hash(token_id),
+                                     len(self.shards))]
+
+    def map(self, func, items):
+        '''
+        Returns the results of calling func with each of the given
+        items, in parallel if there's more than one.
+        '''
+
+        items = list(items)
+        if len(items) < 2:
+            return [func(item) for item in items]
+        return get_pool(self.threads).map(func, items)
+
+    def _find_by_name(self, screen_name, find):
+        # Try the shard that held the user's blob last time, and only
+        # ask every shard if it isn't there.
+        user_id = self.names.get(screen_name)
+        if user_id is not None:
+            result = find(self.shard_for(user_id))
+            if result is not None:
+                return result
+        results = self.map(find, self.shards)
+        found = [(shard, result)
+                 for shard, result in zip(self.shards, results)
+                 if result is not None]
+        if not found:
+            return None
+        # If a rebalance was interrupted, a blob may briefly exist on
+        # more than one shard; the one on its proper shard wins.
+        for shard, result in found:
+            user_id = result['user_id']
+            if self.shard_for(user_id) is shard:
+                self.names.put(screen_name, user_id)
+                return result
+        return found[0][1]
+
+    def find_blob(self, screen_name, without_data=False):
+        return self._find_by_name(
+            screen_name,
+            lambda shard: shard.find_blob(screen_name, without_data)
+            )
+
+    def find_blob_version(self, screen_name):
+        user_id = self.names.get(screen_name)
+        if user_id is not None:
+            version = self.shard_for(user_id).find_blob_version(screen_name)
+            if version is not None:
+                return version
+        versions = [version for version in self.map(
+            lambda shard: shard.find_blob_version(screen_name), self.shards
+            ) if version is not None]
+        if not versions:
+            return None
+        return max(versions)
+
+    def find_blobs(self, key, values):
+        if key == 'user_id':
+            groups = {}
+            for user_id in values:
+                groups.setdefault(self.shard_for(user_id), []).append(user_id)
+            queries = groups.items()
+        else:
+            queries = [(shard, values) for shard in self.shards]
+        results = self.map(
+            lambda (shard, chunk): list(shard.find_blobs(key, chunk)),
+            queries
+            )
+        blobs = {}
+        for shard, result in zip([shard for shard, chunk in queries],
+                                 results):
+            for blob in result:
+                user_id = blob['user_id']
+                if (user_id not in blobs or
+                    self.shard_for(user_id) is shard):
+                    blobs[user_id] = blob
+        for blob in blobs.values():
+            self.names.put(blob['screen_name'], blob['user_id'])
+        return blobs.values()
+
+    def iter_users(self, after=None, limit=None):
+        return by_user_id(self.map(
+            lambda shard: list(shard.iter_users(after, limit)),
+            self.shards
+            ))[:limit or None]
+
+    def iter_blobs_without_json(self):
+        blobs = []
+        for result in self.map(
+            lambda shard: list(shard.iter_blobs_without_json()),
+            self.shards
+            ):
+            blobs.extend(result)
+        return blobs
+
+    def iter_blobs(self, after=None, limit=None, until=None):
+        return by_user_id(self.map(
+            lambda shard: list(shard.iter_blobs(after, limit, until)),
+            self.shards
+            ))[:limit or None]
+
+    def user_id_range(self):
+        ranges = [r for r in self.map(lambda shard: shard.user_id_range(),
+                                      self.shards)
+                  if r is not None]
+        if not ranges:
+            return None
+        return (min(low for low, high in ranges),
+                max(high for low, high in ranges))
+
+    def restore_blob(self, blob):
+        self.shard_for(blob['user_id']).restore_blob(blob)
+        self.names.put(blob['screen_name'], blob['user_id'])
+
+    def restore_blobs(self, blobs):
+        groups = {}
+        for blob in blobs:
+            groups.setdefault(self.shard_for(blob['user_id']),
+                              []).append(blob)
+            self.names.put(blob['screen_name'], blob['user_id'])
+        self.map(lambda (shard, chunk): shard.restore_blobs(chunk),
+                 groups.items())
+
+    def remove_blob(self, user_id):
+        self.shard_for(user_id).remove_blob(user_id)
+
+    def merge_blob(self, user_id, screen_name, data, fetch_data=False):
+        self.names.put(screen_name, user_id)
+        return self.shard_for(user_id).merge_blob(user_id, screen_name,
+                                                  data, fetch_data)
+
+    def replace_blob(self, user_id, screen_name, data, json=None,
+                     if_version=None):
+        self.names.put(screen_name, user_id)
+        return self.shard_for(user_id).replace_blob(user_id, screen_name,
+                                                    data, json, if_version)
+
+    def set_blob_json(self, user_id, version, json):
+        self.shard_for(user_id).set_blob_json(user_id, version, json)
+
+    def insert_token(self, token):
+        self.token_shard_for(token['id']).insert_token(token)
+
+    def find_token(self, token_id):
+        return self.token_shard_for(token_id).find_token(token_id)
+
+    def remove_token(self, token_id):
+        self.token_shard_for(token_id).remove_token(token_id)
+
+    def iter_tokens(self):
+        tokens = []
+        for result in self.map(lambda shard: list(shard.iter_tokens()),
+                               self.shards):
+            tokens.extend(result)
+        return tokens
+
+    def insert_revocation(self, nonce, expires):
+        self.shards[0].insert_revocation(nonce, expires)
+
+    def find_revocations(self, now):
+        return self.shards[0].find_revocations(now)
+
+    def enqueue_feedback(self, sender, message, now):
+        return self.shards[0].enqueue_feedback(sender, message, now)
+
+    def claim_feedback(self, now, lease_until, limit):
+        return self.shards[0].claim_feedback(now, lease_until, limit)
+
+    def finish_feedback(self, feedback_id):
+        self.shards[0].finish_feedback(feedback_id)
+
+    def retry_feedback(self, feedback_id, available, error):
+        self.shards[0].retry_feedback(feedback_id, available, error)
+
+    def dead_letter_feedback(self, feedback_id, error):
+        self.shards[0].dead_letter_feedback(feedback_id, error)
+
+    def requeue_dead_feedback(self, now):
+        return self.shards[0].requeue_dead_feedback(now)
+
+    def feedback_stats(self):
+        return self.shards[0].feedback_stats()
+
+    def expire_tokens(self, token_lifetime, request_token_lifetime):
+        return all([shard.expire_tokens(token_lifetime,
+                                        request_token_lifetime)
+                    for shard in self.shards])
+
+    def replication_lag(self):
+        lags = self.map(lambda shard: shard.replication_lag(), self.shards)
+        if None in lags:
+            return None
+        return max(lags)
+
+    def remove_expired_tokens(self, tokens_before, request_tokens_before,
+                              revocations_before):
+        return sum(self.map(
+            lambda shard: shard.remove_expired_tokens(
+                tokens_before, request_tokens_before, revocations_before
+                ),
+            self.shards
+            ))
+
+def rebalance(backend, batch_size=REBALANCE_BATCH_SIZE):
+    '''
+    Moves every blob and auth token in the given ShardedBackend's
+    shards, and its retired shards, that isn't on the shard it belongs
+    on to that shard, returning the number moved. This is needed after
+    the number of shards changes, and should be done while the app
+    isn't running, as blobs that haven't moved yet can't be found by
+    user id.
+
+      >>> from twitblob.storage import MemoryBackend
+      >>> shards = [MemoryBackend() for i in range(3)]
+      >>> b = ShardedBackend(shards[:2])
+      >>> for user_id in range(1, 9):
+      ...     version = b.replace_blob(user_id, 'user%d' % user_id, {})
+      >>> b = ShardedBackend(shards)
+      >>> rebalance(b)
+      3
+      >>> rebalance(b)
+      0
+      >>> [len(shard.blobs) for shard in shards]
+      [2, 3, 3]
+    '''
+
+    moved = 0
+    for shard in backend.shards + backend.retired:
+        after = None
+        while True:
+            blobs = list(shard.iter_blobs(after, batch_size))
+            if not blobs:
+                break
+            for blob in blobs:
+                home = backend.shard_for(blob['user_id'])
+                if home is not shard:
+                    home.restore_blob(blob)
+                    shard.remove_blob(blob['user_id'])
+                    moved += 1
+            after = blobs[-1]['user_id']
+        for token in list(shard.iter_tokens()):
+            home = backend.token_shard_for(token['id'])
+            if home is not shard:
+                try:
+                    home.insert_token(token)
+                except DuplicateToken:
+                    pass
+                shard.remove_token(token['id'])
+                moved += 1
+    return moved
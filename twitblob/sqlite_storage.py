@@ -0,0 +1,434 @@
+import sqlite3
+import datetime
+import threading
+
+from twitblob import codec as json
+from twitblob.storage import Backend, DuplicateToken, FEEDBACK_KEYS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    user_id INTEGER PRIMARY KEY,
+    screen_name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    json TEXT,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_screen_name ON blobs (screen_name);
+
+CREATE TABLE IF NOT EXISTS auth_tokens (
+    id TEXT PRIMARY KEY,
+    screen_name TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    date timestamp NOT NULL
+);
+CREATE INDEX IF NOT EXISTS auth_tokens_date ON auth_tokens (date);
+
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    nonce TEXT PRIMARY KEY,
+    expires timestamp NOT NULL
+);
+CREATE INDEX IF NOT EXISTS revoked_tokens_expires
+    ON revoked_tokens (expires);
+
+CREATE TABLE IF NOT EXISTS request_tokens (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    date timestamp NOT NULL
+);
+CREATE INDEX IF NOT EXISTS request_tokens_date ON request_tokens (date);
+
+CREATE TABLE IF NOT EXISTS feedback_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    enqueued timestamp NOT NULL,
+    available timestamp NOT NULL,
+    attempts INTEGER NOT NULL,
+    dead INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS feedback_queue_available
+    ON feedback_queue (dead, available);
+"""
+
+BLOB_COLUMNS = 'screen_name, user_id, data, version'
+
+def blob_doc(row):
+    return {'screen_name': row[0],
+            'user_id': row[1],
+            'data': json.loads(row[2]),
+            'version': row[3]}
+
+class SqliteRequestTokens(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __contains__(self, name):
+        return self.backend.query_one(
+            'SELECT 1 FROM request_tokens WHERE name = ?', (name,)
+            ) is not None
+
+    def __delitem__(self, name):
+        def delete(cursor):
+            cursor.execute('DELETE FROM request_tokens WHERE name = ?',
+                           (name,))
+            return cursor.rowcount
+        if not self.backend.transaction(delete):
+            raise KeyError(name)
+
+    def __getitem__(self, name):
+        row = self.backend.query_one(
+            'SELECT value FROM request_tokens WHERE name = ?', (name,)
+            )
+        if row is None:
+            raise KeyError(name)
+        return json.loads(row[0])
+
+    def pop(self, name, *default):
+        def pop(cursor):
+            cursor.execute('SELECT value FROM request_tokens WHERE name = ?',
+                           (name,))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute('DELETE FROM request_tokens WHERE name = ?',
+                               (name,))
+            return row
+        row = self.backend.transaction(pop)
+        if row is None:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        return json.loads(row[0])
+
+    def __setitem__(self, name, value):
+        self.backend.transaction(lambda cursor: cursor.execute(
+            'INSERT OR REPLACE INTO request_tokens (name, value, date) '
+            'VALUES (?, ?, ?)',
+            (name, json.dumps(value), datetime.datetime.utcnow())
+            ))
+
+class SqliteBackend(Backend):
+    '''
+    A storage backend that keeps everything in a SQLite database file,
+    for small installations that don't warrant a MongoDB server.
+
+      >>> b = SqliteBackend(':memory:')
+      >>> b.replace_blob(1, 'bob', {'foo': 1})
+      1
+      >>> sorted(b.merge_blob(1, 'bob', {'bar': 2}, fetch_data=True)['data'])
+      ['bar', u'foo']
+      >>> b.find_blob_version('bob')
+      2
+      >>> b.request_tokens['a'] = {'b': 'c'}
+      >>> b.request_tokens['a']
+      {u'b': u'c'}
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    isolation_level=None)
+        self.conn.executescript(SCHEMA)
+        self.request_tokens = SqliteRequestTokens(self)
+
+    def transaction(self, func):
+        self.lock.acquire()
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(cursor)
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+        finally:
+            self.lock.release()
+
+    def query(self, sql, params=()):
+        self.lock.acquire()
+        try:
+            return self.conn.execute(sql, params).fetchall()
+        finally:
+            self.lock.release()
+
+    def query_one(self, sql, params=()):
+        rows = self.query(sql, params)
+        if rows:
+            return rows[0]
+        return None
+
+    def find_blob(self, screen_name, without_data=False):
+        row = self.query_one(
+            'SELECT %s, json FROM blobs WHERE screen_name = ?' % (
+                BLOB_COLUMNS
+                ),
+            (screen_name,)
+            )
+        if row is None:
+            return None
+        blob = blob_doc(row)
+        if row[4] is not None:
+            blob['json'] = row[4]
+        if without_data:
+            del blob['data']
+        return blob
+
+    def find_blob_version(self, screen_name):
+        row = self.query_one('SELECT version FROM blobs '
+                             'WHERE screen_name = ?', (screen_name,))
+        if row is None:
+            return None
+        return row[0]
+
+    def find_blobs(self, key, values):
+        if key not in ('user_id', 'screen_name'):
+            raise ValueError(key)
+        blobs = []
+        # SQLite limits the number of parameters in a single statement.
+        for i in range(0, len(values), 500):
+            chunk = values[i:i+500]
+            blobs.extend(blob_doc(row) for row in self.query(
+                'SELECT %s FROM blobs WHERE %s IN (%s)' % (
+                    BLOB_COLUMNS, key, ', '.join(['?'] * len(chunk))
+                    ),
+                chunk
+                ))
+        return blobs
+
+    def iter_users(self, after=None, limit=None):
+        sql = 'SELECT screen_name, user_id FROM blobs'
+        params = []
+        if after is not None:
+            sql += ' WHERE user_id > ?'
+            params.append(after)
+        sql += ' ORDER BY user_id'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [{'screen_name': row[0], 'user_id': row[1]}
+                for row in self.query(sql, params)]
+
+    def iter_blobs_without_json(self):
+        return [blob_doc(row) for row in self.query(
+            'SELECT %s FROM blobs WHERE json IS NULL' % BLOB_COLUMNS
+            )]
+
+    def iter_blobs(self, after=None, limit=None, until=None):
+        sql = 'SELECT %s, json FROM blobs' % BLOB_COLUMNS
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append('user_id > ?')
+            params.append(after)
+        if until is not None:
+            conditions.append('user_id <= ?')
+            params.append(until)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY user_id'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        blobs = []
+        for row in self.query(sql, params):
+            blob = blob_doc(row)
+            if row[4] is not None:
+                blob['json'] = row[4]
+            blobs.append(blob)
+        return blobs
+
+    def user_id_range(self):
+        row = self.query_one('SELECT MIN(user_id), MAX(user_id) FROM blobs')
+        if row[0] is None:
+            return None
+        return row
+
+    def restore_blob(self, blob):
+        self.restore_blobs([blob])
+
+    def restore_blobs(self, blobs):
+        self.transaction(lambda cursor: cursor.executemany(
+            'INSERT OR REPLACE INTO blobs (user_id, screen_name, data, '
+            'json, version) VALUES (?, ?, ?, ?, ?)',
+            [(blob['user_id'], blob['screen_name'], json.dumps(blob['data']),
+              blob.get('json'), blob['version']) for blob in blobs]
+            ))
+
+    def remove_blob(self, user_id):
+        self.transaction(lambda cursor: cursor.execute(
+            'DELETE FROM blobs WHERE user_id = ?', (user_id,)
+            ))
+
+    def _upsert(self, cursor, user_id, screen_name, data, json_value,
+                if_version=None):
+        insert = ('INSERT INTO blobs (user_id, screen_name, data, json, '
+                  'version) VALUES (?, ?, ?, ?, 1)',
+                  (user_id, screen_name, json.dumps(data), json_value))
+        if if_version == 0:
+            try:
+                cursor.execute(*insert)
+            except sqlite3.IntegrityError:
+                return None
+        else:
+            sql = ('UPDATE blobs SET screen_name = ?, data = ?, json = ?, '
+                   'version = version + 1 WHERE user_id = ?')
+            params = [screen_name, json.dumps(data), json_value, user_id]
+            if if_version is not None:
+                sql += ' AND version = ?'
+                params.append(if_version)
+            cursor.execute(sql, params)
+            if not cursor.rowcount:
+                if if_version is not None:
+                    return None
+                cursor.execute(*insert)
+        cursor.execute('SELECT version FROM blobs WHERE user_id = ?',
+                       (user_id,))
+        return cursor.fetchone()[0]
+
+    def merge_blob(self, user_id, screen_name, data, fetch_data=False):
+        def merge(cursor):
+            cursor.execute('SELECT data FROM blobs WHERE user_id = ?',
+                           (user_id,))
+            row = cursor.fetchone()
+            merged = {}
+            if row is not None:
+                merged = json.loads(row[0])
+            merged.update(data)
+            version = self._upsert(cursor, user_id, screen_name, merged,
+                                   None)
+            return {'version': version, 'data': merged}
+        result = self.transaction(merge)
+        if not fetch_data:
+            del result['data']
+        return result
+
+    def replace_blob(self, user_id, screen_name, data, json=None,
+                     if_version=None):
+        return self.transaction(lambda cursor: self._upsert(
+            cursor, user_id, screen_name, data, json, if_version
+            ))
+
+    def set_blob_json(self, user_id, version, json):
+        self.transaction(lambda cursor: cursor.execute(
+            'UPDATE blobs SET json = ? WHERE user_id = ? AND version = ?',
+            (json, user_id, version)
+            ))
+
+    def insert_token(self, token):
+        try:
+            self.transaction(lambda cursor: cursor.execute(
+                'INSERT INTO auth_tokens (id, screen_name, user_id, date) '
+                'VALUES (?, ?, ?, ?)',
+                (token['id'], token['screen_name'], token['user_id'],
+                 token['date'])
+                ))
+        except sqlite3.IntegrityError:
+            raise DuplicateToken(token['id'])
+
+    def find_token(self, token_id):
+        row = self.query_one('SELECT id, screen_name, user_id, date '
+                             'FROM auth_tokens WHERE id = ?', (token_id,))
+        if row is None:
+            return None
+        return {'id': row[0], 'screen_name': row[1], 'user_id': row[2],
+                'date': row[3]}
+
+    def remove_token(self, token_id):
+        self.transaction(lambda cursor: cursor.execute(
+            'DELETE FROM auth_tokens WHERE id = ?', (token_id,)
+            ))
+
+    def iter_tokens(self):
+        return [{'id': row[0], 'screen_name': row[1], 'user_id': row[2],
+                 'date': row[3]} for row in self.query(
+            'SELECT id, screen_name, user_id, date FROM auth_tokens'
+            )]
+
+    def insert_revocation(self, nonce, expires):
+        self.transaction(lambda cursor: cursor.execute(
+            'INSERT OR REPLACE INTO revoked_tokens (nonce, expires) '
+            'VALUES (?, ?)', (nonce, expires)
+            ))
+
+    def find_revocations(self, now):
+        return [(row[0], row[1]) for row in self.query(
+            'SELECT nonce, expires FROM revoked_tokens WHERE expires > ?',
+            (now,)
+            )]
+
+    def remove_expired_tokens(self, tokens_before, request_tokens_before,
+                              revocations_before):
+        def remove(cursor):
+            removed = 0
+            for sql, date in [
+                ('DELETE FROM auth_tokens WHERE date < ?', tokens_before),
+                ('DELETE FROM request_tokens WHERE date < ?',
+                 request_tokens_before),
+                ('DELETE FROM revoked_tokens WHERE expires < ?',
+                 revocations_before)
+                ]:
+                cursor.execute(sql, (date,))
+                removed += cursor.rowcount
+            return removed
+        return self.transaction(remove)
+
+    def enqueue_feedback(self, sender, message, now):
+        def enqueue(cursor):
+            cursor.execute('INSERT INTO feedback_queue (sender, message, '
+                           'enqueued, available, attempts, dead) '
+                           'VALUES (?, ?, ?, ?, 0, 0)',
+                           (sender, message, now, now))
+            return cursor.lastrowid
+        return self.transaction(enqueue)
+
+    def claim_feedback(self, now, lease_until, limit):
+        def claim(cursor):
+            cursor.execute('SELECT %s FROM feedback_queue '
+                           'WHERE dead = 0 AND available <= ? '
+                           'ORDER BY id LIMIT ?' % ', '.join(FEEDBACK_KEYS),
+                           (now, limit))
+            claimed = [dict(zip(FEEDBACK_KEYS, row))
+                       for row in cursor.fetchall()]
+            for item in claimed:
+                item['attempts'] += 1
+                cursor.execute('UPDATE feedback_queue SET available = ?, '
+                               'attempts = ? WHERE id = ?',
+                               (lease_until, item['attempts'], item['id']))
+            return claimed
+        return self.transaction(claim)
+
+    def finish_feedback(self, feedback_id):
+        self.transaction(lambda cursor: cursor.execute(
+            'DELETE FROM feedback_queue WHERE id = ?', (feedback_id,)
+            ))
+
+    def retry_feedback(self, feedback_id, available, error):
+        self.transaction(lambda cursor: cursor.execute(
+            'UPDATE feedback_queue SET available = ?, error = ? '
+            'WHERE id = ?', (available, error, feedback_id)
+            ))
+
+    def dead_letter_feedback(self, feedback_id, error):
+        self.transaction(lambda cursor: cursor.execute(
+            'UPDATE feedback_queue SET dead = 1, error = ? WHERE id = ?',
+            (error, feedback_id)
+            ))
+
+    def requeue_dead_feedback(self, now):
+        def requeue(cursor):
+            cursor.execute('UPDATE feedback_queue SET dead = 0, '
+                           'available = ?, attempts = 0 WHERE dead = 1',
+                           (now,))
+            return cursor.rowcount
+        return self.transaction(requeue)
+
+    def feedback_stats(self):
+        counts = dict(self.query('SELECT dead, COUNT(*) FROM feedback_queue '
+                                 'GROUP BY dead'))
+        oldest = self.query_one('SELECT enqueued FROM feedback_queue '
+                                'WHERE dead = 0 ORDER BY id LIMIT 1')
+        return {'queued': counts.get(0, 0), 'dead': counts.get(1, 0),
+                'oldest': oldest and oldest[0]}
@@ -0,0 +1,565 @@
+import copy
+import datetime
+import threading
+
+# The keys of the feedback messages returned by
+# Backend.claim_feedback().
+FEEDBACK_KEYS = ['id', 'sender', 'message', 'enqueued', 'attempts']
+
+class DuplicateToken(Exception):
+    '''
+    Raised by Backend.insert_token when a token with the same id
+    already exists.
+    '''
+
+    pass
+
+class Backend(object):
+    '''
+    The interface TwitBlobDb uses to persist blobs, auth tokens and
+    token revocations, and that TwitBlobApi uses to queue feedback for
+    delivery. Implementations also provide a 'request_tokens'
+    attribute: a dictionary-like object that TwitterOauthClientApp uses
+    to keep OAuth request tokens between redirects. Its pop() method
+    must fetch and remove a token atomically, so that a token can't be
+    redeemed twice.
+
+    Blob documents are dictionaries with 'screen_name', 'user_id',
+    'data' and 'version' keys, plus a 'json' key holding the encoded
+    data if it has been stored. Callers may freely mutate any documents
+    returned to them.
+    '''
+
+    def find_blob(self, screen_name, without_data=False):
+        '''
+        Returns the blob document for the given screen name, or None.
+        If without_data is true, the document has no 'data' key.
+        '''
+
+        raise NotImplementedError()
+
+    def find_blob_version(self, screen_name):
+        '''
+        Returns the version of the given screen name's blob, or None if
+        it doesn't exist.
+        '''
+
+        raise NotImplementedError()
+
+    def find_blobs(self, key, values):
+        '''
+        Returns an iterable of blob documents, without their encoded
+        JSON, whose 'screen_name' or 'user_id' (as given by key) is in
+        the given list of values.
+        '''
+
+        raise NotImplementedError()
+
+    def iter_users(self, after=None, limit=None):
+        '''
+        Returns an iterable of dictionaries with the 'screen_name' and
+        'user_id' of every blob, ordered by user id, starting after the
+        given user id and returning at most limit entries.
+        '''
+
+        raise NotImplementedError()
+
+    def iter_blobs_without_json(self):
+        '''
+        Returns an iterable of the blob documents that have no encoded
+        JSON stored.
+        '''
+
+        raise NotImplementedError()
+
+    def iter_blobs(self, after=None, limit=None, until=None):
+        '''
+        Returns an iterable of complete blob documents, including any
+        encoded JSON, ordered by user id, starting after the given user
+        id, ending with the user id given by until and returning at
+        most limit entries.
+        '''
+
+        raise NotImplementedError()
+
+    def user_id_range(self):
+        '''
+        Returns the lowest and highest user ids that have blobs, or
+        None if there are no blobs.
+        '''
+
+        raise NotImplementedError()
+
+    def restore_blob(self, blob):
+        '''
+        Stores a complete blob document exactly as given, version
+        included, replacing any blob with the same user id.
+        '''
+
+        raise NotImplementedError()
+
+    def restore_blobs(self, blobs):
+        '''
+        Restores each of the given blob documents, in as few round
+        trips to the database as the backend can manage.
+        '''
+
+        for blob in blobs:
+            self.restore_blob(blob)
+
+    def remove_blob(self, user_id):
+        raise NotImplementedError()
+
+    def merge_blob(self, user_id, screen_name, data, fetch_data=False):
+        '''
+        Atomically merges the keys of data into the given user's blob,
+        creating it if needed, and increments its version. Any encoded
+        JSON, which is now stale, is removed in the same operation.
+
+        Returns a dictionary with the new 'version' and, if fetch_data
+        is true, the merged 'data'.
+        '''
+
+        raise NotImplementedError()
+
+    def replace_blob(self, user_id, screen_name, data, json=None,
+                     if_version=None):
+        '''
+        Atomically replaces the data and encoded JSON (which is removed
+        if not given) of the given user's blob, creating it if needed,
+        and returns its new version.
+
+        If if_version is given, the blob is only replaced if its
+        version is still that, where 0 means that it doesn't exist
+        yet, and None is returned otherwise.
+        '''
+
+        raise NotImplementedError()
+
+    def set_blob_json(self, user_id, version, json):
+        '''
+        Stores the encoded JSON for the given user's blob, unless its
+        version has changed.
+        '''
+
+        raise NotImplementedError()
+
+    def insert_token(self, token):
+        '''
+        Stores an auth token, raising DuplicateToken if its id is
+        already taken.
+        '''
+
+        raise NotImplementedError()
+
+    def find_token(self, token_id):
+        raise NotImplementedError()
+
+    def remove_token(self, token_id):
+        raise NotImplementedError()
+
+    def iter_tokens(self):
+        '''
+        Returns an iterable of every auth token.
+        '''
+
+        raise NotImplementedError()
+
+    def insert_revocation(self, nonce, expires):
+        raise NotImplementedError()
+
+    def find_revocations(self, now):
+        '''
+        Returns an iterable of (nonce, expires) tuples for every
+        revocation that expires after now.
+        '''
+
+        raise NotImplementedError()
+
+    def expire_tokens(self, token_lifetime, request_token_lifetime):
+        '''
+        Arranges for auth tokens and request tokens to be removed once
+        they're older than the given timedeltas, and revocations once
+        they've expired. Returns False if the backend can't do this by
+        itself, in which case remove_expired_tokens() must be called
+        periodically instead.
+        '''
+
+        return False
+
+    def remove_expired_tokens(self, tokens_before, request_tokens_before,
+                              revocations_before):
+        '''
+        Removes the auth tokens and request tokens dated before the
+        given dates, and the revocations expiring before the given
+        date. Returns the number of entries removed.
+        '''
+
+        raise NotImplementedError()
+
+    def enqueue_feedback(self, sender, message, now):
+        '''
+        Adds a feedback message to the delivery queue, to be delivered
+        as soon as possible, and returns its id.
+        '''
+
+        raise NotImplementedError()
+
+    def claim_feedback(self, now, lease_until, limit):
+        '''
+        Atomically claims at most limit queued feedback messages that
+        are due for delivery at now, oldest first, counting an attempt
+        at delivering each and hiding them from other claims until
+        lease_until. Returns them as dictionaries with 'id', 'sender',
+        'message', 'enqueued' and 'attempts' keys.
+        '''
+
+        raise NotImplementedError()
+
+    def finish_feedback(self, feedback_id):
+        '''
+        Removes a delivered feedback message from the queue.
+        '''
+
+        raise NotImplementedError()
+
+    def retry_feedback(self, feedback_id, available, error):
+        '''
+        Makes a feedback message whose delivery failed with the given
+        error due for delivery again at the given date.
+        '''
+
+        raise NotImplementedError()
+
+    def dead_letter_feedback(self, feedback_id, error):
+        '''
+        Sets aside a feedback message that couldn't be delivered, along
+        with the error its last attempt failed with, so that it's never
+        claimed again.
+        '''
+
+        raise NotImplementedError()
+
+    def requeue_dead_feedback(self, now):
+        '''
+        Queues every dead-lettered feedback message for delivery again,
+        with its attempts reset, and returns the number requeued.
+        '''
+
+        raise NotImplementedError()
+
+    def feedback_stats(self):
+        '''
+        Returns a dictionary with the number of 'queued' and 'dead'
+        feedback messages, and the date the 'oldest' queued one was
+        enqueued, which is None if there are none.
+        '''
+
+        raise NotImplementedError()
+
+    def replication_lag(self):
+        '''
+        Returns how far this backend's data may be behind that of the
+        primary it's replicated from, as a timedelta, or None if that
+        can't be told. Backends that aren't replicas are never behind.
+        '''
+
+        return datetime.timedelta(0)
+
+class MemoryRequestTokens(object):
+    def __init__(self):
+        self.tokens = {}
+
+    def __contains__(self, name):
+        return name in self.tokens
+
+    def __delitem__(self, name):
+        del self.tokens[name]
+
+    def pop(self, name, *default):
+        try:
+            token = self.tokens.pop(name)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        return token['value']
+
+    def __getitem__(self, name):
+        return copy.deepcopy(self.tokens[name]['value'])
+
+    def __setitem__(self, name, value):
+        self.tokens[name] = {'value': copy.deepcopy(value),
+                             'date': datetime.datetime.utcnow()}
+
+class MemoryBackend(Backend):
+    '''
+    A storage backend that keeps everything in the memory of the
+    current process, guarded by a lock.
+
+      >>> b = MemoryBackend()
+      >>> b.replace_blob(1, 'bob', {'foo': 1})
+      1
+      >>> sorted(b.merge_blob(1, 'bob', {'bar': 2}, fetch_data=True)['data'])
+      ['bar', 'foo']
+      >>> sorted(b.find_blob('bob', without_data=True).items())
+      [('screen_name', 'bob'), ('user_id', 1), ('version', 2)]
+      >>> [user['screen_name'] for user in b.iter_users()]
+      ['bob']
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.blobs = {}
+        self.user_ids = {}
+        self.auth_tokens = {}
+        self.revocations = {}
+        self.feedback = {}
+        self.last_feedback_id = 0
+        self.request_tokens = MemoryRequestTokens()
+
+    def _locked(func):
+        def wrapper(self, *args, **kwargs):
+            self.lock.acquire()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.lock.release()
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def _blob_for_name(self, screen_name):
+        user_id = self.user_ids.get(screen_name)
+        if user_id is None:
+            return None
+        return self.blobs[user_id]
+
+    def _upsert(self, user_id, screen_name):
+        blob = self.blobs.get(user_id)
+        if blob is None:
+            blob = {'user_id': user_id, 'data': {}, 'version': 0}
+            self.blobs[user_id] = blob
+        elif blob['screen_name'] != screen_name:
+            self._forget_name(blob['screen_name'], user_id)
+        blob['screen_name'] = screen_name
+        blob['version'] += 1
+        self.user_ids[screen_name] = user_id
+        return blob
+
+    def _forget_name(self, screen_name, user_id):
+        # Another user may have taken the name since, in which case
+        # it's theirs now.
+        if self.user_ids.get(screen_name) == user_id:
+            del self.user_ids[screen_name]
+
+    @_locked
+    def find_blob(self, screen_name, without_data=False):
+        blob = self._blob_for_name(screen_name)
+        if blob is None:
+            return None
+        if without_data:
+            blob = dict(blob)
+            del blob['data']
+        return copy.deepcopy(blob)
+
+    @_locked
+    def find_blob_version(self, screen_name):
+        blob = self._blob_for_name(screen_name)
+        if blob is None:
+            return None
+        return blob['version']
+
+    @_locked
+    def find_blobs(self, key, values):
+        if key == 'user_id':
+            found = [self.blobs.get(value) for value in values]
+        else:
+            found = [self._blob_for_name(value) for value in values]
+        result = []
+        for blob in found:
+            if blob is not None:
+                blob = dict(blob)
+                blob.pop('json', None)
+                result.append(copy.deepcopy(blob))
+        return result
+
+    @_locked
+    def iter_users(self, after=None, limit=None):
+        user_ids = sorted(self.blobs)
+        if after is not None:
+            user_ids = [user_id for user_id in user_ids if user_id > after]
+        if limit:
+            user_ids = user_ids[:limit]
+        return [{'screen_name': self.blobs[user_id]['screen_name'],
+                 'user_id': user_id}
+                for user_id in user_ids]
+
+    @_locked
+    def iter_blobs_without_json(self):
+        return [copy.deepcopy(blob) for blob in self.blobs.values()
+                if 'json' not in blob]
+
+    @_locked
+    def iter_blobs(self, after=None, limit=None, until=None):
+        user_ids = sorted(self.blobs)
+        if after is not None:
+            user_ids = [user_id for user_id in user_ids if user_id > after]
+        if until is not None:
+            user_ids = [user_id for user_id in user_ids if user_id <= until]
+        if limit:
+            user_ids = user_ids[:limit]
+        return [copy.deepcopy(self.blobs[user_id]) for user_id in user_ids]
+
+    @_locked
+    def user_id_range(self):
+        if not self.blobs:
+            return None
+        return (min(self.blobs), max(self.blobs))
+
+    @_locked
+    def restore_blob(self, blob):
+        self.remove_blob(blob['user_id'])
+        self.blobs[blob['user_id']] = copy.deepcopy(blob)
+        self.user_ids[blob['screen_name']] = blob['user_id']
+
+    @_locked
+    def remove_blob(self, user_id):
+        blob = self.blobs.pop(user_id, None)
+        if blob is not None:
+            self._forget_name(blob['screen_name'], user_id)
+
+    @_locked
+    def merge_blob(self, user_id, screen_name, data, fetch_data=False):
+        blob = self._upsert(user_id, screen_name)
+        blob['data'].update(copy.deepcopy(data))
+        blob.pop('json', None)
+        result = {'version': blob['version']}
+        if fetch_data:
+            result['data'] = copy.deepcopy(blob['data'])
+        return result
+
+    @_locked
+    def replace_blob(self, user_id, screen_name, data, json=None,
+                     if_version=None):
+        if if_version is not None:
+            blob = self.blobs.get(user_id)
+            if if_version != (blob and blob['version'] or 0):
+                return None
+        blob = self._upsert(user_id, screen_name)
+        blob['data'] = copy.deepcopy(data)
+        blob.pop('json', None)
+        if json is not None:
+            blob['json'] = json
+        return blob['version']
+
+    @_locked
+    def set_blob_json(self, user_id, version, json):
+        blob = self.blobs.get(user_id)
+        if blob is not None and blob['version'] == version:
+            blob['json'] = json
+
+    @_locked
+    def insert_token(self, token):
+        if token['id'] in self.auth_tokens:
+            raise DuplicateToken(token['id'])
+        self.auth_tokens[token['id']] = dict(token)
+
+    @_locked
+    def find_token(self, token_id):
+        token = self.auth_tokens.get(token_id)
+        if token is not None:
+            token = dict(token)
+        return token
+
+    @_locked
+    def remove_token(self, token_id):
+        self.auth_tokens.pop(token_id, None)
+
+    @_locked
+    def iter_tokens(self):
+        return [dict(token) for token in self.auth_tokens.values()]
+
+    @_locked
+    def insert_revocation(self, nonce, expires):
+        self.revocations[nonce] = expires
+
+    @_locked
+    def find_revocations(self, now):
+        return [(nonce, expires)
+                for nonce, expires in self.revocations.items()
+                if expires > now]
+
+    @_locked
+    def remove_expired_tokens(self, tokens_before, request_tokens_before,
+                              revocations_before):
+        expired = [(self.auth_tokens, token_id)
+                   for token_id, token in self.auth_tokens.items()
+                   if token['date'] < tokens_before]
+        expired.extend((self.request_tokens.tokens, name)
+                       for name, token in self.request_tokens.tokens.items()
+                       if token['date'] < request_tokens_before)
+        expired.extend((self.revocations, nonce)
+                       for nonce, expires in self.revocations.items()
+                       if expires < revocations_before)
+        for entries, key in expired:
+            entries.pop(key, None)
+        return len(expired)
+
+    @_locked
+    def enqueue_feedback(self, sender, message, now):
+        self.last_feedback_id += 1
+        self.feedback[self.last_feedback_id] = {
+            'id': self.last_feedback_id, 'sender': sender,
+            'message': message, 'enqueued': now, 'available': now,
+            'attempts': 0, 'dead': False, 'error': None
+            }
+        return self.last_feedback_id
+
+    @_locked
+    def claim_feedback(self, now, lease_until, limit):
+        due = sorted(feedback_id
+                     for feedback_id, item in self.feedback.items()
+                     if not item['dead'] and item['available'] <= now)
+        claimed = []
+        for feedback_id in due[:limit]:
+            item = self.feedback[feedback_id]
+            item['available'] = lease_until
+            item['attempts'] += 1
+            claimed.append(dict((key, item[key]) for key in FEEDBACK_KEYS))
+        return claimed
+
+    @_locked
+    def finish_feedback(self, feedback_id):
+        self.feedback.pop(feedback_id, None)
+
+    @_locked
+    def retry_feedback(self, feedback_id, available, error):
+        item = self.feedback.get(feedback_id)
+        if item is not None:
+            item['available'] = available
+            item['error'] = error
+
+    @_locked
+    def dead_letter_feedback(self, feedback_id, error):
+        item = self.feedback.get(feedback_id)
+        if item is not None:
+            item['dead'] = True
+            item['error'] = error
+
+    @_locked
+    def requeue_dead_feedback(self, now):
+        dead = [item for item in self.feedback.values() if item['dead']]
+        for item in dead:
+            item.update(dead=False, available=now, attempts=0)
+        return len(dead)
+
+    @_locked
+    def feedback_stats(self):
+        queued = [item['enqueued'] for item in self.feedback.values()
+                  if not item['dead']]
+        return {'queued': len(queued),
+                'dead': len(self.feedback) - len(queued),
+                'oldest': queued and min(queued) or None}
+
+    del _locked
@@ -0,0 +1,213 @@
+import hmac
+import hashlib
+import calendar
+import datetime
+import threading
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+import simplejson as json
+
+# By default, revocations made by other processes are picked up
+# within a minute.
+DEFAULT_REVOCATION_REFRESH = datetime.timedelta(seconds=60)
+
+# OAuth request tokens only need to outlive a user's trip to Twitter
+# and back.
+DEFAULT_REQUEST_TOKEN_LIFETIME = datetime.timedelta(hours=1)
+
+# How often expired tokens are swept from backends that can't expire
+# them by themselves.
+DEFAULT_SWEEP_INTERVAL = datetime.timedelta(hours=1)
+
+def to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+def b64encode(s):
+    return urlsafe_b64encode(s).rstrip('=')
+
+def b64decode(s):
+    return urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+def constant_time_compare(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+class TokenSigner(object):
+    '''
+    Packs a dictionary into an HMAC-signed, URL-safe token string that
+    can later be verified without consulting any storage.
+
+      >>> signer = TokenSigner('sekrit')
+      >>> token = signer.sign({'s': 'bob'})
+      >>> signer.unsign(token)
+      {'s': 'bob'}
+
+    Tampered tokens, or tokens signed with another secret, don't
+    verify:
+
+      >>> TokenSigner('other').unsign(token) is None
+      True
+      >>> signer.unsign(token[:-2]) is None
+      True
+      >>> signer.unsign(u'\\u2603.blah') is None
+      True
+    '''
+
+    def __init__(self, secret):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+
+    def signature(self, payload):
+        return b64encode(hmac.new(self.secret, payload,
+                                  hashlib.sha256).digest())
+
+    def sign(self, obj):
+        payload = b64encode(json.dumps(obj, separators=(',', ':')))
+        return '%s.%s' % (payload, self.signature(payload))
+
+    def unsign(self, token):
+        try:
+            token = str(token)
+        except UnicodeError:
+            return None
+        if token.count('.') != 1:
+            return None
+        payload, signature = token.split('.')
+        if not constant_time_compare(signature, self.signature(payload)):
+            return None
+        try:
+            obj = json.loads(b64decode(payload))
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(obj, dict):
+            return None
+        return obj
+
+class RevocationList(object):
+    '''
+    A small list of revoked signed tokens, kept in memory so that
+    checking a token costs no database access. Revocations are
+    persisted to storage and periodically re-read from it, so that
+    revocations made by other processes take effect too. Entries are
+    dropped once the token they revoke has expired anyway.
+    '''
+
+    def __init__(self, storage, utcnow=datetime.datetime.utcnow,
+                 refresh_interval=DEFAULT_REVOCATION_REFRESH):
+        self.storage = storage
+        self.utcnow = utcnow
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.revoked = {}
+        self.next_refresh = None
+        # Revocations made while storage is being re-read, which may
+        # have been stored too late to be in what's read.
+        self.revoked_during_refresh = None
+
+    def refresh(self):
+        self.refresh_lock.acquire()
+        try:
+            self.__refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def __refresh(self):
+        now = self.utcnow()
+        self.lock.acquire()
+        try:
+            self.revoked_during_refresh = {}
+        finally:
+            self.lock.release()
+        try:
+            revoked = dict(self.storage.find_revocations(now))
+        except:
+            self.revoked_during_refresh = None
+            raise
+        self.lock.acquire()
+        try:
+            revoked.update(self.revoked_during_refresh)
+            self.revoked = revoked
+            self.revoked_during_refresh = None
+            self.next_refresh = now + self.refresh_interval
+        finally:
+            self.lock.release()
+
+    def revoke(self, nonce, expires):
+        self.storage.insert_revocation(nonce, expires)
+        self.lock.acquire()
+        try:
+            self.revoked[nonce] = expires
+            if self.revoked_during_refresh is not None:
+                self.revoked_during_refresh[nonce] = expires
+        finally:
+            self.lock.release()
+
+    def __contains__(self, nonce):
+        if self.next_refresh is None or self.utcnow() >= self.next_refresh:
+            # Only one thread needs to refresh; the others carry on
+            # with the revocations they have, unless there aren't any
+            # yet.
+            if self.refresh_lock.acquire(self.next_refresh is None):
+                try:
+                    if (self.next_refresh is None or
+                        self.utcnow() >= self.next_refresh):
+                        self.__refresh()
+                finally:
+                    self.refresh_lock.release()
+        return nonce in self.revoked
+
+class TokenSweeper(object):
+    '''
+    Periodically removes expired auth tokens, request tokens and
+    revocations from storage that can't expire them by itself.
+
+      >>> from twitblob.storage import MemoryBackend
+      >>> b = MemoryBackend()
+      >>> now = datetime.datetime(2010, 6, 17)
+      >>> b.insert_token({'id': 'a', 'screen_name': 'bob', 'user_id': 1,
+      ...                 'date': now - datetime.timedelta(days=2)})
+      >>> sweeper = TokenSweeper(b, datetime.timedelta(days=1),
+      ...                        utcnow=lambda: now)
+      >>> sweeper.maybe_sweep()
+      1
+      >>> sweeper.maybe_sweep()
+      >>> b.find_token('a')
+    '''
+
+    def __init__(self, storage, token_lifetime,
+                 request_token_lifetime=DEFAULT_REQUEST_TOKEN_LIFETIME,
+                 utcnow=datetime.datetime.utcnow,
+                 interval=DEFAULT_SWEEP_INTERVAL):
+        self.storage = storage
+        self.token_lifetime = token_lifetime
+        self.request_token_lifetime = request_token_lifetime
+        self.utcnow = utcnow
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_sweep = None
+
+    def sweep(self):
+        now = self.utcnow()
+        self.next_sweep = now + self.interval
+        return self.storage.remove_expired_tokens(
+            now - self.token_lifetime,
+            # Request tokens are always dated by the real clock.
+            datetime.datetime.utcnow() - self.request_token_lifetime,
+            now
+            )
+
+    def maybe_sweep(self):
+        # Only one thread needs to sweep; the others carry on.
+        if not self.lock.acquire(False):
+            return None
+        try:
+            if self.next_sweep is None or self.utcnow() >= self.next_sweep:
+                return self.sweep()
+        finally:
+            self.lock.release()
@@ -0,0 +1,295 @@
+'''
+Exporting every blob, and optionally every live auth token, to a
+directory of gzipped newline-delimited JSON files, and importing them
+again, so that data can be backed up or moved between databases.
+
+Blobs are read and written in batches by a number of threads, each
+handling a range of user ids, so memory use doesn't grow with the
+number of blobs. Progress is saved to a checkpoint file after every
+batch, so an interrupted export or import picks up where it left off
+when run again.
+'''
+
+import os
+import glob
+import gzip
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+
+from twitblob import codec as json
+from twitblob.storage import DuplicateToken
+
+DEFAULT_WORKERS = 4
+
+# Number of blobs read or written at a time by each worker.
+DEFAULT_BATCH_SIZE = 1000
+
+BLOBS_FILE = 'blobs-%03d.ndjson.gz'
+
+BLOBS_PATTERN = 'blobs-*.ndjson.gz'
+
+TOKENS_FILE = 'tokens.ndjson.gz'
+
+EXPORT_CHECKPOINT = 'export-checkpoint.json'
+
+IMPORT_CHECKPOINT = 'import-checkpoint.json'
+
+def split_range(low, high, parts):
+    '''
+    Splits the user ids from low to high into at most the given number
+    of (after, until) ranges, the first and last of which are open so
+    that users added during an export aren't missed.
+
+      >>> split_range(1, 100, 4)
+      [(None, 25), (25, 50), (50, 75), (75, None)]
+      >>> split_range(1, 2, 4)
+      [(None, 1), (1, None)]
+    '''
+
+    bounds = []
+    for i in range(1, parts):
+        bound = low + (high - low) * i // parts
+        if not bounds or bound > bounds[-1]:
+            bounds.append(bound)
+    return zip([None] + bounds, bounds + [None])
+
+def parse_date(value):
+    '''
+      >>> parse_date('2010-06-17T00:32:33.985904')
+      datetime.datetime(2010, 6, 17, 0, 32, 33, 985904)
+      >>> parse_date('2010-06-17T00:32:33')
+      datetime.datetime(2010, 6, 17, 0, 32, 33)
+    '''
+
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+def write_lines(f, docs):
+    # Each batch is a complete gzip member, so that a file can be cut
+    # back to the end of the last batch that was checkpointed, and
+    # the result is still a valid gzip file.
+    member = gzip.GzipFile(filename='', mode='wb', fileobj=f)
+    for doc in docs:
+        member.write(json.dumps(doc) + '\n')
+    member.close()
+    f.flush()
+    os.fsync(f.fileno())
+
+def open_for_append(path, offset):
+    if not os.path.exists(path):
+        return open(path, 'wb')
+    f = open(path, 'r+b')
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+class Checkpoint(object):
+    '''
+    The progress of each part of an export or import, kept in a JSON
+    file that's replaced atomically whenever it changes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(path):
+            self.state = json.loads(open(path).read())
+
+    def get(self, name, default=None):
+        self.lock.acquire()
+        try:
+            return self.state.get(name, default)
+        finally:
+            self.lock.release()
+
+    def set(self, name, value):
+        self.lock.acquire()
+        try:
+            self.state[name] = value
+            f = open(self.path + '.tmp', 'w')
+            try:
+                f.write(json.dumps(self.state))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(self.path + '.tmp', self.path)
+        finally:
+            self.lock.release()
+
+def parallel(func, items, workers):
+    if workers < 2 or len(items) < 2:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def export_blobs(storage, path, after, until, checkpoint, batch_size):
+    name = os.path.basename(path)
+    state = checkpoint.get(name) or {'after': after, 'offset': 0,
+                                     'count': 0, 'done': False}
+    if state['done']:
+        return state['count']
+    f = open_for_append(path, state['offset'])
+    try:
+        while True:
+            blobs = list(storage.iter_blobs(state['after'], batch_size,
+                                            until))
+            if not blobs:
+                break
+            write_lines(f, blobs)
+            state = dict(state, after=blobs[-1]['user_id'],
+                         offset=f.tell(), count=state['count'] + len(blobs))
+            checkpoint.set(name, state)
+    finally:
+        f.close()
+    checkpoint.set(name, dict(state, done=True))
+    return state['count']
+
+def export_tokens(storage, path, checkpoint, batch_size, token_lifetime,
+                  now):
+    name = os.path.basename(path)
+    state = checkpoint.get(name)
+    if state is not None and state['done']:
+        return state['count']
+    # There are few enough tokens that they're exported all over again
+    # if the export is interrupted.
+    oldest = now - token_lifetime
+    f = open(path, 'wb')
+    count = 0
+    try:
+        batch = []
+        for token in storage.iter_tokens():
+            if token['date'] < oldest:
+                continue
+            batch.append(dict(token, date=token['date'].isoformat()))
+            if len(batch) == batch_size:
+                write_lines(f, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            write_lines(f, batch)
+            count += len(batch)
+    finally:
+        f.close()
+    checkpoint.set(name, {'count': count, 'done': True})
+    return count
+
+def export(storage, directory, workers=DEFAULT_WORKERS,
+           batch_size=DEFAULT_BATCH_SIZE, token_lifetime=None,
+           utcnow=datetime.datetime.utcnow):
+    '''
+    Exports every blob to the given directory, split between the given
+    number of workers by user id, along with the auth tokens younger
+    than token_lifetime if it's given. Returns the number of blobs and
+    tokens exported.
+    '''
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    checkpoint = Checkpoint(os.path.join(directory, EXPORT_CHECKPOINT))
+
+    # The ranges are saved so that a resumed export splits the blobs
+    # the same way, even if users have been added since it started.
+    ranges = checkpoint.get('ranges')
+    if ranges is None:
+        ranges = [(None, None)]
+        user_id_range = storage.user_id_range()
+        if user_id_range is not None:
+            ranges = split_range(user_id_range[0], user_id_range[1],
+                                 workers)
+        checkpoint.set('ranges', ranges)
+
+    parts = [(os.path.join(directory, BLOBS_FILE % i), after, until)
+             for i, (after, until) in enumerate(ranges)]
+    blobs = sum(parallel(
+        lambda (path, after, until): export_blobs(
+            storage, path, after, until, checkpoint, batch_size
+            ),
+        parts, workers
+        ))
+
+    tokens = 0
+    if token_lifetime is not None:
+        tokens = export_tokens(storage, os.path.join(directory, TOKENS_FILE),
+                               checkpoint, batch_size, token_lifetime,
+                               utcnow())
+    return blobs, tokens
+
+def read_lines(path, skip):
+    f = gzip.GzipFile(path, 'rb')
+    try:
+        for i, line in enumerate(f):
+            if i >= skip:
+                yield json.loads(line)
+    finally:
+        f.close()
+
+def import_blobs(storage, path, checkpoint, batch_size):
+    name = os.path.basename(path)
+    state = checkpoint.get(name) or {'count': 0, 'done': False}
+    if state['done']:
+        return state['count']
+    batch = []
+    for blob in read_lines(path, state['count']):
+        batch.append(blob)
+        if len(batch) == batch_size:
+            storage.restore_blobs(batch)
+            state = dict(state, count=state['count'] + len(batch))
+            checkpoint.set(name, state)
+            batch = []
+    if batch:
+        storage.restore_blobs(batch)
+        state = dict(state, count=state['count'] + len(batch))
+    checkpoint.set(name, dict(state, done=True))
+    return state['count']
+
+def import_tokens(storage, path, checkpoint):
+    name = os.path.basename(path)
+    state = checkpoint.get(name)
+    if state is not None and state['done']:
+        return state['count']
+    count = 0
+    for token in read_lines(path, 0):
+        token['date'] = parse_date(token['date'])
+        try:
+            storage.insert_token(token)
+        except DuplicateToken:
+            pass
+        count += 1
+    checkpoint.set(name, {'count': count, 'done': True})
+    return count
+
+def import_(storage, directory, workers=DEFAULT_WORKERS,
+            batch_size=DEFAULT_BATCH_SIZE, checkpoint_path=None):
+    '''
+    Imports the blobs and auth tokens exported to the given directory,
+    replacing any blobs with the same user ids, with the files divided
+    between the given number of workers. Returns the number of blobs
+    and tokens imported.
+
+    Progress is saved to the export directory, unless another
+    checkpoint path is given.
+    '''
+
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(directory, IMPORT_CHECKPOINT)
+    checkpoint = Checkpoint(checkpoint_path)
+
+    paths = sorted(glob.glob(os.path.join(directory, BLOBS_PATTERN)))
+    blobs = sum(parallel(
+        lambda path: import_blobs(storage, path, checkpoint, batch_size),
+        paths, workers
+        ))
+
+    tokens = 0
+    tokens_path = os.path.join(directory, TOKENS_FILE)
+    if os.path.exists(tokens_path):
+        tokens = import_tokens(storage, tokens_path, checkpoint)
+    return blobs, tokens
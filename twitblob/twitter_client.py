@@ -1,27 +1,182 @@
-import simplejson as json
+import time
 from cgi import parse_qsl
 import urllib
 from wsgiref.util import application_uri
 
+from twitblob import async_http
+from twitblob.http_client import ConnectionPool, UpstreamError, \
+     request_with_retries, DEFAULT_RETRIES, DEFAULT_BACKOFF
+from twitblob.workers import DEFER_KEY
+
+# Key of the WSGI environment under which a login that's waiting on
+# Twitter keeps its progress.
+LOGIN_KEY = 'twitblob.twitter_login'
+
+class OAuthCall(object):
+    '''
+    A signed request to Twitter that a login is waiting on.
+    '''
+
+    def __init__(self, url, method, token=None, idempotent=True):
+        self.url = url
+        self.method = method
+        self.token = token
+        self.idempotent = idempotent
+
+def text_response(status, body):
+    def app(environ, start_response):
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [body]
+    return app
+
+def redirect(location):
+    def app(environ, start_response):
+        start_response('302 Found', [('Location', location)])
+        return []
+    return app
+
 class TwitterOauthClientApp(object):
     base_url = 'https://api.twitter.com/oauth/'
-    request_token_url = base_url + 'request_token'
-    access_token_url = base_url + 'access_token'
-    authorize_url = base_url + 'authorize'
 
-    def __init__(self, consumer, oauth, request_tokens, onsuccess=None):
+    def __init__(self, consumer, oauth, request_tokens, onsuccess=None,
+                 http=None, base_url=None, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, sleep=time.sleep, async_http=None):
         self.oauth = oauth
         self.consumer = consumer
         self.onsuccess = onsuccess
         self.request_tokens = request_tokens
+        # Connections to Twitter are kept alive and shared between
+        # logins.
+        if http is None:
+            http = ConnectionPool()
+        self.http = http
+        # When given an AsyncHttpClient, logins served by a server
+        # that can defer requests don't hold on to a thread while
+        # waiting for Twitter.
+        self.async_http = async_http
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        if base_url is not None:
+            self.base_url = base_url
+        self.request_token_url = self.base_url + 'request_token'
+        self.access_token_url = self.base_url + 'access_token'
+        self.authorize_url = self.base_url + 'authorize'
+
+    def signer(self, url, method, token=None):
+        # Every attempt is signed with a new nonce and timestamp, since
+        # Twitter rejects ones it has already seen.
+        is_form_encoded = (method == 'POST')
+        def sign():
+            headers = {}
+            body = None
+            req = self.oauth.Request.from_consumer_and_token(
+                self.consumer, token=token, http_method=method,
+                http_url=url, is_form_encoded=is_form_encoded
+                )
+            req.sign_request(self.oauth.SignatureMethod_HMAC_SHA1(),
+                             self.consumer, token)
+            if is_form_encoded:
+                body = req.to_postdata()
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+                return url, body, headers
+            return req.to_url(), body, headers
+        return sign
+
+    def oauth_request(self, url, method, token=None, idempotent=True):
+        '''
+        Makes a signed request to Twitter and returns its parsed
+        response, raising UpstreamError if it fails.
+        '''
+
+        content = request_with_retries(self.http, url, method,
+                                       retries=self.retries,
+                                       backoff=self.backoff,
+                                       sleep=self.sleep,
+                                       prepare=self.signer(url, method,
+                                                           token),
+                                       idempotent=idempotent)
+        return dict(parse_qsl(content))
+
+    def oauth_request_async(self, call, callback):
+        '''
+        Makes a signed request to Twitter with the AsyncHttpClient, and
+        later calls callback with its parsed response and None, or with
+        None and the UpstreamError it failed with.
+        '''
+
+        def done(content, error):
+            if error is not None:
+                return callback(None, error)
+            callback(dict(parse_qsl(content)), None)
+        async_http.request_with_retries(
+            self.async_http, call.url, done, call.method,
+            retries=self.retries, backoff=self.backoff,
+            prepare=self.signer(call.url, call.method, call.token),
+            idempotent=call.idempotent
+            )
 
     def __call__(self, environ, start_response):
+        try:
+            if (self.async_http is not None and
+                environ.get(DEFER_KEY) is not None):
+                return self.handle_deferred(environ, start_response)
+            return self.handle(environ, start_response)
+        except UpstreamError, e:
+            start_response(e.status, [('Content-Type', 'text/plain')])
+            return [str(e)]
+
+    def handle(self, environ, start_response):
+        # Makes the calls a login needs to Twitter one after another,
+        # waiting for each.
+        steps = self.steps(environ)
+        step = steps.next()
+        while isinstance(step, OAuthCall):
+            try:
+                response = self.oauth_request(step.url, step.method,
+                                              step.token, step.idempotent)
+            except UpstreamError, e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(response)
+        return step(environ, start_response)
+
+    def handle_deferred(self, environ, start_response):
+        # Defers the request while each call is made, and carries on
+        # with the login's steps, which are kept in the environment,
+        # when it's resumed.
+        login = environ.get(LOGIN_KEY)
+        if login is None:
+            login = environ[LOGIN_KEY] = {'steps': self.steps(environ)}
+            step = login['steps'].next()
+        elif login['error'] is not None:
+            step = login['steps'].throw(login['error'])
+        else:
+            step = login['steps'].send(login['response'])
+        if not isinstance(step, OAuthCall):
+            return step(environ, start_response)
+
+        def start(resume):
+            def done(response, error):
+                login['response'] = response
+                login['error'] = error
+                resume()
+            self.oauth_request_async(step, done)
+        environ[DEFER_KEY](start)
+
+    def steps(self, environ):
+        '''
+        Serves a login, yielding each OAuthCall it needs made to Twitter,
+        to be sent its response or thrown the UpstreamError it failed
+        with, and finally a WSGI application to respond with.
+        '''
+
         path = environ['PATH_INFO']
         qs = environ['QUERY_STRING']
 
         if path == '/':
-            # Step 1: Get a request token. This is a temporary token that is used for 
-            # having the user authorize an access token and to sign the request to obtain 
+            # Step 1: Get a request token. This is a temporary token that is used for
+            # having the user authorize an access token and to sign the request to obtain
             # said access token.
 
             appuri = application_uri(environ)
@@ -33,46 +188,46 @@ class TwitterOauthClientApp(object):
                 self.request_token_url,
                 urllib.urlencode({'oauth_callback': oauth_callback})
                 )
-            client = self.oauth.Client(self.consumer)
-            resp, content = client.request(url, "GET")
-            if resp['status'] != '200':
-                raise Exception("Invalid response %s." % resp['status'])
-
-            request_token = dict(parse_qsl(content))
+            request_token = yield OAuthCall(url, "GET")
 
             if ('oauth_callback_confirmed' not in request_token or
                 request_token['oauth_callback_confirmed'] != 'true'):
-                raise Exception("Oauth callback must be confirmed.")
+                raise UpstreamError("Oauth callback must be confirmed.")
 
             self.request_tokens[request_token['oauth_token']] = request_token
 
             # Step 2: Redirect to the provider.
 
-            redirect_url = "%s?oauth_token=%s" % (self.authorize_url,
-                                                  request_token['oauth_token'])
-            start_response('302 Found',
-                           [('Location', redirect_url)])
-            return []
+            yield redirect("%s?oauth_token=%s" % (
+                self.authorize_url, request_token['oauth_token']
+                ))
         elif path == '/callback':
             qsdict = dict(parse_qsl(qs))
 
-            if qsdict['oauth_token'] not in self.request_tokens:
-                raise Exception('invalid token: %s' % self.request_tokens)
-
-            request_token = self.request_tokens[qsdict['oauth_token']]
-            del self.request_tokens[qsdict['oauth_token']]
+            # Fetching and removing the request token in one operation
+            # means it can only ever be redeemed once.
+            request_token = None
+            if 'oauth_token' in qsdict and 'oauth_verifier' in qsdict:
+                request_token = self.request_tokens.pop(
+                    qsdict['oauth_token'], None
+                    )
+            if request_token is None:
+                yield text_response('400 Bad Request',
+                                    'invalid token: %s' %
+                                    qsdict.get('oauth_token'))
+                return
 
             token = self.oauth.Token(request_token['oauth_token'],
                                      request_token['oauth_token_secret'])
             token.set_verifier(qsdict['oauth_verifier'])
-            client = self.oauth.Client(self.consumer, token)
-            resp, content = client.request(self.access_token_url, "POST")
-            if resp['status'] != '200':
-                raise Exception("Invalid response %s." % resp['status'])
-            access_token = dict(parse_qsl(content))
+            # Redeeming the request token uses it up, so if Twitter may
+            # have seen the request, trying it again can only fail.
+            access_token = yield OAuthCall(self.access_token_url, "POST",
+                                           token, idempotent=False)
+            if ('screen_name' not in access_token or
+                'user_id' not in access_token):
+                raise UpstreamError("Access token has no user.")
             environ['oauth.access_token'] = access_token
-            return self.onsuccess(environ, start_response)
-
-        start_response('404 Not Found',
-                       [('Content-Type', 'text/plain')])
-        return ['path not found: %s' % path]
+            yield self.onsuccess
+        else:
+            yield text_response('404 Not Found', 'path not found: %s' % path)
@@ -0,0 +1,760 @@
+'''
+Multi-threaded and pre-forked HTTP servers for running a WSGI
+application in production, built on wsgiref.
+
+Both kinds of server answer requests from a fixed pool of threads,
+keep HTTP/1.1 connections alive between requests without tying up a
+thread for each, turn connections away with a 503 when too many
+requests are waiting for a thread, and shut down gracefully on
+SIGTERM or SIGINT, letting requests in progress finish.
+On SIGHUP they reload, building a fresh application from the
+factory they were given.
+
+Applications can also give up their thread while they wait on
+something slow, such as another server: calling the function in
+environ[DEFER_KEY] with a start function unwinds the application,
+start(resume) is called, and once it calls resume(), from any thread,
+the application is called again with the same environ, in which it
+can keep whatever it needs to carry on where it left off.
+'''
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import threading
+import Queue
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, \
+     ServerHandler
+
+DEFAULT_THREADS = 10
+
+DEFAULT_WORKERS = 4
+
+DEFAULT_KEEPALIVE_TIMEOUT = 15
+
+# Number of connections with a request waiting that may queue for a
+# thread before others are turned away.
+DEFAULT_QUEUE_SIZE = 100
+
+DEFAULT_GRACEFUL_TIMEOUT = 30
+
+DEFAULT_BACKLOG = 128
+
+log = logging.getLogger('twitblob.workers')
+
+# Key of the WSGI environment under which the server offers to defer a
+# request.
+DEFER_KEY = 'twitblob.defer'
+
+# Key of the WSGI environment that's true when an application is
+# called again for a request it deferred.
+RESUMED_KEY = 'twitblob.resumed'
+
+# Returned by KeepAliveHandler in place of whether to keep a
+# connection open, when its request has been deferred.
+DEFERRED = 'deferred'
+
+# Sent to connections whose requests arrive while the queue is full.
+BUSY_RESPONSE = ('HTTP/1.1 503 Service Unavailable\r\n'
+                 'Content-Type: text/plain\r\n'
+                 'Content-Length: 9\r\n'
+                 'Retry-After: 1\r\n'
+                 'Connection: close\r\n'
+                 '\r\n'
+                 'too busy\n')
+
+class LimitedInput(object):
+    '''
+    A file-like object that reads at most a given number of bytes
+    from a stream, so that an application can't read past the end of
+    a request body into the next request on a kept-alive connection.
+
+      >>> from StringIO import StringIO
+      >>> f = LimitedInput(StringIO('foo\\nbar-next request'), 7)
+      >>> f.readline()
+      'foo\\n'
+      >>> f.read()
+      'bar'
+      >>> f.read(), f.remaining
+      ('', 0)
+    '''
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+class Deferred(Exception):
+    '''
+    Raised through an application by the function in its environ's
+    DEFER_KEY, to give its thread back until its request is resumed.
+    WSGI middleware should let it pass, as it would any exception.
+    '''
+
+    def __init__(self, start):
+        Exception.__init__(self, start)
+        self.start = start
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def __init__(self, request_handler, *args, **kwargs):
+        ServerHandler.__init__(self, *args, **kwargs)
+        self.request_handler = request_handler
+
+    def run(self, application):
+        '''
+        Serves the request with the application, as ServerHandler.run
+        does, unless the application defers it, in which case the
+        Deferred is returned and the response is left unfinished.
+        '''
+
+        self.setup_environ()
+        # The application may have moved parts of the path to
+        # SCRIPT_NAME, which it will expect to do again if resumed.
+        self.path = (self.environ.get('SCRIPT_NAME', ''),
+                     self.environ.get('PATH_INFO', ''))
+        return self.respond(application)
+
+    def resume(self, application):
+        self.environ['SCRIPT_NAME'], self.environ['PATH_INFO'] = self.path
+        self.environ[RESUMED_KEY] = True
+        return self.respond(application)
+
+    def respond(self, application):
+        try:
+            self.result = application(self.environ, self.start_response)
+            self.finish_response()
+        except Deferred, e:
+            return e
+        except:
+            try:
+                self.handle_error()
+            except:
+                self.close()
+                raise
+        return None
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        # Without a Content-Length the end of the response can only be
+        # signalled by closing the connection.
+        if 'Content-Length' not in self.headers:
+            self.request_handler.close_connection = 1
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+class KeepAliveHandler(WSGIRequestHandler):
+    '''
+    Serves any number of requests over a single HTTP/1.1 connection.
+
+    Unlike other request handlers, it doesn't serve its connection as
+    soon as it's made; the server's threads call handle_one_request()
+    each time a request arrives on it.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = 0
+        # The request that's waiting to be resumed, if any, and what's
+        # needed to finish it.
+        self.deferred = None
+        self.setup()
+
+    def buffered(self):
+        # Whether the start of another request has already been read
+        # from the socket, in which case waiting for the socket to
+        # become readable again might mean waiting forever.
+        return self.rfile._rbuf.tell() > 0
+
+    def setup(self):
+        # Seconds an idle kept-alive connection is held open.
+        self.timeout = self.server.keepalive_timeout
+        WSGIRequestHandler.setup(self)
+        # Headers and body are written separately, and on a kept-alive
+        # connection Nagle's algorithm would hold the body back until
+        # the client acknowledges the headers.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                   1)
+
+    def handle(self):
+        BaseHTTPRequestHandler.handle(self)
+
+    def handle_next_request(self):
+        '''
+        Serves the request that has arrived, along with any others
+        that were sent with it, and returns whether the connection
+        should be kept open for more.
+        '''
+
+        while True:
+            self.close_connection = 1
+            self.handle_one_request()
+            if self.deferred is not None:
+                return DEFERRED
+            if self.close_connection or self.server.stopping:
+                return False
+            if not self.buffered():
+                return True
+
+    def resume_next_request(self):
+        '''
+        Finishes serving a request that was deferred, and then any
+        others sent after it, returning whether the connection should
+        be kept open for more, or DEFERRED.
+        '''
+
+        handler, stdin, app, deferred = self.deferred
+        self.deferred = None
+        deferred = handler.resume(app)
+        if deferred is not None:
+            self.deferred = (handler, stdin, app, deferred)
+            return DEFERRED
+        self.end_request(stdin)
+        if self.close_connection or self.server.stopping:
+            return False
+        if not self.buffered():
+            return True
+        return self.handle_next_request()
+
+    def defer(self, start):
+        raise Deferred(start)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        if self.server.stopping:
+            self.close_connection = 1
+
+        environ = self.get_environ()
+        environ[DEFER_KEY] = self.defer
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        stdin = LimitedInput(self.rfile, length)
+        handler = KeepAliveServerHandler(self, stdin, self.wfile,
+                                         self.get_stderr(), environ)
+        # A deferred request is resumed with the application it
+        # started with, even if the server has been reloaded since.
+        app = self.server.get_app()
+        deferred = handler.run(app)
+        if deferred is not None:
+            self.deferred = (handler, stdin, app, deferred)
+            return
+        self.end_request(stdin)
+
+    def end_request(self, stdin):
+        # Any part of the body the application didn't read would be
+        # mistaken for the next request.
+        if stdin.remaining:
+            self.close_connection = 1
+        self.wfile.flush()
+
+class IdleConnections(object):
+    '''
+    Watches kept-alive connections between requests, so that they
+    don't each hold on to a thread, handing each back to its server
+    once another request arrives on it, and closing those that have
+    been idle for longer than the server's keep-alive timeout.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.added = []
+        self.stopped = False
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in [self.wakeup_r, self.wakeup_w]:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add(self, handler):
+        self.lock.acquire()
+        try:
+            stopped = self.stopped
+            if not stopped:
+                self.added.append(handler)
+                self.wake()
+        finally:
+            self.lock.release()
+        if stopped:
+            self.server.close_connection(handler)
+
+    def wake(self):
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, e:
+            # If the pipe is full, the watcher is already awake.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def stop(self):
+        '''
+        Closes every idle connection and stops watching for more.
+        '''
+
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            self.wake()
+        finally:
+            self.lock.release()
+        self.thread.join()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def watch(self):
+        poll = select.poll()
+        poll.register(self.wakeup_r, select.POLLIN)
+        handlers = {}
+        while True:
+            self.lock.acquire()
+            try:
+                added, self.added = self.added, []
+                stopped = self.stopped
+            finally:
+                self.lock.release()
+            deadline = time.time() + self.server.keepalive_timeout
+            for handler in added:
+                fd = handler.connection.fileno()
+                handlers[fd] = (handler, deadline)
+                poll.register(fd, select.POLLIN)
+            if stopped:
+                for handler, deadline in handlers.values():
+                    self.server.close_connection(handler)
+                return
+
+            timeout = None
+            if handlers:
+                timeout = max(0, min(deadline for handler, deadline
+                                     in handlers.values()) - time.time())
+            try:
+                events = poll.poll(timeout and timeout * 1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            now = time.time()
+            ready = []
+            for fd, event in events:
+                if fd == self.wakeup_r:
+                    try:
+                        while os.read(self.wakeup_r, 4096):
+                            pass
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                else:
+                    ready.append(fd)
+            expired = [fd for fd, (handler, deadline) in handlers.items()
+                       if fd not in ready and deadline <= now]
+            for fd in ready + expired:
+                poll.unregister(fd)
+                handler, deadline = handlers.pop(fd)
+                if fd in ready:
+                    self.server.dispatch(handler)
+                else:
+                    self.server.close_connection(handler)
+
+class PooledWSGIServer(WSGIServer):
+    '''
+    A WSGI server that serves requests from a fixed pool of threads.
+    A connection is only handed to a thread once a request has
+    arrived on it, and if more than queue_size connections are
+    already waiting for one, it's turned away with a 503.
+    '''
+
+    request_queue_size = DEFAULT_BACKLOG
+
+    def __init__(self, server_address, handler_class=KeepAliveHandler,
+                 threads=DEFAULT_THREADS,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 queue_size=DEFAULT_QUEUE_SIZE, bind_and_activate=True):
+        WSGIServer.__init__(self, server_address, handler_class,
+                            bind_and_activate)
+        self.keepalive_timeout = keepalive_timeout
+        self.stopping = False
+        # Deferred requests being resumed go to the front of the line
+        # however long it is, having been let in once already, so the
+        # queue's size is limited by dispatch() alone.
+        self.queue_size = queue_size
+        self.requests = Queue.Queue()
+        self.turned_away = 0
+        self.deferred = 0
+        self.deferred_cond = threading.Condition(threading.Lock())
+        self.idle = IdleConnections(self)
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.process_requests)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        # New connections wait with the idle ones for their first
+        # request, so that clients that connect and then say nothing
+        # don't hold on to a thread.
+        try:
+            handler = self.RequestHandlerClass(request, client_address,
+                                               self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self.idle.add(handler)
+
+    def dispatch(self, handler):
+        # Only the thread watching idle connections dispatches them, so
+        # the queue can't grow between checking its size and adding
+        # to it, other than by resumed requests.
+        if self.requests.qsize() < self.queue_size:
+            self.requests.put(handler)
+        else:
+            self.turned_away += 1
+            try:
+                handler.connection.sendall(BUSY_RESPONSE)
+            except socket.error:
+                pass
+            self.close_connection(handler)
+
+    def close_connection(self, handler):
+        try:
+            handler.finish()
+        except socket.error:
+            pass
+        self.shutdown_request(handler.request)
+
+    def process_requests(self):
+        while True:
+            handler = self.requests.get()
+            if handler is None:
+                return
+            try:
+                if handler.deferred is not None:
+                    keep_alive = handler.resume_next_request()
+                else:
+                    keep_alive = handler.handle_next_request()
+            except Exception:
+                self.handle_error(handler.request, handler.client_address)
+                keep_alive = False
+            if keep_alive == DEFERRED:
+                self.start_deferred(handler)
+            elif keep_alive and not self.stopping:
+                self.idle.add(handler)
+            else:
+                self.close_connection(handler)
+
+    def start_deferred(self, handler):
+        # Called once the thread that deferred the request has let go
+        # of it, so that it can't be served by two threads at once.
+        self.count_deferred(1)
+        resumed = []
+        def resume():
+            if not resumed:
+                resumed.append(True)
+                self.requests.put(handler)
+                self.count_deferred(-1)
+        try:
+            handler.deferred[3].start(resume)
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            if not resumed:
+                resumed.append(True)
+                self.count_deferred(-1)
+                self.close_connection(handler)
+
+    def count_deferred(self, change):
+        self.deferred_cond.acquire()
+        try:
+            self.deferred += change
+            self.deferred_cond.notifyAll()
+        finally:
+            self.deferred_cond.release()
+
+    def drain(self, timeout=None):
+        '''
+        Closes idle connections, and stops the thread pool once the
+        requests that have already arrived, including those that have
+        been deferred, have been served.
+        '''
+
+        self.stopping = True
+        self.idle.stop()
+        deadline = timeout and time.time() + timeout
+        self.deferred_cond.acquire()
+        try:
+            while self.deferred:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.deferred_cond.wait(remaining)
+                else:
+                    self.deferred_cond.wait()
+        finally:
+            self.deferred_cond.release()
+        for thread in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            if deadline:
+                thread.join(max(0, deadline - time.time()))
+            else:
+                thread.join()
+
+def listen(host, port, backlog=DEFAULT_BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def make_server(sock, app, threads=DEFAULT_THREADS,
+                keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                handler_class=KeepAliveHandler,
+                queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Makes a PooledWSGIServer that accepts connections from an already
+    listening socket, which may be shared with other processes.
+    '''
+
+    server = PooledWSGIServer(sock.getsockname(), handler_class,
+                              threads=threads,
+                              keepalive_timeout=keepalive_timeout,
+                              queue_size=queue_size,
+                              bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    host, port = sock.getsockname()[:2]
+    server.server_name = socket.getfqdn(host)
+    server.server_port = port
+    server.setup_environ()
+    server.set_app(app)
+    return server
+
+def run_server(server, app_factory, graceful_timeout):
+    '''
+    Serves requests until SIGTERM or SIGINT is received, reloading the
+    application on SIGHUP.
+    '''
+
+    received = []
+    def on_signal(signum, frame):
+        received.append(signum)
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, on_signal)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    while True:
+        while not received:
+            time.sleep(1)
+        if received.pop(0) == signal.SIGHUP:
+            # A bad config file or an unreachable database shouldn't
+            # take the server down with it.
+            try:
+                app = app_factory()
+            except Exception:
+                log.exception('reloading failed; still serving the '
+                              'previous application')
+                continue
+            server.set_app(app)
+            continue
+        break
+    server.shutdown()
+    server.drain(graceful_timeout)
+
+def serve_threaded(app_factory, host='', port=8000,
+                   threads=DEFAULT_THREADS,
+                   keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                   graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT,
+                   queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Serves the application returned by app_factory from a single
+    process with a pool of threads.
+    '''
+
+    server = make_server(listen(host, port), app_factory(), threads,
+                         keepalive_timeout, queue_size=queue_size)
+    run_server(server, app_factory, graceful_timeout)
+
+class PreforkMaster(object):
+    '''
+    Manages a number of worker processes that each serve requests
+    from a shared listening socket with a pool of threads.
+
+    The application is built by calling app_factory in each worker
+    after it has been forked, so that database connections aren't
+    shared between processes. Workers that die are replaced. On
+    SIGHUP a new set of workers is started and the old ones are
+    stopped gracefully.
+    '''
+
+    def __init__(self, sock, app_factory, workers=DEFAULT_WORKERS,
+                 threads=DEFAULT_THREADS,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.sock = sock
+        self.app_factory = app_factory
+        self.workers = workers
+        self.threads = threads
+        self.keepalive_timeout = keepalive_timeout
+        self.graceful_timeout = graceful_timeout
+        self.queue_size = queue_size
+        self.pids = set()
+        self.received = []
+
+    def spawn(self):
+        # Anything buffered now would otherwise be written again by
+        # the child.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+        status = 0
+        try:
+            try:
+                for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                               signal.SIGCHLD]:
+                    signal.signal(signum, signal.SIG_DFL)
+                server = make_server(self.sock, self.app_factory(),
+                                     self.threads, self.keepalive_timeout,
+                                     queue_size=self.queue_size)
+                run_server(server, self.app_factory, self.graceful_timeout)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def stop(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        deadline = time.time() + self.graceful_timeout
+        while pids & self.pids and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in pids & self.pids:
+            os.kill(pid, signal.SIGKILL)
+        while pids & self.pids:
+            self.reap(block=True)
+
+    def reap(self, block=False):
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, (not block) and os.WNOHANG or 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.pids.clear()
+                    return
+                raise
+            if not pid:
+                return
+            self.pids.discard(pid)
+            if block:
+                return
+
+    def on_signal(self, signum, frame):
+        self.received.append(signum)
+
+    def run(self):
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP,
+                       signal.SIGCHLD]:
+            signal.signal(signum, self.on_signal)
+        for i in range(self.workers):
+            self.spawn()
+        while True:
+            while not self.received:
+                time.sleep(1)
+            signum = self.received.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                self.stop(set(self.pids))
+                return
+            if signum == signal.SIGHUP:
+                old = set(self.pids)
+                for i in range(self.workers):
+                    self.spawn()
+                self.stop(old)
+            self.reap()
+            while len(self.pids) < self.workers:
+                self.spawn()
+
+def serve_prefork(app_factory, host='', port=8000, workers=DEFAULT_WORKERS,
+                  threads=DEFAULT_THREADS,
+                  keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                  graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT,
+                  queue_size=DEFAULT_QUEUE_SIZE):
+    '''
+    Serves the application returned by app_factory from a number of
+    pre-forked worker processes, each with a pool of threads.
+    '''
+
+    master = PreforkMaster(listen(host, port), app_factory, workers,
+                           threads, keepalive_timeout, graceful_timeout,
+                           queue_size)
+    master.run()